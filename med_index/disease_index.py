@@ -0,0 +1,288 @@
+"""
+disease_index.py
+
+Инвертированный индекс "заболевание -> id чанков" по результату пайплайна (med_index/pipeline.py):
+чанки с полями diseases, section_titles, linked_diagnoses. Чанки диагноза берутся напрямую, без векторного
+поиска: из индекса чанков (CHUNKS_INDEX_DIR, id узла = id_ чанка, pipeline.sync_index), а недостающие —
+из сохранённых чанков пайплайна (MED_CHUNKS_PATH, текст и метаданные).
+
+Ключи нормализуются (NFKC, регистр, апострофы, дефисы, пунктуация) и сворачиваются по синонимам:
+встроенный словарь DISEASE_SYNONYMS, JSON-файл синонимов (settings.DISEASE_SYNONYMS_PATH) и скобочные
+варианты из самих чанков ("Chickenpox (varicella)" -> varicella = chickenpox).
+
+Поиск по вопросу — словарные обращения по n-граммам слов вопроса (самые длинные совпадения),
+без обхода индекса.
+
+Пример:
+    disease_index = DiseaseIndex.build(chunks)
+    disease_index.save(DISEASE_INDEX_PATH)
+    disease_index.lookup("Varicella")                         # id чанков chickenpox: прямые + связанные
+    DiseaseIndex.load(DISEASE_INDEX_PATH).match("What are the symptoms of whooping cough?")  # ["pertussis"]
+"""
+import os
+import re
+import asyncio
+import unicodedata
+from typing import Any, Dict, Iterable, List, Optional
+
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from utils.general import load_json, save_json
+
+# вариант -> основное название (оба в нормализованном виде)
+DISEASE_SYNONYMS: Dict[str, str] = {
+    "varicella": "chickenpox",
+    "chicken pox": "chickenpox",
+    "rubeola": "measles",
+    "german measles": "rubella",
+    "whooping cough": "pertussis",
+    "glandular fever": "infectious mononucleosis",
+    "mono": "infectious mononucleosis",
+    "slapped cheek syndrome": "erythema infectiosum",
+    "fifth disease": "erythema infectiosum",
+    "parvovirus b19 infection": "erythema infectiosum",
+    "roseola": "roseola infantum",
+    "sixth disease": "roseola infantum",
+    "hfmd": "hand foot and mouth disease",
+    "scarlatina": "scarlet fever",
+    "epidemic parotitis": "mumps",
+    "laryngotracheobronchitis": "croup",
+    "uti": "urinary tract infection",
+    "aom": "acute otitis media",
+    "otitis media acute": "acute otitis media",
+    "gord": "gastro oesophageal reflux disease",
+    "gerd": "gastro oesophageal reflux disease",
+    "gastroesophageal reflux disease": "gastro oesophageal reflux disease",
+    "gastro esophageal reflux disease": "gastro oesophageal reflux disease",
+    "adhd": "attention deficit hyperactivity disorder",
+    "covid": "covid 19",
+    "sars cov 2 infection": "covid 19",
+    "tb": "tuberculosis",
+    "kawasaki syndrome": "kawasaki disease",
+    "mucocutaneous lymph node syndrome": "kawasaki disease",
+    "t1dm": "type 1 diabetes mellitus",
+    "type 1 diabetes": "type 1 diabetes mellitus",
+}
+MAX_NGRAM = 6
+_PAREN_RE = re.compile(r"\(([^()]*)\)")
+
+
+def normalize_disease(name: str) -> str:
+    """NFKC, нижний регистр, без притяжательного 's, дефисы и пунктуация — пробелы, схлопнутые пробелы."""
+    text = unicodedata.normalize("NFKC", name or "").lower().replace("’", "'")
+    text = re.sub(r"'s\b", "", text)
+    text = re.sub(r"[^\w]+", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _name_variants(name: str) -> List[str]:
+    """Название и его скобочные варианты: "Chickenpox (varicella)" -> ["chickenpox", "varicella"]."""
+    variants = [normalize_disease(_PAREN_RE.sub(" ", name))]
+    variants.extend(normalize_disease(inner) for inner in _PAREN_RE.findall(name or ""))
+    return [v for v in variants if v]
+
+
+class DiseaseIndex:
+    """
+    Индекс заболеваний: keys {ключ: [id чанков]}, links {id чанка: [id связанных чанков]},
+    synonyms {вариант: ключ}, names {ключ: исходное название}.
+    """
+
+    def __init__(
+            self,
+            keys: Optional[Dict[str, List[str]]] = None,
+            links: Optional[Dict[str, List[str]]] = None,
+            synonyms: Optional[Dict[str, str]] = None,
+            names: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.keys: Dict[str, List[str]] = keys or {}
+        self.links: Dict[str, List[str]] = links or {}
+        self.synonyms: Dict[str, str] = dict(DISEASE_SYNONYMS)
+        self.synonyms.update(synonyms or {})
+        self.names: Dict[str, str] = names or {}
+
+    def key(self, name: str) -> str:
+        """Ключ заболевания: нормализованное название, свёрнутое по синонимам."""
+        key = normalize_disease(name)
+        return self.synonyms.get(key, key)
+
+    @classmethod
+    def build(cls, chunks: Iterable[Dict[str, Any]], synonyms: Optional[Dict[str, str]] = None) -> "DiseaseIndex":
+        """
+        Индекс по чанкам пайплайна. Чанки, где заболевание есть в section_titles (раздел о нём),
+        идут в списке ключа первыми, остальные — в порядке документа (chunk_index).
+
+        :param chunks: чанки с id_, diseases, section_titles, linked_diagnoses
+        :param synonyms: дополнительные синонимы {вариант: основное название}
+        """
+        index = cls()
+        for variant, canonical in (synonyms or {}).items():
+            index.synonyms[normalize_disease(variant)] = index.key(canonical)
+
+        chunks = sorted((c for c in chunks if c.get("id_")), key=lambda c: c.get("chunk_index", 0))
+        # скобочные варианты: "Chickenpox (varicella)" — varicella сворачивается в chickenpox
+        for chunk in chunks:
+            for name in chunk.get("diseases") or []:
+                variants = _name_variants(name)
+                for alias in variants[1:]:
+                    index.synonyms.setdefault(alias, index.key(variants[0]))
+
+        titled: Dict[str, List[str]] = {}
+        mentioned: Dict[str, List[str]] = {}
+        for chunk in chunks:
+            title_keys = {index.key(v) for t in chunk.get("section_titles") or [] for v in _name_variants(t)}
+            for name in chunk.get("diseases") or []:
+                variants = _name_variants(name)
+                if not variants:
+                    continue
+                key = index.key(variants[0])
+                index.names.setdefault(key, name)
+                target = titled if key in title_keys else mentioned
+                ids = target.setdefault(key, [])
+                if chunk["id_"] not in ids:
+                    ids.append(chunk["id_"])
+            linked = [i for i in (chunk.get("linked_diagnoses") or {}).values() if i and i != chunk["id_"]]
+            if linked:
+                index.links[chunk["id_"]] = list(dict.fromkeys(linked))
+        for key in set(titled) | set(mentioned):
+            ids = titled.get(key, [])
+            index.keys[key] = ids + [i for i in mentioned.get(key, []) if i not in ids]
+        return index
+
+    # ───────────────────────────── хранение ─────────────────────────────
+
+    def save(self, path: str) -> bool:
+        learned = {k: v for k, v in self.synonyms.items() if DISEASE_SYNONYMS.get(k) != v}
+        return save_json({"keys": self.keys, "links": self.links, "synonyms": learned, "names": self.names}, path)
+
+    @classmethod
+    def load(cls, path: str, synonyms_path: Optional[str] = None) -> "DiseaseIndex":
+        """Загружает индекс (пустой, если файла нет) и дополняет синонимы из synonyms_path."""
+        data = load_json(path) if os.path.isfile(path) else None
+        data = data or {}
+        index = cls(data.get("keys"), data.get("links"), data.get("synonyms"), data.get("names"))
+        extra = load_json(synonyms_path) if synonyms_path and os.path.isfile(synonyms_path) else None
+        for variant, canonical in (extra or {}).items():
+            index.synonyms[normalize_disease(variant)] = index.key(canonical)
+        return index
+
+    # ───────────────────────────── поиск ─────────────────────────────
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, name: str) -> bool:
+        return self.key(name) in self.keys
+
+    def lookup(self, name: str, with_links: bool = True, max_chunks: Optional[int] = None) -> List[str]:
+        """
+        id чанков заболевания: прямые попадания, затем связанные чанки (linked_diagnoses).
+
+        :param name: название заболевания (любой вариант или синоним)
+        :param with_links: добавлять связанные чанки
+        :param max_chunks: не больше стольких id (None — все)
+        """
+        direct = self.keys.get(self.key(name), [])
+        ids = list(direct)
+        if with_links:
+            seen = set(ids)
+            for chunk_id in direct:
+                for linked in self.links.get(chunk_id, []):
+                    if linked not in seen:
+                        seen.add(linked)
+                        ids.append(linked)
+        return ids[:max_chunks] if max_chunks is not None else ids
+
+    def match(self, text: str) -> List[str]:
+        """
+        Ключи заболеваний, названных в тексте: самые длинные n-граммы слов (до MAX_NGRAM), совпавшие
+        с ключом или синонимом, без перекрытий, в порядке появления.
+        """
+        words = normalize_disease(text).split()
+        found: List[str] = []
+        i = 0
+        while i < len(words):
+            for n in range(min(MAX_NGRAM, len(words) - i), 0, -1):
+                key = self.key(" ".join(words[i:i + n]))
+                if key in self.keys:
+                    if key not in found:
+                        found.append(key)
+                    i += n
+                    break
+            else:
+                i += 1
+        return found
+
+
+def chunk_to_node(chunk: Dict[str, Any]) -> TextNode:
+    """TextNode llama-index из чанка пайплайна: id узла = id_ чанка, остальные поля — метаданные."""
+    return TextNode(
+        id_=chunk["id_"],
+        text=chunk["text"],
+        metadata={k: v for k, v in chunk.items() if k not in ("id_", "text")},
+    )
+
+
+class DiseaseIndexRetriever(BaseRetriever):
+    """
+    Retriever llama-index: чанки заболеваний, названных в запросе, напрямую (с linked_diagnoses);
+    если заболевание не найдено или ни один его чанк не нашёлся — fallback-retriever (векторный/гибридный).
+
+    stats — счётчики: lookups (запросы с известным заболеванием), unresolved (ни одного найденного чанка —
+    индекс заболеваний рассинхронизирован с чанками), fallback (запросы, ушедшие в fallback).
+    """
+
+    def __init__(self, index: Any, disease_index: DiseaseIndex, fallback: Any, max_chunks: int = 8,
+                 chunks: Optional[Iterable[Dict[str, Any]]] = None, **kwargs: Any) -> None:
+        """
+        :param index: индекс чанков пайплайна (id узла = id_ чанка) или None
+        :param disease_index: индекс заболеваний тех же чанков
+        :param fallback: retriever для запросов без известного заболевания
+        :param max_chunks: сколько чанков вернуть на запрос
+        :param chunks: сохранённые чанки пайплайна — узлы для id, которых нет в index
+        """
+        super().__init__(**kwargs)
+        self._index = index
+        self._disease_index = disease_index
+        self._fallback = fallback
+        self._max_chunks = int(max_chunks)
+        self._chunks: Dict[str, Dict[str, Any]] = {c["id_"]: c for c in chunks or [] if c.get("id_")}
+        self.stats: Dict[str, int] = {"lookups": 0, "unresolved": 0, "fallback": 0}
+
+    def lookup_nodes(self, query: str) -> List[NodeWithScore]:
+        """Чанки заболеваний запроса (score None — без отсечения по сходству)."""
+        ids: List[str] = []
+        for key in self._disease_index.match(query):
+            ids.extend(i for i in self._disease_index.lookup(key) if i not in ids)
+        ids = ids[:self._max_chunks]
+        if not ids:
+            return []
+        self.stats["lookups"] += 1
+        loaded: Dict[str, Any] = {}
+        if self._index is not None:
+            from utils.mmap_vector_store import get_nodes_by_id
+            loaded = get_nodes_by_id(self._index, ids)
+        for chunk_id in ids:
+            if chunk_id not in loaded and chunk_id in self._chunks:
+                loaded[chunk_id] = chunk_to_node(self._chunks[chunk_id])
+        nodes = [NodeWithScore(node=loaded[i], score=None) for i in ids if i in loaded]
+        if not nodes:
+            self.stats["unresolved"] += 1
+            print(f"[disease_index] ни один из {len(ids)} чанков не найден для запроса {query!r} — "
+                  f"индекс заболеваний не соответствует чанкам (перезапустите med_index.pipeline)")
+        return nodes
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        nodes = self.lookup_nodes(query_bundle.query_str)
+        if nodes:
+            return nodes
+        self.stats["fallback"] += 1
+        return self._fallback.retrieve(query_bundle)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        nodes = await asyncio.to_thread(self.lookup_nodes, query_bundle.query_str)
+        if nodes:
+            return nodes
+        self.stats["fallback"] += 1
+        return await self._fallback.aretrieve(query_bundle)
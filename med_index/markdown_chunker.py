@@ -0,0 +1,142 @@
+"""
+markdown_chunker.py
+
+Разбиение markdown (полученного через HeaderDetector, см. toolkit/md_processing/markdown_converter.py)
+на чанки по границам заголовков #/##/###.
+
+Каждый чанк получает heading_path — цепочку заголовков от корня до своего раздела — и сразу
+заполненные section_titles, поэтому извлекать заголовки из текста (regexp/LLM) не нужно.
+Разделы, не укладывающиеся в бюджет токенов, дробятся SentenceSplitter'ом с перекрытием.
+"""
+
+import re
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from utils.tokenizer_counter import approximate_tokens_counter
+
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_MD_MARKUP_RE = re.compile(r"[*_`]+")
+
+MarkdownSource = Union[str, Dict[int, str]]  # весь markdown или {номер страницы: markdown}
+
+
+def _clean_heading(text: str) -> str:
+    """Текст заголовка без markdown-разметки (**bold**, _italic_, `code`)."""
+    return re.sub(r"\s+", " ", _MD_MARKUP_RE.sub("", text)).strip()
+
+
+def _iter_lines(markdown: MarkdownSource) -> Iterable[Tuple[Optional[int], str]]:
+    """Строки markdown вместе с номером страницы (None, если markdown передан одной строкой)."""
+    if isinstance(markdown, str):
+        for line in markdown.splitlines():
+            yield None, line
+        return
+    for page in sorted(markdown):
+        for line in markdown[page].splitlines():
+            yield page, line
+
+
+def split_markdown_sections(markdown: MarkdownSource, max_level: int = 3) -> List[Dict[str, Any]]:
+    """
+    Делит markdown на разделы по заголовкам уровня 1..max_level (заголовки глубже остаются в тексте).
+
+    :param markdown: markdown строкой или по страницам {page: markdown}
+    :param max_level: самый глубокий уровень заголовка, по которому режется текст
+    :return: [{"heading_path": [...], "level": int, "text": str, "page": int | None}, ...]
+             — в порядке документа; разделы без текста (заголовок сразу перед подзаголовком) опускаются
+    """
+    sections: List[Dict[str, Any]] = []
+    path: List[str] = []
+    level = 0
+    lines: List[str] = []
+    page: Optional[int] = None
+
+    def close() -> None:
+        text = "\n".join(lines).strip()
+        if text:
+            sections.append({"heading_path": list(path), "level": level, "text": text, "page": page})
+
+    for line_page, line in _iter_lines(markdown):
+        m = _HEADING_RE.match(line)
+        if m and len(m.group(1)) <= max_level and _clean_heading(m.group(2)):
+            close()
+            level = len(m.group(1))
+            # путь: заголовки более высоких уровней + текущий
+            path = path[:level - 1] + [""] * max(0, level - 1 - len(path)) + [_clean_heading(m.group(2))]
+            lines = []
+            page = line_page
+            continue
+        if not lines and not line.strip():
+            continue
+        if not lines and page is None:
+            page = line_page
+        lines.append(line)
+    close()
+    return sections
+
+
+def chunk_markdown(
+        markdown: MarkdownSource,
+        file_name: str = "",
+        *,
+        chunk_size: int = 1024,
+        chunk_overlap: int = 100,
+        max_level: int = 3,
+        include_heading: bool = True,
+        tokens_counter: Callable[[str], int] = approximate_tokens_counter,
+        start_index: int = 0,
+) -> List[Dict[str, Any]]:
+    """
+    Чанки по разделам markdown: раздел целиком, если укладывается в chunk_size токенов, иначе —
+    части SentenceSplitter(chunk_size, chunk_overlap). Формат совместим с pipeline.chunk_documents.
+
+    :param markdown: markdown строкой или по страницам {page: markdown}
+    :param file_name: имя исходного файла (в метаданные чанка)
+    :param chunk_size: бюджет токенов на чанк
+    :param chunk_overlap: перекрытие частей крупного раздела (токены)
+    :param max_level: самый глубокий уровень заголовка, по которому режется текст
+    :param include_heading: добавлять путь заголовков первой строкой текста чанка (контекст для эмбеддинга)
+    :param tokens_counter: счётчик токенов
+    :param start_index: chunk_index первого чанка (при чанкинге нескольких документов подряд)
+    :return: [{"text","file_name","page","chunk_index","heading_path","section_titles"}, ...]
+    """
+    splitters: Dict[int, Any] = {}  # бюджет -> SentenceSplitter (бюджет зависит от длины пути заголовков)
+    chunks: List[Dict[str, Any]] = []
+    chunk_index = start_index
+    for section in split_markdown_sections(markdown, max_level=max_level):
+        heading_path = [h for h in section["heading_path"] if h]
+        prefix = " > ".join(heading_path) + "\n" if include_heading and heading_path else ""
+        body = section["text"]
+        budget = chunk_size - (tokens_counter(prefix) if prefix else 0)
+        if tokens_counter(body) <= budget:
+            parts = [body]
+        else:
+            budget = max(budget, chunk_overlap + 1)
+            if budget not in splitters:
+                from llama_index.core.node_parser import SentenceSplitter
+                splitters[budget] = SentenceSplitter(chunk_size=budget, chunk_overlap=chunk_overlap)
+            parts = splitters[budget].split_text(body)
+        for part in parts:
+            chunks.append({
+                "text": prefix + part,
+                "file_name": file_name,
+                "page": section["page"],
+                "chunk_index": chunk_index,
+                "heading_path": heading_path,
+                "section_titles": list(heading_path),
+            })
+            chunk_index += 1
+    return chunks
+
+
+if __name__ == "__main__":
+    import os
+    from utils.custom_print import custom_pretty_print
+
+    MD_PATH = os.path.join("../tests/data", "Easy Paediatrics.md")
+    with open(MD_PATH, "r", encoding="utf-8") as fp:
+        md_text = fp.read()
+
+    md_chunks = chunk_markdown(md_text, os.path.basename(MD_PATH), chunk_size=700)
+    print(f"Разделов: {len(split_markdown_sections(md_text))}, чанков: {len(md_chunks)}")
+    custom_pretty_print("Первые чанки:", md_chunks[:3])
@@ -2,20 +2,38 @@
 pipeline.py
 
 Основной пайплайн для структурирования метаданных медицинских чанков.
+
+Инкрементальный запуск (python -m med_index.pipeline): по манифесту отпечатков страниц перечитываются
+только изменённые файлы, LLM-обогащение — только для чанков с новым текстом, а индекс чанков
+(CHUNKS_INDEX_DIR, id узла = id_ чанка) обновляется sync_index: удаляются устаревшие узлы, эмбеддинги
+считаются только для новых.
 """
 
-from typing import List, Dict, Any
+import os
+import glob
+import shutil
+from fnmatch import fnmatch
+from typing import List, Dict, Any, Optional, Set, Tuple
 import uuid
 
 from llama_index.core import SimpleDirectoryReader
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.readers.file import PDFReader
 
-from settings import MED_SOURCE_DIR
+from settings import MED_SOURCE_DIR, CHUNKS_INDEX_DIR
 
 from med_index.extraction.disease import extract_diseases
 from med_index.extraction.section_titles import extract_section_titles, get_active_section_titles
 from med_index.extraction.summary import extract_chunk_summary
+from med_index.markdown_chunker import chunk_markdown
+from med_index.disease_index import DiseaseIndex, chunk_to_node
+from toolkit.pdf_preprocessing.running_elements import strip_running_lines
+from utils.page_manifest import PageManifest
+
+LEVELS_SUFFIX = "_heading_levels.json"
+SPANS_SUFFIX = "_spans.json"
+# Поля, которые получает чанк на шаге LLM-обогащения (переносятся при инкрементальной переобработке)
+ENRICHED_FIELDS = ("id_", "diseases", "chunk_summary", "section_titles")
 
 
 def generate_chunk_id() -> str:
@@ -23,6 +41,23 @@ def generate_chunk_id() -> str:
     return str(uuid.uuid4())
 
 
+def strip_running_text(docs: List[Any]) -> List[Any]:
+    """
+    Убирает из постраничных документов PDFReader колонтитулы, номера страниц и водяные знаки
+    (строки, повторяющиеся на одних и тех же местах страниц одного файла).
+    """
+    by_file: Dict[str, List[Any]] = {}
+    for doc in docs:
+        by_file.setdefault(doc.metadata.get("file_name", ""), []).append(doc)
+    for file_name, file_docs in by_file.items():
+        stripped, report = strip_running_lines({i: doc.text for i, doc in enumerate(file_docs)})
+        for i, doc in enumerate(file_docs):
+            doc.set_content(stripped[i])
+        if report["tokens_removed"]:
+            print(f"[pipeline] {file_name}: колонтитулы/номера страниц — {report['tokens_removed_pct']}% токенов")
+    return docs
+
+
 def chunk_documents(docs: List[Any], chunk_size: int = 1024, chunk_overlap: int = 100) -> List[Dict[str, Any]]:
     """
     Sentence-aware разбиение документов на чанки.
@@ -43,22 +78,251 @@ def chunk_documents(docs: List[Any], chunk_size: int = 1024, chunk_overlap: int
     return all_chunks
 
 
+def levels_path_for(pdf_path: str) -> str:
+    """Путь к levels JSON (уровни стилей заголовков) рядом с PDF: <имя>_heading_levels.json."""
+    return os.path.splitext(pdf_path)[0] + LEVELS_SUFFIX
+
+
+def build_outline_levels(
+        pdf_path: str,
+        levels_path: Optional[str] = None,
+        levels: int = 3,
+        changed_pages: Optional[Set[int]] = None,
+        page_count: Optional[int] = None,
+) -> bool:
+    """
+    levels JSON по встроенному оглавлению PDF (detect_heading_levels без LLM-заголовков): если оглавление
+    хорошо ложится на текст, уровни сохраняются в levels_path и PDF идёт в markdown-путь без LLM.
+
+    Сырые спаны кэшируются рядом с PDF (<имя>_spans.json); при известных changed_pages заново извлекаются
+    только они (refresh_spans). Совпавшие с прежними уровни не перезаписываются — кэш markdown
+    (ключ — хэш levels JSON) остаётся действительным.
+
+    :param changed_pages: изменённые страницы (PageManifest.diff); None — извлечь все
+    :param page_count: число страниц новой версии PDF
+    :return: True, если levels JSON построен по оглавлению
+    """
+    from toolkit.pdf_preprocessing.outline_headings import detect_heading_levels, read_outline
+    from toolkit.pdf_preprocessing.running_elements import strip_running_spans
+    from toolkit.pdf_preprocessing.span_creator import extract_spans, refresh_spans
+    from utils.general import load_json, save_json
+
+    if not read_outline(pdf_path):
+        return False
+    spans_path = os.path.splitext(pdf_path)[0] + SPANS_SUFFIX
+    cached = load_json(spans_path) if changed_pages is not None and os.path.isfile(spans_path) else None
+    if cached is not None:
+        raw_spans = refresh_spans(pdf_path, cached, changed_pages, page_count, profile="fast")
+    else:
+        raw_spans = extract_spans(pdf_path, profile="fast")
+    save_json(raw_spans, spans_path)
+
+    spans, _ = strip_running_spans(raw_spans)
+    levels_dict, _, source = detect_heading_levels(pdf_path, spans, levels=levels)
+    if source != "outline":
+        return False
+    levels_path = levels_path or levels_path_for(pdf_path)
+    previous = load_json(levels_path) if os.path.isfile(levels_path) else None
+    if previous and previous.get("levels") == levels_dict["levels"]:
+        return True
+    print(f"[pipeline] {os.path.basename(pdf_path)}: уровни заголовков по оглавлению "
+          f"(покрытие {levels_dict['meta']['coverage']:.0%})")
+    return save_json(levels_dict, levels_path)
+
+
+def _levels_source(levels_path: str) -> Optional[str]:
+    """Источник levels JSON: "outline" — построен build_outline_levels, иначе None."""
+    from utils.general import load_json
+
+    data = load_json(levels_path) if os.path.isfile(levels_path) else None
+    return ((data or {}).get("meta") or {}).get("source")
+
+
+def _chunks_by_file(chunks: Optional[List[Dict[str, Any]]]) -> Dict[str, List[Dict[str, Any]]]:
+    by_file: Dict[str, List[Dict[str, Any]]] = {}
+    for chunk in chunks or []:
+        by_file.setdefault(chunk.get("file_name", ""), []).append(chunk)
+    return by_file
+
+
+def chunk_markdown_sources(
+        source_dir: str,
+        chunk_size: int = 1024,
+        chunk_overlap: int = 100,
+        manifest: Optional[PageManifest] = None,
+        previous_chunks: Optional[List[Dict[str, Any]]] = None,
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Чанки по заголовкам для PDF, у которых есть levels JSON: PDF -> markdown (HeaderDetector) -> разделы.
+    Если levels JSON нет, он строится по оглавлению PDF (build_outline_levels).
+
+    С манифестом отпечатков страниц файл без изменённых страниц не перечитывается — берутся его чанки
+    из previous_chunks; у изменённого файла markdown заново строится только для изменённых страниц
+    (кэш markdown ключуется отпечатком страницы), уровни по оглавлению — по спанам изменённых страниц.
+    Отпечатки — по content stream (mode="content"): заголовки зависят от оформления, и правка только
+    стиля страницы тоже считается изменением.
+    Манифест обновляется, но не сохраняется.
+
+    :return: (чанки, пути обработанных PDF); PDF без levels JSON и без пригодного оглавления пропускаются —
+             их чанкит chunk_documents
+    """
+    from toolkit.md_processing.markdown_converter import convert_pdf_to_markdown_pages
+    from utils.page_manifest import page_fingerprints
+
+    previous_by_file = _chunks_by_file(previous_chunks)
+    chunks: List[Dict[str, Any]] = []
+    converted: List[str] = []
+    for pdf_path in sorted(glob.glob(os.path.join(source_dir, "*.pdf"))):
+        levels_path = levels_path_for(pdf_path)
+        new_levels = not os.path.isfile(levels_path)
+        if new_levels and not build_outline_levels(pdf_path, levels_path):
+            continue
+        file_name = os.path.basename(pdf_path)
+        converted.append(pdf_path)
+        if manifest is not None:
+            fingerprints, changed = manifest.diff(pdf_path, mode="content")
+            manifest.update(pdf_path, fingerprints, mode="content")
+            # новые уровни — прежние чанки файла получены другим путём (PDFReader), их не переиспользуем
+            if not changed and not new_levels and file_name in previous_by_file:
+                chunks.extend(dict(chunk) for chunk in previous_by_file[file_name])
+                continue
+            print(f"[pipeline] {file_name}: изменено страниц {len(changed)} из {len(fingerprints)}")
+            if changed and not new_levels and _levels_source(levels_path) == "outline":
+                build_outline_levels(pdf_path, levels_path, changed_pages=changed, page_count=len(fingerprints))
+        else:
+            fingerprints = page_fingerprints(pdf_path, mode="content")
+        pages = convert_pdf_to_markdown_pages(pdf_path, levels_path, fingerprints=fingerprints)
+        pages, report = strip_running_lines(pages)
+        print(f"[pipeline] {file_name}: колонтитулы/номера страниц — {report['tokens_removed_pct']}% токенов")
+        chunks.extend(chunk_markdown(pages, file_name, chunk_size=chunk_size,
+                                     chunk_overlap=chunk_overlap, start_index=len(chunks)))
+    return chunks, converted
+
+
+def reuse_enrichment(chunks: List[Dict[str, Any]], previous_chunks: List[Dict[str, Any]]) -> int:
+    """
+    Переносит id_ и LLM-метаданные (diseases, chunk_summary, section_titles) с чанков прошлого прогона
+    на чанки с тем же файлом и текстом — их не нужно обогащать заново, а узлы индекса остаются прежними.
+
+    :return: сколько чанков переиспользовано
+    """
+    previous = {(c.get("file_name", ""), c["text"]): c for c in previous_chunks if "id_" in c}
+    reused = 0
+    for chunk in chunks:
+        old = previous.pop((chunk.get("file_name", ""), chunk["text"]), None)
+        if old is None:
+            continue
+        for key in ENRICHED_FIELDS:
+            if key in old:
+                chunk[key] = old[key]
+        reused += 1
+    return reused
+
+
+def diff_chunk_ids(
+        previous_chunks: List[Dict[str, Any]],
+        chunks: List[Dict[str, Any]],
+) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """
+    :return: (id_ устаревших чанков прошлого прогона, новые чанки) — что удалить из индекса и что вставить
+    """
+    current_ids = {chunk["id_"] for chunk in chunks}
+    previous_ids = {chunk["id_"] for chunk in previous_chunks if "id_" in chunk}
+    stale = [chunk["id_"] for chunk in previous_chunks if chunk.get("id_") not in current_ids]
+    fresh = [chunk for chunk in chunks if chunk["id_"] not in previous_ids]
+    return stale, fresh
+
+
+def sync_index(
+        index: Any,
+        previous_chunks: List[Dict[str, Any]],
+        chunks: List[Dict[str, Any]],
+        embed_model: Any = None,
+        bm25: Any = None,
+) -> Tuple[int, int]:
+    """
+    Заменяет в llama-index индексе узлы устаревших чанков узлами новых (id_ чанка = id узла);
+    эмбеддинги нужны только новым чанкам.
+
+    :param embed_model: LocalSTEmbedding — новые узлы кодируются одним проходом (embed_nodes)
+    :param bm25: BM25-индекс той же директории, обновляется теми же удалениями и вставками
+    :return: (удалено узлов, вставлено узлов)
+    """
+    stale, fresh = diff_chunk_ids(previous_chunks, chunks)
+    if stale:
+        index.delete_nodes(stale, delete_from_docstore=True)
+        if bm25 is not None:
+            bm25.delete_nodes(stale)
+    if fresh:
+        nodes = [chunk_to_node(chunk) for chunk in fresh]
+        if embed_model is not None:
+            from utils.local_embedding import embed_nodes
+            embed_nodes(nodes, embed_model)
+        index.insert_nodes(nodes)
+        if bm25 is not None:
+            bm25.add(nodes)
+    return len(stale), len(fresh)
+
+
+def update_chunks_index(
+        previous_chunks: Optional[List[Dict[str, Any]]],
+        chunks: List[Dict[str, Any]],
+        persist_dir: str = CHUNKS_INDEX_DIR,
+) -> Tuple[int, int]:
+    """
+    Приводит сохранённый индекс чанков к результату прогона через sync_index. Индекса нет или он построен
+    другой моделью эмбеддингов (embedding.json) — строится заново из всех чанков.
+
+    :return: (удалено узлов, вставлено узлов)
+    """
+    from llama_index.core import Settings, VectorStoreIndex
+    from utils.bm25_index import BM25Index
+    from utils.mmap_vector_store import get_storage_context, load_index
+    from utils.embedding_signature import read_index_embedding, same_embedding, write_index_embedding
+    from utils.local_embedding import configure_embeddings, embedding_signature
+
+    Settings.llm = None
+    embed_model = configure_embeddings()
+    signature = embedding_signature(embed_model)
+    exists = os.path.isfile(os.path.join(persist_dir, "docstore.json"))
+    if exists and same_embedding(read_index_embedding(persist_dir), signature):
+        index = load_index(persist_dir)
+    else:
+        shutil.rmtree(persist_dir, ignore_errors=True)
+        index = VectorStoreIndex([], storage_context=get_storage_context(persist_dir))
+        previous_chunks = []  # новый индекс — вставляются все чанки
+    bm25 = BM25Index.from_persist_dir(persist_dir)
+    try:
+        removed, added = sync_index(index, previous_chunks or [], chunks, embed_model=embed_model, bm25=bm25)
+    finally:
+        bm25.close()
+    index.storage_context.persist(persist_dir=persist_dir)
+    write_index_embedding(persist_dir, signature)
+    return removed, added
+
+
 def enrich_chunks_with_metadata(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
     Обогащает каждый чанк метаданными: diseases, chunk_summary, section_titles.
+    Чанки с уже известными section_titles (из заголовков markdown) повторно их не извлекают;
+    чанки, уже имеющие id_ (переиспользованные из прошлого прогона), пропускаются.
     """
-    # Сначала — собрать все section titles по документу (регэксп/LLM, см. extraction/section_titles.py)
-    full_text = " ".join(chunk["text"] for chunk in chunks)
-    all_section_titles = extract_section_titles(full_text)
+    # Сначала — собрать все section titles по документу (регэксп/LLM, см. extraction/section_titles.py),
+    # но только по чанкам без заголовков
+    untitled = [chunk for chunk in chunks if "section_titles" not in chunk]
+    all_section_titles = extract_section_titles(" ".join(chunk["text"] for chunk in untitled)) if untitled else {}
 
     for chunk in chunks:
+        if "id_" in chunk:
+            continue
         chunk["id_"] = generate_chunk_id()
         # Diseases extraction (через LLM)
         chunk["diseases"] = extract_diseases(chunk["text"])
         # Chunk summary (через LLM)
         chunk["chunk_summary"] = extract_chunk_summary(chunk["text"])
         # Section titles (по тексту чанка и ближайшим сверху по документу)
-        chunk["section_titles"] = get_active_section_titles(chunk["text"], all_section_titles)
+        if "section_titles" not in chunk:
+            chunk["section_titles"] = get_active_section_titles(chunk["text"], all_section_titles)
     return chunks
 
 
@@ -87,20 +351,62 @@ def link_chunks_by_disease(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]
     return chunks
 
 
-def pipeline() -> List[Dict[str, Any]]:
+def pipeline(
+        use_markdown: bool = True,
+        source_dir: Optional[str] = None,
+        previous_chunks: Optional[List[Dict[str, Any]]] = None,
+        manifest: Optional[PageManifest] = None,
+) -> List[Dict[str, Any]]:
     """
     Основной orchestrator: читает документы, разбивает на чанки, обогащает метаданными и строит связи.
+
+    Инкрементальный режим (previous_chunks — результат прошлого прогона, manifest — отпечатки страниц):
+    переделываются только изменённые страницы, а LLM-обогащение — только для чанков с новым текстом.
+
+    :param use_markdown: PDF с levels JSON чанкуются по заголовкам markdown (section_titles известны заранее)
+    :param source_dir: папка с документами (по умолчанию MED_SOURCE_DIR)
+    :param previous_chunks: чанки прошлого прогона (с id_ и метаданными)
+    :param manifest: манифест постраничных отпечатков (обновляется; сохраняет вызывающий). Удалённые файлы
+                     из него убираются
     """
-    # 1. Считываем документы из папки (PDF поддержка!)
-    docs = SimpleDirectoryReader(
-        input_dir=MED_SOURCE_DIR,
-        file_extractor={".pdf": PDFReader()}
-    ).load_data()
+    source_dir = source_dir or MED_SOURCE_DIR
+
+    # 1-2. PDF с уровнями заголовков — markdown-чанки по разделам (section titles известны заранее)
+    chunks: List[Dict[str, Any]] = []
+    converted: List[str] = []
+    if use_markdown:
+        chunks, converted = chunk_markdown_sources(source_dir, manifest=manifest, previous_chunks=previous_chunks)
 
-    # 2. Разбиваем на чанки (sentence-aware)
-    chunks = chunk_documents(docs)
+    # Остальные документы — PDFReader + sentence-aware разбиение; PDF без изменённых страниц не перечитываются
+    exclude = ["*" + LEVELS_SUFFIX, "*" + SPANS_SUFFIX] + [os.path.basename(p) for p in converted]
+    rest = sorted(f for f in os.listdir(source_dir)
+                  if not f.startswith(".") and os.path.isfile(os.path.join(source_dir, f))
+                  and not any(fnmatch(f, pat) for pat in exclude))
+    previous_by_file = _chunks_by_file(previous_chunks)
+    to_read: List[str] = []
+    for file_name in rest:
+        path = os.path.join(source_dir, file_name)
+        if manifest is not None and file_name.lower().endswith(".pdf"):
+            fingerprints, changed = manifest.diff(path)
+            manifest.update(path, fingerprints)
+            if not changed and file_name in previous_by_file:
+                chunks.extend(dict(chunk) for chunk in previous_by_file[file_name])
+                continue
+        to_read.append(path)
+    if to_read:
+        docs = SimpleDirectoryReader(input_files=to_read, file_extractor={".pdf": PDFReader()}).load_data()
+        chunks.extend(chunk_documents(strip_running_text(docs)))
+    if manifest is not None:
+        for file_name in manifest.removed_files(converted + rest):
+            manifest.forget(file_name)
 
-    # 3. Извлекаем diseases, section_titles, chunk_summary (через LLM/prompts)
+    for index, chunk in enumerate(chunks):
+        chunk["chunk_index"] = index
+
+    # 3. Извлекаем diseases, section_titles, chunk_summary (через LLM/prompts) — кроме неизменившихся чанков
+    if previous_chunks:
+        reused = reuse_enrichment(chunks, previous_chunks)
+        print(f"[pipeline] Переиспользовано чанков: {reused} из {len(chunks)}")
     chunks = enrich_chunks_with_metadata(chunks)
 
     # 4. Строим связи по disease (linked_diagnoses)
@@ -112,8 +418,24 @@ def pipeline() -> List[Dict[str, Any]]:
 
 if __name__ == "__main__":
     import json
-    all_chunks = pipeline()
-    # Для примера — сохраняем в файл
-    with open("med_chunks.json", "w", encoding="utf-8") as f:
+    from utils.general import load_json
+    from settings import PAGE_MANIFEST_PATH, DISEASE_INDEX_PATH, DISEASE_SYNONYMS_PATH, MED_CHUNKS_PATH
+
+    prev_chunks = None
+    if os.path.isfile(MED_CHUNKS_PATH):
+        with open(MED_CHUNKS_PATH, "r", encoding="utf-8") as f:
+            prev_chunks = json.load(f)
+    page_manifest = PageManifest.load(PAGE_MANIFEST_PATH)
+
+    all_chunks = pipeline(previous_chunks=prev_chunks, manifest=page_manifest)
+    # индекс чанков обновляется до сохранения: при сбое следующий прогон повторит тот же diff
+    removed_, added_ = update_chunks_index(prev_chunks, all_chunks)
+    with open(MED_CHUNKS_PATH, "w", encoding="utf-8") as f:
         json.dump(all_chunks, f, ensure_ascii=False, indent=2)
-    print(f"Total chunks processed: {len(all_chunks)}")
+    page_manifest.save()
+    synonyms = load_json(DISEASE_SYNONYMS_PATH) if os.path.isfile(DISEASE_SYNONYMS_PATH) else None
+    disease_index = DiseaseIndex.build(all_chunks, synonyms)
+    disease_index.save(DISEASE_INDEX_PATH)
+    print(f"Индекс заболеваний: {len(disease_index)} ключей -> {DISEASE_INDEX_PATH}")
+    print(f"Total chunks processed: {len(all_chunks)} (в индексе {CHUNKS_INDEX_DIR}: "
+          f"вставлено {added_}, удалено {removed_})")
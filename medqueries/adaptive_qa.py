@@ -0,0 +1,342 @@
+"""
+adaptive_qa.py
+
+QA по индексу с адаптивной стратегией объединения документов вместо фиксированного map_reduce.
+
+1. Retriever отдаёт до similarity_top_k чанков со score; чанки ниже similarity_cutoff отбрасываются
+   (k уменьшается динамически, но остаётся не меньше min_k).
+2. Токены чанков считаются токенизатором модели (если он недоступен — приближённо). Чанк длиннее бюджета
+   контекста (окно модели минус промпт, вопрос и ответ) режется на части по бюджету; чанки и части
+   упаковываются в группы, каждая из которых укладывается в бюджет.
+3. Одна группа — один вызов LLM ("stuff"). Несколько групп — map по группам параллельно (не больше
+   map_concurrency одновременно), затем reduce выдержек одним вызовом.
+
+invoke — синхронно (map в пуле потоков), ainvoke — полностью асинхронно (aretrieve, llm.ainvoke),
+для сервиса запросов (medqueries/query_service.py).
+
+Интерфейс совместим с RetrievalQA: invoke({"query": ...}) -> {"query", "result", "source_documents", ...}.
+
+Пример:
+    qa = AdaptiveQA.from_index(loaded_index, similarity_top_k=7)
+    result = qa.invoke({"query": "What are the symptoms of measles?"})
+    print(result["result"], result["strategy"], result["llm_calls"])
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from langchain.schema import Document
+
+from settings import (default_llm, LLM_CONTEXT_WINDOW, LLM_TOKENIZER, QA_MAX_ANSWER_TOKENS, QA_SIMILARITY_CUTOFF,
+                      QA_MAP_CONCURRENCY)
+
+STUFF_PROMPT = (
+    "Use the following pieces of context to answer the question at the end. "
+    "If you don't know the answer, just say that you don't know, don't try to make up an answer.\n\n"
+    "{context}\n\nQuestion: {question}\nHelpful Answer:"
+)
+MAP_PROMPT = (
+    "Use the following portion of a long document to see if any of the text is relevant to answer the question. "
+    "Return any relevant text verbatim.\n{context}\nQuestion: {question}\nRelevant text, if any:"
+)
+REDUCE_PROMPT = (
+    "Given the following extracted parts of a long document and a question, create a final answer. "
+    "If you don't know the answer, just say that you don't know. Don't try to make up an answer.\n\n"
+    "QUESTION: {question}\n=========\n{context}\n=========\nFINAL ANSWER:"
+)
+DOC_SEPARATOR = "\n\n"
+
+
+CHARS_PER_TOKEN = 3  # оценка без токенизатора (с запасом: медицинские термины дробятся на короткие токены)
+
+
+def _chars_tokens_counter(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def _approximate_counter() -> Callable[[str], int]:
+    """tiktoken (cl100k_base); если он недоступен (нет пакета или файла кодировки офлайн) — оценка по символам."""
+    try:
+        from utils.tokenizer_counter import approximate_tokens_counter
+        approximate_tokens_counter("probe")
+        return approximate_tokens_counter
+    except Exception as e:
+        print(f"tiktoken недоступен ({e}), токены оцениваются по числу символов")
+        return _chars_tokens_counter
+
+
+@lru_cache(maxsize=1)
+def default_tokens_counter() -> Callable[[str], int]:
+    """
+    Счётчик токенов модели (Llama3TokenizerCounter по settings.LLM_TOKENIZER); если токенизатор
+    недоступен (нет transformers, сети или доступа к репозиторию HF) — приближённый подсчёт.
+    Ошибка токенизатора при подсчёте тоже переключает на приближённый подсчёт, а не роняет цепочку.
+    """
+    try:
+        from utils.tokenizer_counter import Llama3TokenizerCounter
+
+        counter = Llama3TokenizerCounter(LLM_TOKENIZER)
+        counter._load_tokenizer()
+    except Exception as e:
+        print(f"Токенизатор {LLM_TOKENIZER} недоступен ({e}), используется приближённый подсчёт")
+        approximate = _approximate_counter()
+        return lambda text: approximate(text) if text.strip() else 0
+
+    fallback: List[Callable[[str], int]] = []
+
+    def count(text: str) -> int:
+        if not text.strip():
+            return 0
+        if not fallback:
+            try:
+                return counter.count_tokens(text)
+            except Exception as e:
+                print(f"Ошибка токенизатора {LLM_TOKENIZER} ({e}), используется приближённый подсчёт")
+                fallback.append(_approximate_counter())
+        return fallback[0](text)
+
+    return count
+
+
+def _message_text(message: Any) -> str:
+    return message.content if hasattr(message, "content") else str(message)
+
+
+class AdaptiveQA:
+    """
+    Адаптивная QA-цепочка: "stuff", если найденный контекст помещается в бюджет, иначе параллельный map + reduce.
+    """
+
+    def __init__(
+            self,
+            retriever: Any,
+            llm: Any = default_llm,
+            *,
+            tokens_counter: Optional[Callable[[str], int]] = None,
+            context_window: int = LLM_CONTEXT_WINDOW,
+            max_answer_tokens: int = QA_MAX_ANSWER_TOKENS,
+            similarity_cutoff: Optional[float] = QA_SIMILARITY_CUTOFF,
+            min_k: int = 1,
+            map_concurrency: int = QA_MAP_CONCURRENCY,
+            verbose: bool = False,
+    ) -> None:
+        """
+        :param retriever: retriever llama-index (retrieve/aretrieve -> NodeWithScore)
+        :param llm: LangChain LLM (invoke/ainvoke)
+        :param tokens_counter: счётчик токенов модели (по умолчанию default_tokens_counter())
+        :param context_window: контекстное окно модели, токены
+        :param max_answer_tokens: резерв окна под ответ
+        :param similarity_cutoff: чанки с score ниже отбрасываются (None — без отсечения)
+        :param min_k: сколько лучших чанков оставлять даже ниже порога
+        :param map_concurrency: сколько map-вызовов выполнять одновременно
+        :param verbose: печатать выбранную стратегию
+        """
+        self.retriever = retriever
+        self.llm = llm
+        self.tokens_counter = tokens_counter
+        self.context_window = int(context_window)
+        self.max_answer_tokens = int(max_answer_tokens)
+        self.similarity_cutoff = similarity_cutoff
+        self.min_k = max(0, int(min_k))
+        self.map_concurrency = max(1, int(map_concurrency))
+        self.verbose = verbose
+
+    @classmethod
+    def from_index(cls, loaded_index: Any, similarity_top_k: int = 7, **kwargs: Any) -> "AdaptiveQA":
+        return cls(loaded_index.as_retriever(similarity_top_k=similarity_top_k), **kwargs)
+
+    def _count(self, text: str) -> int:
+        if self.tokens_counter is None:
+            self.tokens_counter = default_tokens_counter()
+        return self.tokens_counter(text)
+
+    # ───────────────────────────── планирование ─────────────────────────────
+
+    def select_nodes(self, nodes: List[Any]) -> List[Any]:
+        """
+        Чанки в порядке retriever'а (по релевантности) без чанков со score ниже similarity_cutoff
+        (но не меньше min_k). Чанки без score (найденные только BM25) не отсекаются.
+        """
+        if self.similarity_cutoff is None:
+            return list(nodes)
+        kept = [n for n in nodes if n.score is None or n.score >= self.similarity_cutoff]
+        return kept if len(kept) >= self.min_k else nodes[:self.min_k]
+
+    def budget(self, question: str) -> int:
+        """Токенов контекста на один вызов: окно минус самый длинный шаблон с вопросом и резерв под ответ."""
+        overhead = max(self._count(STUFF_PROMPT.format(context="", question=question)),
+                       self._count(MAP_PROMPT.format(context="", question=question)))
+        return max(1, self.context_window - self.max_answer_tokens - overhead)
+
+    def split(self, text: str, budget: int) -> List[str]:
+        """
+        Текст, разрезанный на части не больше budget токенов (по пробелам, если они есть); текст
+        в пределах бюджета — одной частью.
+        """
+        pieces: List[str] = []
+        rest = text
+        while rest:
+            tokens = self._count(rest)
+            if tokens <= budget:
+                pieces.append(rest)
+                break
+            cut = max(1, int(len(rest) * budget / tokens * 0.9))
+            space = rest.rfind(" ", 0, cut + 1)
+            if space > cut // 2:
+                cut = space
+            while cut > 1 and self._count(rest[:cut]) > budget:
+                cut = max(1, int(cut * 0.8))
+            piece = rest[:cut].strip()
+            if piece:
+                pieces.append(piece)
+            rest = rest[cut:].lstrip()
+        return pieces
+
+    def pack(self, token_counts: List[int], budget: int) -> List[List[int]]:
+        """
+        Жадная упаковка текстов (в порядке релевантности) в группы не больше budget токенов.
+        Текст длиннее бюджета образует отдельную группу (plan заранее режет такие тексты split'ом).
+
+        :param token_counts: число токенов каждого текста
+        :return: индексы текстов по группам
+        """
+        groups: List[List[int]] = []
+        used = 0
+        sep = self._count(DOC_SEPARATOR)
+        for i, tokens in enumerate(token_counts):
+            if groups and used + sep + tokens <= budget:
+                groups[-1].append(i)
+                used += sep + tokens
+            else:
+                groups.append([i])
+                used = tokens
+        return groups
+
+    def plan(self, question: str, nodes: List[Any]) -> Tuple[List[Any], List[str], int]:
+        """
+        Выбранные чанки, тексты контекстов (один — "stuff", несколько — map по ним) и сумма токенов чанков.
+        Чанк длиннее бюджета режется на части (split), каждая идёт в свою группу — окно модели не переполняется.
+        """
+        selected = self.select_nodes(nodes)
+        budget = self.budget(question)
+        texts: List[str] = []
+        token_counts: List[int] = []
+        for node in selected:
+            text = node.node.get_content()
+            tokens = self._count(text)
+            if tokens <= budget:
+                texts.append(text)
+                token_counts.append(tokens)
+                continue
+            for piece in self.split(text, budget):
+                texts.append(piece)
+                token_counts.append(self._count(piece))
+        groups = self.pack(token_counts, budget)
+        return selected, [DOC_SEPARATOR.join(texts[i] for i in group) for group in groups], sum(token_counts)
+
+    def _reduce_context(self, question: str, extracts: List[str]) -> str:
+        """Выдержки map-шага, которые помещаются в бюджет reduce-вызова (в порядке релевантности)."""
+        budget = max(1, self.context_window - self.max_answer_tokens
+                     - self._count(REDUCE_PROMPT.format(context="", question=question)))
+        kept: List[str] = []
+        used = 0
+        for text in extracts:
+            tokens = self._count(text)
+            if kept and used + tokens > budget:
+                break
+            kept.append(text)
+            used += tokens
+        return DOC_SEPARATOR.join(kept)
+
+    @staticmethod
+    def _documents(nodes: List[Any]) -> List[Document]:
+        return [Document(page_content=n.node.get_content(), metadata=dict(n.node.metadata or {})) for n in nodes]
+
+    def _result(self, question: str, answer: str, selected: List[Any], contexts: List[str], context_tokens: int,
+                strategy: str, llm_calls: int) -> Dict[str, Any]:
+        if self.verbose:
+            print(f"[AdaptiveQA] {strategy}: k={len(selected)}, токенов контекста={context_tokens}, "
+                  f"групп={len(contexts)}, вызовов LLM={llm_calls}")
+        return {
+            "query": question,
+            "result": answer,
+            "source_documents": self._documents(selected),
+            "strategy": strategy,
+            "k": len(selected),
+            "context_tokens": context_tokens,
+            "llm_calls": llm_calls,
+        }
+
+    # ───────────────────────────── выполнение ─────────────────────────────
+
+    def invoke(self, inputs: Dict[str, Any], **kwargs: Any) -> Dict[str, Any]:
+        question = inputs["query"]
+        selected, contexts, tokens = self.plan(question, self.retriever.retrieve(question))
+        if len(contexts) <= 1:
+            context = contexts[0] if contexts else ""
+            answer = _message_text(self.llm.invoke(STUFF_PROMPT.format(context=context, question=question)))
+            return self._result(question, answer, selected, contexts, tokens, "stuff", 1)
+
+        with ThreadPoolExecutor(max_workers=min(self.map_concurrency, len(contexts))) as executor:
+            extracts = list(executor.map(
+                lambda ctx: _message_text(self.llm.invoke(MAP_PROMPT.format(context=ctx, question=question))),
+                contexts,
+            ))
+        context = self._reduce_context(question, [e for e in extracts if e.strip()])
+        answer = _message_text(self.llm.invoke(REDUCE_PROMPT.format(context=context, question=question)))
+        return self._result(question, answer, selected, contexts, tokens, "map_reduce", len(contexts) + 1)
+
+    async def ainvoke(self, inputs: Dict[str, Any], **kwargs: Any) -> Dict[str, Any]:
+        """
+        Асинхронный invoke: retriever.aretrieve и llm.ainvoke; map-вызовы одного вопроса идут одновременно
+        (не больше map_concurrency, asyncio.Semaphore) и занимают параллельные слоты сервера LLM.
+        Отмена (таймаут сервиса) прерывает все незавершённые вызовы. Подсчёт токенов (plan, _reduce_context;
+        первый вызов ещё и загружает токенизатор) — в пуле потоков, чтобы не блокировать event loop.
+        """
+        question = inputs["query"]
+        nodes = await self.retriever.aretrieve(question)
+        selected, contexts, tokens = await asyncio.to_thread(self.plan, question, nodes)
+        if len(contexts) <= 1:
+            context = contexts[0] if contexts else ""
+            answer = _message_text(await self.llm.ainvoke(STUFF_PROMPT.format(context=context, question=question)))
+            return self._result(question, answer, selected, contexts, tokens, "stuff", 1)
+
+        semaphore = asyncio.Semaphore(self.map_concurrency)
+
+        async def map_one(ctx: str) -> str:
+            async with semaphore:
+                return _message_text(await self.llm.ainvoke(MAP_PROMPT.format(context=ctx, question=question)))
+
+        extracts = await asyncio.gather(*(map_one(ctx) for ctx in contexts))
+        context = await asyncio.to_thread(self._reduce_context, question, [e for e in extracts if e.strip()])
+        answer = _message_text(await self.llm.ainvoke(REDUCE_PROMPT.format(context=context, question=question)))
+        return self._result(question, answer, selected, contexts, tokens, "map_reduce", len(contexts) + 1)
+
+
+if __name__ == "__main__":
+    import statistics
+    from time import perf_counter
+    from settings import PERSISTED_INDEX_DIR
+    from utils.local_embedding import configure_embeddings
+    from utils.mmap_vector_store import load_index
+    from medqueries.med_query import build_qa_chain
+
+    QUESTIONS = [
+        "What are the symptoms of measles?",
+        "How is Cryptosporidiosis treated?",
+        "What is the incubation period of chickenpox?",
+        "When should a child with scarlet fever return to school?",
+        "What are the complications of mumps?",
+    ]
+    configure_embeddings()
+    index_ = load_index(PERSISTED_INDEX_DIR)
+    for label, qa_ in (("map_reduce", build_qa_chain(index_, adaptive=False, verbose=False)),
+                       ("adaptive", build_qa_chain(index_, adaptive=True, verbose=True))):
+        latencies = []
+        for q in QUESTIONS:
+            t1 = perf_counter()
+            qa_.invoke({"query": q})
+            latencies.append(perf_counter() - t1)
+        print(f"{label}: медиана {statistics.median(latencies):.2f} с, "
+              f"min {min(latencies):.2f} с, max {max(latencies):.2f} с")
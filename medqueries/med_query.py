@@ -12,36 +12,62 @@ med_query.py
 - utils.retriever_adapter с классом LlamaRetrieverForLangChain
 """
 
-from typing import Any
+from typing import Any, Union
 from time import perf_counter
 
-from llama_index.core import StorageContext, load_index_from_storage
 from langchain.chains import RetrievalQA
 
 from settings import PERSISTED_INDEX_DIR, default_llm
 from utils.retriever_adapter import LlamaRetrieverForLangChain
+from utils.hybrid_retriever import build_retriever
+from medqueries.adaptive_qa import AdaptiveQA
+from utils.local_embedding import configure_embeddings
+from utils.mmap_vector_store import load_index
+from utils.semantic_cache import cached_invoke, open_answer_cache
 from utils.formatting import format_time, display_quotes
 
 
-def main() -> None:
+def build_qa_chain(loaded_index: Any = None, similarity_top_k: int = 7, verbose: bool = True,
+                   adaptive: bool = True) -> Union[AdaptiveQA, RetrievalQA]:
     """
-    Главная функция. Загружает индекс, создает retriever и RetrievalQA-цепочку,
-    запускает интерактивный цикл вопросов-ответов с выводом источников и времени работы.
+    RetrievalQA-цепочка для вопросов по индексу.
+
+    Args:
+        loaded_index: уже загруженный индекс; если None — загружается из PERSISTED_INDEX_DIR.
+        similarity_top_k (int): сколько чанков отдаёт retriever (после слияния с BM25, если он включён).
+        verbose (bool): подробный вывод цепочки.
+        adaptive (bool): AdaptiveQA ("stuff" одним вызовом, если контекст помещается в окно модели,
+            иначе параллельный map + reduce); False — прежняя RetrievalQA map_reduce.
+
+    Returns:
+        Union[AdaptiveQA, RetrievalQA]: цепочка с возвратом источников (invoke({"query": ...})).
     """
-    # Загружаем индекс и создаём retriever
-    storage_context: StorageContext = StorageContext.from_defaults(persist_dir=PERSISTED_INDEX_DIR)
-    loaded_index = load_index_from_storage(storage_context)
-    llama_retriever = loaded_index.as_retriever(similarity_top_k=7)
+    if loaded_index is None:
+        # Загружаем индекс (запросы кодируются той же моделью, что и узлы при индексации)
+        configure_embeddings()
+        loaded_index = load_index(PERSISTED_INDEX_DIR)  # хранилище векторов — settings.VECTOR_STORE
+    llama_retriever = build_retriever(loaded_index, similarity_top_k)  # BM25 + вектор — settings.HYBRID_RETRIEVAL
+    if adaptive:
+        return AdaptiveQA(llama_retriever, default_llm, verbose=verbose)
     retriever = LlamaRetrieverForLangChain(llama_retriever=llama_retriever)
 
-    qa: RetrievalQA = RetrievalQA.from_chain_type(
+    return RetrievalQA.from_chain_type(
         llm=default_llm,
         chain_type="map_reduce",
         retriever=retriever,
         return_source_documents=True,
-        verbose=True
+        verbose=verbose
     )
 
+
+def main() -> None:
+    """
+    Главная функция. Загружает индекс, создает retriever и RetrievalQA-цепочку,
+    запускает интерактивный цикл вопросов-ответов с выводом источников и времени работы.
+    """
+    qa = build_qa_chain()
+    cache = open_answer_cache()
+
     print("Введите медицинский вопрос (пустая строка — выход):")
     while True:
         question: str = input("\nВопрос: ").strip()
@@ -50,13 +76,18 @@ def main() -> None:
             break
 
         t1 = perf_counter()
-        result: Any = qa.invoke({"query": question})
+        result: Any = cached_invoke(qa, question, cache)
         t2 = perf_counter()
 
         print("\nОтвет:\n", result["result"])
+        if "cache" in result:
+            print(f"\n(из кэша: «{result['cache']['cached_question']}», сходство {result['cache']['similarity']})")
         print(f"\nВремя ответа: {format_time(t2 - t1)}")
         display_quotes(result)
 
+    cache.save()
+    print(f"Кэш ответов: {cache.stats()}")
+
 
 if __name__ == "__main__":
     main()
@@ -5,7 +5,8 @@ med_query_chain.py
 с помощью индекса llama-index и локальной LLM через LangChain.
 
 Цепочка включает два шага:
-1. Поиск симптомов по диагнозу (через RetrievalQA).
+1. Поиск симптомов по диагнозу: чанки диагноза из индекса заболеваний (med_index/disease_index.py),
+   если диагноз в нём есть, иначе векторный поиск; ответ — QA-цепочка (AdaptiveQA).
 2. Классификация каждого найденного признака (симптом/анализ/медицинский показатель).
 
 Ввод диагнозов — в бесконечном цикле, выход по пустой строке.
@@ -18,34 +19,59 @@ med_query_chain.py
 - utils.retriever_adapter и utils.formatting
 """
 
-from typing import Any
+import os
+from typing import Any, Optional, Union
 from time import perf_counter
 
-from llama_index.core import StorageContext, load_index_from_storage
 from langchain.chains import RetrievalQA
-from settings import PERSISTED_INDEX_DIR, default_llm
+from settings import (PERSISTED_INDEX_DIR, DISEASE_INDEX_PATH, DISEASE_SYNONYMS_PATH, DISEASE_LOOKUP_MAX_CHUNKS,
+                      MED_CHUNKS_PATH, CHUNKS_INDEX_DIR, default_llm)
 from utils.retriever_adapter import LlamaRetrieverForLangChain
+from utils.hybrid_retriever import build_retriever
+from medqueries.adaptive_qa import AdaptiveQA
+from med_index.disease_index import DiseaseIndex, DiseaseIndexRetriever
+from utils.local_embedding import configure_embeddings
+from utils.mmap_vector_store import load_index
+from utils.semantic_cache import SemanticAnswerCache, cached_invoke, open_answer_cache
 from utils.formatting import format_time, display_quotes
+from utils.general import load_json
+
+
+def symptoms_question(diagnosis: str) -> str:
+    """Вопрос к RetrievalQA о симптомах диагноза."""
+    return f"What are the symptoms of {diagnosis}? Give out only numbered symptoms"
+
+
+def feature_types_prompt(diagnosis: str, featurelist: str) -> str:
+    """Промпт классификации признаков диагноза (симптом/анализ/медицинский показатель)."""
+    return (
+        f"Determine the type of {diagnosis} features, select for each of the feature from featurelist, "
+        f"is it a symptom, analysis or medical indicator. "
+        f"Give the answer in the form of a pair feature - type\n\n{featurelist}"
+    )
 
 
 def get_symptoms_for_diagnosis(
     diagnosis: str,
-    qa_chain: RetrievalQA,
-    verbose: bool = False
+    qa_chain: Union[AdaptiveQA, RetrievalQA],
+    verbose: bool = False,
+    cache: Optional[SemanticAnswerCache] = None
 ) -> str:
     """
     Получает список симптомов для заданного диагноза через RetrievalQA-цепочку.
 
     Args:
         diagnosis (str): Название диагноза.
-        qa_chain (RetrievalQA): RetrievalQA-цепочка для поиска.
+        qa_chain (Union[AdaptiveQA, RetrievalQA]): QA-цепочка для поиска (build_qa_chain).
         verbose (bool): Если True — выводит найденные источники.
+        cache (Optional[SemanticAnswerCache]): кэш ответов (область "symptoms", ключ — точный диагноз:
+            вопросы-шаблоны близких диагнозов семантически неразличимы).
 
     Returns:
         str: Список симптомов, найденный по диагнозу (обычно нумерованный).
     """
-    question = f"What are the symptoms of {diagnosis}? Give out only numbered symptoms"
-    result = qa_chain.invoke({"query": question})
+    question = symptoms_question(diagnosis)
+    result = cached_invoke(qa_chain, question, cache, scope="symptoms", key=diagnosis)
     print(f"\nСимптомы для диагноза '{diagnosis}':\n{result['result']}\n")
     if verbose:
         display_quotes(result)
@@ -68,17 +94,58 @@ def analyze_feature_types(
     Returns:
         str: Список пар "признак - тип" (в виде текста).
     """
-    prompt = (
-        f"Determine the type of {diagnosis} features, select for each of the feature from featurelist, "
-        f"is it a symptom, analysis or medical indicator. "
-        f"Give the answer in the form of a pair feature - type\n\n{featurelist}"
-    )
+    prompt = feature_types_prompt(diagnosis, featurelist)
     response = llm.invoke(prompt)
     text = response.content if hasattr(response, "content") else str(response)
     print(f"\nКлассификация признаков для '{diagnosis}':\n{text}\n")
     return text
 
 
+def build_qa_chain(loaded_index: Any = None, similarity_top_k: int = 3, verbose: bool = True,
+                   adaptive: bool = True, use_disease_index: bool = True) -> Union[AdaptiveQA, RetrievalQA]:
+    """
+    RetrievalQA-цепочка для поиска симптомов по диагнозу.
+
+    Args:
+        loaded_index: уже загруженный индекс; если None — загружается из PERSISTED_INDEX_DIR.
+        similarity_top_k (int): сколько чанков отдаёт retriever (после слияния с BM25, если он включён).
+        verbose (bool): подробный вывод цепочки.
+        adaptive (bool): AdaptiveQA ("stuff" одним вызовом, если контекст помещается в окно модели,
+            иначе параллельный map + reduce); False — прежняя RetrievalQA map_reduce.
+        use_disease_index (bool): чанки диагноза берутся из индекса заболеваний (DISEASE_INDEX_PATH)
+            напрямую, вместе со связанными (узлы — из индекса чанков CHUNKS_INDEX_DIR или из сохранённых
+            чанков MED_CHUNKS_PATH); векторный поиск — только если диагноз в нём не найден.
+
+    Returns:
+        Union[AdaptiveQA, RetrievalQA]: цепочка с возвратом источников (invoke({"query": ...})).
+    """
+    if loaded_index is None:
+        # Загружаем индекс (запросы кодируются той же моделью, что и узлы при индексации)
+        configure_embeddings()
+        loaded_index = load_index(PERSISTED_INDEX_DIR)  # хранилище векторов — settings.VECTOR_STORE
+    llama_retriever = build_retriever(loaded_index, similarity_top_k)  # BM25 + вектор — settings.HYBRID_RETRIEVAL
+    if use_disease_index:
+        disease_index = DiseaseIndex.load(DISEASE_INDEX_PATH, DISEASE_SYNONYMS_PATH)
+        if len(disease_index):
+            configure_embeddings()
+            chunks_index = load_index(CHUNKS_INDEX_DIR) if os.path.isdir(CHUNKS_INDEX_DIR) else None
+            chunks = load_json(MED_CHUNKS_PATH) if os.path.isfile(MED_CHUNKS_PATH) else None
+            llama_retriever = DiseaseIndexRetriever(chunks_index, disease_index, llama_retriever,
+                                                    max_chunks=DISEASE_LOOKUP_MAX_CHUNKS, chunks=chunks)
+    if adaptive:
+        return AdaptiveQA(llama_retriever, default_llm, verbose=verbose)
+    retriever = LlamaRetrieverForLangChain(llama_retriever=llama_retriever)
+
+    # Готовим RetrievalQA chain для поиска по медицинским источникам
+    return RetrievalQA.from_chain_type(
+        llm=default_llm,
+        chain_type="map_reduce",
+        retriever=retriever,
+        return_source_documents=True,
+        verbose=verbose
+    )
+
+
 def main() -> None:
     """
     Главная функция модуля.
@@ -90,31 +157,20 @@ def main() -> None:
     - Выводит время каждого этапа и общее время.
     - Завершает работу при вводе пустой строки.
     """
-    # Загружаем индекс и создаём retriever
-    storage_context: StorageContext = StorageContext.from_defaults(persist_dir=PERSISTED_INDEX_DIR)
-    loaded_index = load_index_from_storage(storage_context)
-    llama_retriever = loaded_index.as_retriever(similarity_top_k=3)
-    retriever = LlamaRetrieverForLangChain(llama_retriever=llama_retriever)
-
-    # Готовим RetrievalQA chain для поиска по медицинским источникам
-    qa: RetrievalQA = RetrievalQA.from_chain_type(
-        llm=default_llm,
-        chain_type="map_reduce",
-        retriever=retriever,
-        return_source_documents=True,
-        verbose=True
-    )
+    qa = build_qa_chain()
+    cache = open_answer_cache()
 
     print("Введите диагноз (пустая строка — выход):")
     while True:
         diagnosis: str = input("\nДиагноз: ").strip()
         if not diagnosis:
             print("Выход.")
+            cache.save()
             break
 
         # 1. Находим список симптомов по диагнозу, замер времени
         t1 = perf_counter()
-        symptom_list: str = get_symptoms_for_diagnosis(diagnosis, qa, verbose=True)
+        symptom_list: str = get_symptoms_for_diagnosis(diagnosis, qa, verbose=True, cache=cache)
         t2 = perf_counter()
         print(f"Время поиска симптомов: {format_time(t2 - t1)}")
 
@@ -0,0 +1,185 @@
+"""
+query_service.py
+
+Долгоживущий HTTP-сервис запросов к медицинскому индексу (aiohttp, asyncio).
+
+Индекс, retriever'ы и QA-цепочки создаются один раз при старте; клиент платит только
+за поиск и LLM. Цепочки выполняются полностью асинхронно (AdaptiveQA.ainvoke: aretrieve, llm.ainvoke),
+map-вызовы одного вопроса идут одновременно (settings.QA_MAP_CONCURRENCY) на параллельных слотах LLM. Эндпоинты повторяют интерактивные модули:
+- POST /query    {"question": "..."}                        — как med_query
+- POST /symptoms {"diagnosis": "...", "classify": true}     — как med_query_chain (симптомы + типы признаков)
+- GET  /health                                              — состояние и метрики семантического кэша
+
+Одновременно выполняется не больше max_concurrency цепочек (остальные ждут очереди), каждый шаг запроса
+вместе с ожиданием очереди ограничен timeout секундами (504 при превышении). По SIGINT/SIGTERM сервис
+перестаёт принимать соединения и дожидается текущих запросов (shutdown_timeout).
+
+Запуск:
+    python -m medqueries.query_service --port 8765
+    python -m medqueries.query_service --unix /tmp/med_query.sock
+    curl -s localhost:8765/query -d '{"question": "How is Cryptosporidiosis treated?"}'
+"""
+import asyncio
+import argparse
+from time import perf_counter
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+from settings import PERSISTED_INDEX_DIR, QUERY_SERVICE_HOST, QUERY_SERVICE_PORT, QUERY_TIMEOUT, default_llm
+from utils.semantic_cache import acached_invoke, open_answer_cache, serialize_sources
+
+STATE_KEY = web.AppKey("state", dict)
+
+
+def build_state(persist_dir: str = PERSISTED_INDEX_DIR, max_concurrency: int = 4,
+                timeout: float = QUERY_TIMEOUT, use_cache: bool = True) -> Dict[str, Any]:
+    """
+    Загружает индекс один раз и строит обе цепочки поверх него (и семантический кэш ответов, если use_cache).
+    Токенизатор AdaptiveQA загружается здесь же, а не первым запросом (офлайн загрузка с HF ждёт таймаута).
+    """
+    from utils.local_embedding import configure_embeddings
+    from utils.mmap_vector_store import load_index
+    from medqueries import med_query, med_query_chain
+    from medqueries.adaptive_qa import default_tokens_counter
+
+    configure_embeddings()
+    default_tokens_counter()
+    loaded_index = load_index(persist_dir)
+    return {
+        "index": loaded_index,
+        "qa": med_query.build_qa_chain(loaded_index, verbose=False),
+        "symptoms_qa": med_query_chain.build_qa_chain(loaded_index, verbose=False),
+        "llm": default_llm,
+        "cache": open_answer_cache(persist_dir) if use_cache else None,
+        "semaphore": asyncio.Semaphore(max(1, int(max_concurrency))),
+        "timeout": float(timeout),
+        "in_flight": 0,
+        "served": 0,
+    }
+
+
+async def _read_payload(request: web.Request, field: str) -> Dict[str, Any]:
+    """JSON тела запроса с обязательным непустым строковым полем field (400 иначе)."""
+    try:
+        payload = await request.json()
+    except Exception:
+        raise web.HTTPBadRequest(text='{"error": "ожидается JSON"}', content_type="application/json")
+    if not isinstance(payload, dict) or not str(payload.get(field, "") or "").strip():
+        raise web.HTTPBadRequest(text=f'{{"error": "пустое поле {field}"}}', content_type="application/json")
+    payload[field] = str(payload[field]).strip()
+    return payload
+
+
+async def _run(state: Dict[str, Any], coro: Any) -> Any:
+    """
+    Выполняет корутину цепочки под семафором. Таймаут запроса ограничивает и ожидание свободного слота,
+    и саму цепочку; served — число успешно выполненных шагов.
+    """
+    async def guarded() -> Any:
+        try:
+            async with state["semaphore"]:
+                return await coro
+        finally:
+            coro.close()  # таймаут в очереди — корутина так и не запускалась
+
+    state["in_flight"] += 1
+    try:
+        result = await asyncio.wait_for(guarded(), timeout=state["timeout"])
+    except asyncio.TimeoutError:
+        raise web.HTTPGatewayTimeout(text=f'{{"error": "превышено время ответа {state["timeout"]:.0f} с"}}',
+                                     content_type="application/json")
+    finally:
+        state["in_flight"] -= 1
+    state["served"] += 1
+    return result
+
+
+async def handle_query(request: web.Request) -> web.Response:
+    state = request.app[STATE_KEY]
+    question = (await _read_payload(request, "question"))["question"]
+    t1 = perf_counter()
+    result = await _run(state, acached_invoke(state["qa"], question, state["cache"], "query"))
+    return web.json_response({
+        "question": question,
+        "answer": result["result"],
+        "sources": serialize_sources(result.get("source_documents")),
+        "cache": result.get("cache"),
+        "elapsed": round(perf_counter() - t1, 3),
+    })
+
+
+async def handle_symptoms(request: web.Request) -> web.Response:
+    from medqueries.med_query_chain import symptoms_question, feature_types_prompt
+
+    state = request.app[STATE_KEY]
+    payload = await _read_payload(request, "diagnosis")
+    diagnosis = payload["diagnosis"]
+    t1 = perf_counter()
+    result = await _run(state, acached_invoke(state["symptoms_qa"], symptoms_question(diagnosis), state["cache"],
+                                              "symptoms", key=diagnosis))
+    response: Dict[str, Any] = {
+        "diagnosis": diagnosis,
+        "symptoms": result["result"],
+        "sources": serialize_sources(result.get("source_documents")),
+        "cache": result.get("cache"),
+    }
+    t2 = perf_counter()
+    if payload.get("classify", True):
+        answer = await _run(state, state["llm"].ainvoke(feature_types_prompt(diagnosis, result["result"])))
+        response["feature_types"] = answer.content if hasattr(answer, "content") else str(answer)
+        response["classify_elapsed"] = round(perf_counter() - t2, 3)
+    response["symptoms_elapsed"] = round(t2 - t1, 3)
+    return web.json_response(response)
+
+
+async def handle_health(request: web.Request) -> web.Response:
+    state = request.app[STATE_KEY]
+    cache = state["cache"]
+    return web.json_response({"status": "ok", "in_flight": state["in_flight"], "served": state["served"],
+                              "cache": cache.stats() if cache is not None else None})
+
+
+async def _save_cache(app: web.Application) -> None:
+    cache = app[STATE_KEY]["cache"]
+    if cache is not None:
+        cache.save()
+
+
+def create_app(state: Dict[str, Any]) -> web.Application:
+    app = web.Application()
+    app[STATE_KEY] = state
+    app.add_routes([
+        web.post("/query", handle_query),
+        web.post("/symptoms", handle_symptoms),
+        web.get("/health", handle_health),
+    ])
+    app.on_cleanup.append(_save_cache)
+    return app
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="HTTP-сервис запросов к медицинскому индексу")
+    parser.add_argument("--host", default=QUERY_SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=QUERY_SERVICE_PORT)
+    parser.add_argument("--unix", default=None, help="путь Unix-сокета (вместо host:port)")
+    parser.add_argument("--persist-dir", default=PERSISTED_INDEX_DIR)
+    parser.add_argument("--timeout", type=float, default=QUERY_TIMEOUT, help="таймаут запроса, с")
+    parser.add_argument("--max-concurrency", type=int, default=4, help="одновременно выполняемых цепочек")
+    parser.add_argument("--shutdown-timeout", type=float, default=30.0,
+                        help="сколько ждать текущие запросы при остановке, с")
+    parser.add_argument("--no-cache", action="store_true", help="без семантического кэша ответов")
+    args = parser.parse_args(argv)
+
+    t1 = perf_counter()
+    state = build_state(args.persist_dir, args.max_concurrency, args.timeout, use_cache=not args.no_cache)
+    print(f"Индекс и цепочки загружены за {perf_counter() - t1:.2f} с")
+    app = create_app(state)
+    if args.unix:
+        web.run_app(app, path=args.unix, shutdown_timeout=args.shutdown_timeout)
+    else:
+        web.run_app(app, host=args.host, port=args.port, shutdown_timeout=args.shutdown_timeout)
+
+
+if __name__ == "__main__":
+    main()
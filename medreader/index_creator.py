@@ -1,84 +1,287 @@
 # index_creator.py
+"""
+Инкрементальная индексация PDF из MED_SOURCE_DIR в VectorStoreIndex (PERSISTED_INDEX_DIR).
 
+Манифест хранит по каждому файлу (path, size, mtime, sha256) и id документов llama-index, созданных из него.
+Файл с теми же size и mtime считается неизменным без чтения; при расхождении считается sha256, и только
+новые или изменённые по содержимому файлы разбираются PDFReader'ом. Узлы удалённых и изменённых файлов
+удаляются из индекса (delete_ref_doc). Если ничего не изменилось, индекс не загружается и не сохраняется.
+BM25-индекс (utils/bm25_index.py, в той же директории) обновляется теми же удалениями и добавлениями.
+
+Манифест и директория индекса (embedding.json) хранят подпись модели эмбеддингов (backend, модель с учётом
+int8, размерность). Если текущая модель другая (или индекс создан до появления подписи), индекс
+перестраивается целиком: векторы разных моделей в одном индексе несравнимы. Подпись сверяется по settings
+(utils/embedding_signature.py); модель эмбеддингов загружается, только если есть что индексировать.
+
+Запуск:
+    python -m medreader.index_creator                    # обновить индекс
+    python -m medreader.index_creator --dry-run          # только показать план
+    python -m medreader.index_creator --query "Cryptosporidiosis*"
+"""
 import os
-from llama_index.core import SimpleDirectoryReader
-from llama_index.readers.file import PDFReader
-from llama_index.core.node_parser import SentenceSplitter
-from llama_index.core import VectorStoreIndex, StorageContext, load_index_from_storage
-from llama_index.core import Settings
+import shutil
+import argparse
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from settings import MED_SOURCE_DIR, PERSISTED_INDEX_DIR, INDEXED_FILES_PATH, INDEX_MANIFEST_PATH
+from utils.general import file_sha256, load_json, save_json
+
+SOURCE_EXTENSIONS: Tuple[str, ...] = (".pdf",)
+
+
+def scan_sources(source_dir: str, extensions: Iterable[str] = SOURCE_EXTENSIONS) -> List[str]:
+    """Абсолютные пути файлов-источников в директории (без рекурсии), отсортированные по имени."""
+    extensions = tuple(ext.lower() for ext in extensions)
+    with os.scandir(source_dir) as entries:
+        paths = [e.path for e in entries if e.is_file() and e.name.lower().endswith(extensions)]
+    return sorted(os.path.abspath(p) for p in paths)
+
 
-from settings import MED_SOURCE_DIR, PERSISTED_INDEX_DIR, INDEXED_FILES_PATH
+class IndexManifest:
+    """
+    Манифест проиндексированных файлов: {file_name: {"path", "size", "mtime", "sha256", "ref_doc_ids"}}
+    и подпись модели эмбеддингов индекса (embedding_signature).
+    """
 
-# Временно отключаем
-Settings.llm = None
+    def __init__(self, path: str, files: Optional[Dict[str, Dict[str, Any]]] = None,
+                 embedding: Optional[Dict[str, Any]] = None) -> None:
+        self.path = path
+        self.files: Dict[str, Dict[str, Any]] = files or {}
+        self.embedding: Optional[Dict[str, Any]] = embedding
 
+    @classmethod
+    def load(cls, path: str, legacy_path: Optional[str] = INDEXED_FILES_PATH) -> "IndexManifest":
+        """
+        Загружает манифест. Если его нет, но есть старый список indexed_files.txt, файлы из списка
+        считаются проиндексированными (id документов найдутся в индексе по file_name при удалении).
+        """
+        data = load_json(path) if os.path.isfile(path) else None
+        manifest = cls(path, (data or {}).get("files", {}), (data or {}).get("embedding"))
+        if data is None and legacy_path and os.path.isfile(legacy_path):
+            with open(legacy_path, "r", encoding="utf-8") as fp:
+                for name in (line.strip() for line in fp):
+                    if name:
+                        manifest.files[name] = {"path": None, "size": None, "mtime": None, "sha256": None,
+                                                "ref_doc_ids": None, "legacy": True}
+        return manifest
 
-# Функция для получения уже индексированных файлов
-def get_indexed_files():
-    if not os.path.exists(INDEXED_FILES_PATH):
-        return set()
-    with open(INDEXED_FILES_PATH, "r", encoding="utf-8") as f:
-        return set(line.strip() for line in f.readlines())
+    def save(self) -> bool:
+        return save_json({"files": self.files, "embedding": self.embedding}, self.path)
 
+    @staticmethod
+    def stat_record(path: str, sha256: Optional[str] = None) -> Dict[str, Any]:
+        st = os.stat(path)
+        return {"path": path, "size": st.st_size, "mtime": st.st_mtime,
+                "sha256": sha256 if sha256 is not None else file_sha256(path)}
 
-# Функция для добавления новых файлов в список
-def add_indexed_files(files):
-    with open(INDEXED_FILES_PATH, "a", encoding="utf-8") as f:
-        for file in files:
-            f.write(file + "\n")
+    def plan(self, paths: Iterable[str]) -> Dict[str, Any]:
+        """
+        Сравнивает файлы с манифестом.
 
+        :param paths: текущие файлы-источники
+        :return: {"new": [пути], "changed": [пути], "touched": {путь: запись}, "unchanged": [пути],
+                  "removed": [имена]}; touched — файлы с новым mtime, но прежним sha256 (обновляется только запись)
+        """
+        plan: Dict[str, Any] = {"new": [], "changed": [], "touched": {}, "unchanged": [], "removed": []}
+        present = set()
+        for path in paths:
+            name = os.path.basename(path)
+            present.add(name)
+            entry = self.files.get(name)
+            if entry is None:
+                plan["new"].append(path)
+                continue
+            if entry.get("legacy"):
+                plan["touched"][path] = self.stat_record(path)  # содержимое на момент индексации неизвестно
+                continue
+            st = os.stat(path)
+            if entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+                plan["unchanged"].append(path)
+                continue
+            record = self.stat_record(path)
+            if entry["size"] == record["size"] and entry["sha256"] == record["sha256"]:
+                plan["touched"][path] = record
+            else:
+                plan["changed"].append(path)
+        plan["removed"] = [name for name in self.files if name not in present]
+        return plan
 
-indexed_files = get_indexed_files()
+    @staticmethod
+    def has_work(plan: Dict[str, Any]) -> bool:
+        return bool(plan["new"] or plan["changed"] or plan["removed"])
 
-# 1. Считываем документы
-docs = SimpleDirectoryReader(
-    input_dir=MED_SOURCE_DIR,
-    file_extractor={".pdf": PDFReader()}
-).load_data()
 
-# 2. Оставляем только новые документы (по file_name в metadata)
-new_docs = [doc for doc in docs if doc.metadata.get("file_name") not in indexed_files]
+def _ref_doc_ids_for(index: Any, entry: Dict[str, Any], file_name: str) -> List[str]:
+    """id документов файла: из манифеста или (для записей из indexed_files.txt) по file_name в индексе."""
+    if entry.get("ref_doc_ids") is not None:
+        return list(entry["ref_doc_ids"])
+    return [
+        ref_id for ref_id, info in index.ref_doc_info.items()
+        if (info.metadata or {}).get("file_name") == file_name
+    ]
 
-if not new_docs:
-    print("Нет новых документов для индексации!")
-else:
-    # 3. Создаём splitter (разбивка на чанки)
-    splitter = SentenceSplitter(chunk_size=1024, chunk_overlap=100)
 
-    # 4. Разбиваем на чанки каждый новый документ
-    all_nodes = []
-    for doc in new_docs:
-        nodes = splitter.get_nodes_from_documents([doc])
-        all_nodes.extend(nodes)
+def load_nodes(paths: List[str], chunk_size: int = 1024, chunk_overlap: int = 100) -> Tuple[List[Any], Dict[str, List[str]]]:
+    """
+    Разбирает файлы PDFReader'ом и режет на чанки.
 
-    # 5. Добавляем инфу о файле и странице
-    for node in all_nodes:
+    :return: (узлы, {file_name: [id документов]})
+    """
+    from llama_index.core import SimpleDirectoryReader
+    from llama_index.readers.file import PDFReader
+    from llama_index.core.node_parser import SentenceSplitter
+
+    docs = SimpleDirectoryReader(input_files=paths, file_extractor={".pdf": PDFReader()}).load_data()
+    ref_doc_ids: Dict[str, List[str]] = {os.path.basename(p): [] for p in paths}
+    for doc in docs:
+        ref_doc_ids.setdefault(doc.metadata.get("file_name", "unknown"), []).append(doc.doc_id)
+
+    splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    nodes = splitter.get_nodes_from_documents(docs)
+    # Добавляем инфу о файле и странице
+    for node in nodes:
         page_num = node.metadata.get("page_label", "unknown")
         source = node.metadata.get("file_name", "unknown")
         node.text += f"\nsource:'{source}' page:{page_num}"
-        # print(node.text[-100:])
-        # print("---")
-
-    # 6. Индексация новых документов
-    if os.path.exists(PERSISTED_INDEX_DIR):
-        # Если индекс уже существует — догружаем его и дополняем
-        storage_context = StorageContext.from_defaults(persist_dir=PERSISTED_INDEX_DIR)
-        index = load_index_from_storage(storage_context)
-        index.insert_nodes(all_nodes)
-        index.storage_context.persist(persist_dir=PERSISTED_INDEX_DIR)
-    else:
-        # Создаём новый индекс
-        index = VectorStoreIndex.from_documents(all_nodes)
-        index.storage_context.persist(persist_dir=PERSISTED_INDEX_DIR)
-
-    # 7. Добавляем имена новых файлов в учёт
-    add_indexed_files([doc.metadata.get("file_name", "unknown") for doc in new_docs])
-
-# --- Теперь, для запросов, загружаем индекс:
-storage_context = StorageContext.from_defaults(persist_dir=PERSISTED_INDEX_DIR)
-loaded_index = load_index_from_storage(storage_context)
-
-query_engine = loaded_index.as_query_engine()
-response = query_engine.query("Cryptosporidiosis*")
-print(response)
+    return nodes, ref_doc_ids
+
+
+def update_index(
+        source_dir: str = MED_SOURCE_DIR,
+        persist_dir: str = PERSISTED_INDEX_DIR,
+        manifest_path: str = INDEX_MANIFEST_PATH,
+        *,
+        chunk_size: int = 1024,
+        chunk_overlap: int = 100,
+        dry_run: bool = False,
+) -> Dict[str, Any]:
+    """
+    Приводит индекс в соответствие с файлами source_dir.
+
+    :param source_dir: директория с PDF
+    :param persist_dir: директория сохранённого индекса
+    :param manifest_path: путь к манифесту
+    :param chunk_size: размер чанка (токены)
+    :param chunk_overlap: перекрытие чанков
+    :param dry_run: только посчитать план, ничего не менять
+    :return: план (IndexManifest.plan), "nodes_added" — число добавленных узлов и "rebuild" — индекс
+             перестраивается целиком из-за смены модели эмбеддингов
+    """
+    from utils.embedding_signature import expected_embedding_signature, read_index_embedding, same_embedding
+
+    # Подпись по settings, без загрузки модели: ничего не изменившаяся библиотека и --dry-run не грузят torch
+    signature = expected_embedding_signature()
+
+    manifest = IndexManifest.load(manifest_path)
+    recorded = read_index_embedding(persist_dir)
+    rebuild = os.path.exists(persist_dir) and not (
+            same_embedding(recorded, signature)
+            and (manifest.embedding is None or same_embedding(manifest.embedding, signature)))
+    if rebuild:
+        print(f"Модель эмбеддингов индекса {(recorded or manifest.embedding or {}).get('model')} "
+              f"не совпадает с текущей {signature['model']} — индекс перестраивается целиком")
+    embedding_missing = not rebuild and recorded is not None and manifest.embedding is None
+    if embedding_missing:
+        manifest.embedding = recorded  # манифест, записанный до появления подписи
+    if rebuild or not os.path.exists(persist_dir):
+        manifest.files = {}  # индекса нет или он другой модели — всё индексируется заново
+    plan = manifest.plan(scan_sources(source_dir))
+    plan["nodes_added"] = 0
+    plan["rebuild"] = rebuild
+    if dry_run:
+        return plan
+    if rebuild:
+        shutil.rmtree(persist_dir)
+
+    if IndexManifest.has_work(plan):
+        from llama_index.core import Settings, VectorStoreIndex
+        from utils.mmap_vector_store import get_storage_context, load_index
+        from utils.bm25_index import BM25Index, ensure_bm25_index
+        from utils.embedding_signature import write_index_embedding
+        from utils.local_embedding import configure_embeddings, embed_nodes, embedding_signature
+
+        # Временно отключаем
+        Settings.llm = None
+        embed_model = configure_embeddings()
+        signature = embedding_signature(embed_model)  # с размерностью загруженной модели
+
+        index = None
+        bm25 = BM25Index.from_persist_dir(persist_dir)
+        if os.path.exists(os.path.join(persist_dir, "docstore.json")):
+            index = load_index(persist_dir)
+            ensure_bm25_index(index, persist_dir, bm25)  # индекс, созданный до появления BM25
+            # Удаляем узлы удалённых и изменённых файлов
+            for name in plan["removed"] + [os.path.basename(p) for p in plan["changed"]]:
+                entry = manifest.files.get(name, {})
+                for ref_id in _ref_doc_ids_for(index, entry, name):
+                    index.delete_ref_doc(ref_id, delete_from_docstore=True)
+                    bm25.delete_ref_doc(ref_id)
+        for name in plan["removed"]:
+            manifest.files.pop(name, None)
+
+        to_parse = plan["new"] + plan["changed"]
+        if to_parse:
+            nodes, ref_doc_ids = load_nodes(to_parse, chunk_size, chunk_overlap)
+            if embed_model is not None:
+                embed_nodes(nodes, embed_model)  # одним проходом, с пулом процессов
+            if index is None:
+                index = VectorStoreIndex(nodes, storage_context=get_storage_context(persist_dir))
+            else:
+                index.insert_nodes(nodes)
+            bm25.add(nodes)
+            plan["nodes_added"] = len(nodes)
+            if signature["dim"] is None:
+                signature["dim"] = next((len(n.embedding) for n in nodes if n.embedding), None)
+            for path in to_parse:
+                name = os.path.basename(path)
+                manifest.files[name] = {**IndexManifest.stat_record(path), "ref_doc_ids": ref_doc_ids.get(name, [])}
+        if index is not None:
+            index.storage_context.persist(persist_dir=persist_dir)
+            write_index_embedding(persist_dir, signature)
+            manifest.embedding = signature
+        bm25.close()
+
+    for path, record in plan["touched"].items():
+        name = os.path.basename(path)
+        ref_doc_ids = manifest.files.get(name, {}).get("ref_doc_ids")
+        manifest.files[name] = {**record, "ref_doc_ids": ref_doc_ids}
+    if IndexManifest.has_work(plan) or plan["touched"] or embedding_missing:
+        manifest.save()
+    return plan
+
+
+def query_index(query: str, persist_dir: str = PERSISTED_INDEX_DIR) -> Any:
+    from llama_index.core import Settings
+    from utils.mmap_vector_store import load_index
+    from utils.local_embedding import configure_embeddings
+
+    Settings.llm = None
+    configure_embeddings()
+    loaded_index = load_index(persist_dir)
+    return loaded_index.as_query_engine().query(query)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Инкрементальная индексация PDF-источников")
+    parser.add_argument("--source-dir", default=MED_SOURCE_DIR, help="директория с PDF")
+    parser.add_argument("--persist-dir", default=PERSISTED_INDEX_DIR, help="директория индекса")
+    parser.add_argument("--manifest", default=INDEX_MANIFEST_PATH, help="путь к манифесту файлов")
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--chunk-overlap", type=int, default=100)
+    parser.add_argument("--dry-run", action="store_true", help="только показать, что изменилось")
+    parser.add_argument("--query", default=None, help="после обновления выполнить запрос к индексу")
+    args = parser.parse_args(argv)
+
+    plan = update_index(args.source_dir, args.persist_dir, args.manifest, chunk_size=args.chunk_size,
+                        chunk_overlap=args.chunk_overlap, dry_run=args.dry_run)
+    if not IndexManifest.has_work(plan):
+        print("Нет новых документов для индексации!")
+    print(f"Новых: {len(plan['new'])}, изменённых: {len(plan['changed'])}, удалённых: {len(plan['removed'])}, "
+          f"без изменений: {len(plan['unchanged']) + len(plan['touched'])}, добавлено узлов: {plan['nodes_added']}")
+    if args.query:
+        print(query_index(args.query, args.persist_dir))
+    return 0
+
 
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -4,7 +4,6 @@ settings.py
 Глобальный конфиг для пайплайна медицинского индекса.
 Содержит настройки LLM, эмбеддингов, пути данных, storage, etc.
 """
-from __future__ import all_feature_names
 import os
 from typing import Optional, TYPE_CHECKING
 # import warnings
@@ -26,6 +25,34 @@ STORAGE_DIR: str = os.path.abspath(os.path.join(BASE_DIR, "../storage"))
 MED_SOURCE_DIR: str = os.path.join(DATA_DIR, "med_sources")
 PERSISTED_INDEX_DIR: str = os.path.join(STORAGE_DIR, "storage")
 INDEXED_FILES_PATH: str = os.path.join(STORAGE_DIR, "indexed_files.txt")
+INDEX_MANIFEST_PATH: str = os.path.join(STORAGE_DIR, "index_manifest.json")
+EMBEDDING_CACHE_DIR: str = os.path.join(STORAGE_DIR, "embedding_cache")
+MARKDOWN_CACHE_DIR: str = os.path.join(STORAGE_DIR, "markdown_cache")
+PAGE_MANIFEST_PATH: str = os.path.join(STORAGE_DIR, "page_manifest.json")
+# Результат med_index/pipeline.py: чанки с метаданными и их индекс (id узла = id_ чанка, обновляется sync_index)
+MED_CHUNKS_PATH: str = os.path.join(STORAGE_DIR, "med_chunks.json")
+CHUNKS_INDEX_DIR: str = os.path.join(STORAGE_DIR, "chunks_index")
+# Индекс "заболевание -> чанки" из результата med_index/pipeline.py (med_index/disease_index.py)
+DISEASE_INDEX_PATH: str = os.path.join(STORAGE_DIR, "disease_index.json")
+DISEASE_SYNONYMS_PATH: str = os.path.join(STORAGE_DIR, "disease_synonyms.json")  # {вариант: основное название}
+DISEASE_LOOKUP_MAX_CHUNKS: int = 8  # чанков диагноза (прямые + связанные) на запрос
+# Векторное хранилище индекса: "simple" — JSON llama-index по умолчанию, "mmap" — memory-mapped матрица
+# и SQLite с узлами (utils/mmap_vector_store.py, быстрый холодный старт). Смена требует переиндексации.
+VECTOR_STORE: str = os.getenv("VECTOR_STORE", "simple")
+# Гибридный поиск: BM25 (bm25.sqlite в директории индекса) + вектор, слияние RRF (utils/hybrid_retriever.py)
+HYBRID_RETRIEVAL: bool = os.getenv("HYBRID_RETRIEVAL", "1") not in ("0", "false", "False")
+BM25_CANDIDATES: int = 20  # кандидатов от каждого поиска до слияния
+RRF_K: int = 60  # сглаживание рангов reciprocal rank fusion
+
+# ================== Сервис запросов (medqueries/query_service.py) ==================
+QUERY_SERVICE_HOST: str = os.getenv("QUERY_SERVICE_HOST", "127.0.0.1")
+QUERY_SERVICE_PORT: int = int(os.getenv("QUERY_SERVICE_PORT", "8765"))
+QUERY_TIMEOUT: float = float(os.getenv("QUERY_TIMEOUT", "180"))  # секунд на шаг запроса
+# Семантический кэш ответов (utils/semantic_cache.py)
+SEMANTIC_CACHE_PATH: str = os.path.join(STORAGE_DIR, "semantic_cache.json")
+SEMANTIC_CACHE_THRESHOLD: float = 0.92  # минимальный косинус между вопросами
+SEMANTIC_CACHE_TTL: Optional[float] = 7 * 24 * 3600  # секунд (None — без срока)
+SEMANTIC_CACHE_MAX_ENTRIES: int = 2000
 
 # ================== Дефолтная LLM и эмбеддинги ==================
 # Векторные эмбеддинги (Huggingface sentence-transformers)
@@ -42,6 +69,11 @@ default_llm = ChatOpenAI(
     temperature=0.0,
 )
 # default_tokens_counter = Llama3TokenizerCounter(f"m42-health/{DEFAULT_MODEL}")
+LLM_TOKENIZER: str = f"m42-health/{DEFAULT_MODEL}"  # токенизатор для бюджета контекста (medqueries/adaptive_qa.py)
+LLM_CONTEXT_WINDOW: int = int(os.getenv("LLM_CONTEXT_WINDOW", "8192"))  # контекстное окно модели, токены
+QA_MAX_ANSWER_TOKENS: int = 768  # резерв окна под ответ
+QA_SIMILARITY_CUTOFF: Optional[float] = 0.3  # чанки с меньшим косинусом не попадают в контекст (None — все)
+QA_MAP_CONCURRENCY: int = int(os.getenv("QA_MAP_CONCURRENCY", "4"))  # одновременных map-вызовов LLM
 
 # ================== OpenAI модель (по желанию) ==================
 API_KEY: str = os.getenv("API_KEY_OPENAI", "")
@@ -60,6 +92,17 @@ else:
 
 # ================== Embedding модель (по желанию) ==================
 ST_MODEL_NAME: str = "all-MiniLM-L6-v2"
+# Эмбеддинги llama-index: "local" — SentenceTransformer ST_MODEL_NAME на этом хосте (utils/local_embedding.py),
+# "default" — модель llama-index по умолчанию (удалённый API)
+EMBEDDING_BACKEND: str = os.getenv("EMBEDDING_BACKEND", "local")
+# Движок SentenceTransformer: "torch" (fp32), "onnx" (ONNX Runtime, fp32), "onnx-int8" (ONNX Runtime,
+# динамическая int8-квантизация; нужен onnxruntime/optimum). При смене fp32 <-> int8 индекс перестраивается целиком.
+ST_BACKEND: str = os.getenv("ST_BACKEND", "torch")
+ST_QUANTIZATION: str = os.getenv("ST_QUANTIZATION", "avx2")  # "arm64", "avx2", "avx512", "avx512_vnni"
+ST_ONNX_DIR: str = os.path.join(STORAGE_DIR, "onnx_models")
+EMBED_BATCH_SIZE: int = 256
+EMBED_MULTI_PROCESS_MIN: int = 2048  # с какого числа текстов кодировать пулом процессов (0 — никогда)
+EMBED_WORKERS: Optional[int] = None  # процессов в пуле (None — по числу ядер)
 
 # Чтобы избежать тяжёлого импорта при старте и циклических импортов:
 if TYPE_CHECKING:
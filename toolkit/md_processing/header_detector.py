@@ -1,6 +1,8 @@
 from __future__ import annotations
 from typing import Dict, List, Tuple, Any, Optional
 
+from toolkit.pdf_preprocessing.style_index import StyleIndex
+
 
 class HeaderDetector:
     """
@@ -11,6 +13,10 @@ class HeaderDetector:
       1) 'style_to_header' (dict): { (font, size, color): "#"/"##"/... }  — быстрый точный матч
       2) 'rules' (list[dict]): [{"font": str, "size": float, "color": int, "header": str}, ...]
          — «читаемый» формат; используется как fallback с допуском по size.
+
+    Правила компилируются в StyleIndex (группы (font, color) с отсортированными размерами),
+    поэтому fallback — это bisect, а не перебор правил; результаты для повторяющихся стилей мемоизируются.
+    Если self.rules меняются после создания, нужно вызвать compile().
     """
 
     DEFAULT_LEVEL_TO_HEADER = {1: "#", 2: "##", 3: "###", 4: "####", 5: "#####", 6: "######"}
@@ -24,6 +30,16 @@ class HeaderDetector:
         self.rules: List[Dict[str, Any]] = rules or []
         self.style_to_header: Dict[Tuple[str, float, int], str] = style_to_header or {}
         self.size_tol = size_tol
+        self.compile()
+
+    def compile(self) -> None:
+        """(Пере)компилирует self.rules в индекс: первое по порядку правило имеет приоритет."""
+        self._index = StyleIndex(self.size_tol)
+        for priority, rule in enumerate(self.rules):
+            self._index.add(
+                {"font": rule["font"], "color": rule["color"], "size": rule["size"]}, rule["header"], priority
+            )
+        self._memo: Dict[Tuple[str, float, int], str] = {}
 
     # ───────────────────────────── статические утилиты ─────────────────────────────
 
@@ -114,24 +130,21 @@ class HeaderDetector:
     def get_header_id(self, span: dict, page=None) -> str:
         """
         Возвращает "#"/"##"/... или "" для данного span (PyMuPDF4LLM вызовет это на каждый span).
-        Сначала пробуем точное совпадение, затем «мягкую» проверку по правилам (с допуском по size).
+        Сначала пробуем точное совпадение, затем «мягкую» проверку по индексу правил (с допуском по size);
+        ответ для стиля (font, size, color) мемоизируется.
         """
         font = str(span.get("font"))
         size = self._norm_size(span.get("size"))
         color = self._norm_color(span.get("color"))
 
-        # 1) точный ключ
-        exact = self.style_to_header.get((font, float(size), int(color)))
-        if exact:
-            return exact
-
-        # 2) fallback: «читаемые» правила с допуском по size
-        for rule in self.rules:
-            if rule["font"] != font:
-                continue
-            if rule["color"] != color:
-                continue
-            if abs(rule["size"] - size) <= self.size_tol:
-                return rule["header"]
-
-        return ""
+        key = (font, float(size), int(color))
+        cached = self._memo.get(key)
+        if cached is not None:
+            return cached
+
+        # 1) точный ключ, 2) fallback: индекс правил с допуском по size
+        header = self.style_to_header.get(key) or self._index.lookup({"font": font, "color": color, "size": size}, "")
+        if len(self._memo) > 100_000:
+            self._memo.clear()
+        self._memo[key] = header
+        return header
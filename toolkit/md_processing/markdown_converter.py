@@ -0,0 +1,226 @@
+"""
+Параллельная конвертация PDF в markdown через pymupdf4llm с HeaderDetector в роли hdr_info.
+
+Диапазоны страниц распределяются по процессам; каждый процесс один раз (в initializer пула)
+строит свой HeaderDetector.from_levels(...) из общего levels JSON. Markdown каждой страницы
+кэшируется на диске по (хэш levels JSON, файл, отпечаток content stream страницы — см. utils/page_manifest.py,
+mode="content"): правка только оформления (размер шрифта, жирность, стиль заголовка) меняет отпечаток,
+а страницы разных книг с одинаковым текстом не делят запись. Повторный запуск, в том числе на исправленной
+версии книги, конвертирует только новые и изменённые страницы. Страницы склеиваются в исходном порядке.
+
+Пример:
+    md = convert_pdf_to_markdown("Easy Paediatrics.pdf", "Easy Paediatrics_heading_levels.json")
+"""
+from __future__ import annotations
+import os
+import re
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional, Sequence, Union
+
+from toolkit.md_processing.header_detector import HeaderDetector
+
+LevelsSource = Union[str, Dict[str, Any]]  # путь к levels JSON или уже загруженный словарь
+
+# Детектор текущего процесса-воркера (создаётся в _init_worker).
+_WORKER_DETECTOR: Optional[HeaderDetector] = None
+
+
+def _load_levels(levels: LevelsSource) -> Dict[str, Any]:
+    if isinstance(levels, dict):
+        return levels
+    from utils.general import load_json
+    data = load_json(levels)
+    if data is None:
+        raise ValueError(f"Не удалось загрузить levels JSON: {levels}")
+    return data
+
+
+def levels_fingerprint(levels_json: Dict[str, Any], size_tol: float) -> str:
+    """Короткий хэш правил заголовков: часть ключа кэша (другие уровни — другой markdown)."""
+    payload = json.dumps({"levels": levels_json, "size_tol": size_tol}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def _init_worker(levels: LevelsSource, size_tol: float) -> None:
+    """Initializer пула: свой HeaderDetector на процесс."""
+    global _WORKER_DETECTOR
+    _WORKER_DETECTOR = HeaderDetector.from_levels(_load_levels(levels), size_tol=size_tol)
+
+
+def convert_pages(pdf_path: str, page_numbers: Sequence[int]) -> Dict[int, str]:
+    """
+    Markdown страниц PDF (1-based) детектором текущего процесса. Функция верхнего уровня — для пула.
+
+    :return: {номер страницы: markdown}
+    """
+    import pymupdf4llm
+
+    if _WORKER_DETECTOR is None:
+        raise RuntimeError("HeaderDetector воркера не инициализирован (нужен _init_worker)")
+    chunks = pymupdf4llm.to_markdown(
+        pdf_path,
+        pages=[int(p) - 1 for p in page_numbers],
+        hdr_info=_WORKER_DETECTOR,
+        page_chunks=True,
+        show_progress=False,
+    )
+    out: Dict[int, str] = {int(p): "" for p in page_numbers}
+    for chunk in chunks:
+        out[int(chunk["metadata"]["page"])] = chunk.get("text", "")
+    return out
+
+
+class MarkdownPageCache:
+    """
+    Дисковый кэш markdown по отпечаткам страниц:
+    <cache_dir>/<хэш levels>/<файл>/<fingerprint[:2]>/<fingerprint>.md
+    """
+
+    def __init__(self, cache_dir: str, levels_hash: str, file_key: str) -> None:
+        self.path = os.path.join(cache_dir, levels_hash, file_key)
+
+    @staticmethod
+    def file_key(pdf_path: str) -> str:
+        """Часть ключа по файлу: имя PDF (правки той же книги переиспользуют её неизменные страницы)."""
+        return re.sub(r"[^\w.\-]+", "_", os.path.basename(pdf_path))
+
+    def _page_path(self, fingerprint: str) -> str:
+        return os.path.join(self.path, fingerprint[:2], f"{fingerprint}.md")
+
+    def get(self, fingerprint: str) -> Optional[str]:
+        try:
+            with open(self._page_path(fingerprint), "r", encoding="utf-8") as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, fingerprint: str, markdown: str) -> None:
+        page_path = self._page_path(fingerprint)
+        os.makedirs(os.path.dirname(page_path), exist_ok=True)
+        tmp_path = page_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fp:
+            fp.write(markdown)
+        os.replace(tmp_path, page_path)
+
+
+def convert_pdf_to_markdown_pages(
+        pdf_path: str,
+        levels: LevelsSource,
+        page_numbers: Optional[Sequence[int]] = None,
+        *,
+        size_tol: float = 0.15,
+        pages_per_task: int = 8,
+        max_workers: Optional[int] = None,
+        cache_dir: Optional[str] = None,
+        use_cache: bool = True,
+        fingerprints: Optional[Sequence[str]] = None,
+) -> Dict[int, str]:
+    """
+    Markdown по страницам PDF; недостающие в кэше страницы конвертируются пулом процессов.
+
+    :param pdf_path: путь к PDF
+    :param levels: levels JSON (путь или словарь) для HeaderDetector.from_levels
+    :param page_numbers: номера страниц (1-based); None — все страницы документа
+    :param size_tol: допуск по size для HeaderDetector
+    :param pages_per_task: сколько страниц конвертирует один воркер за задачу
+    :param max_workers: число процессов (None — по числу ядер; 1 — без пула)
+    :param cache_dir: директория кэша (по умолчанию settings.MARKDOWN_CACHE_DIR)
+    :param use_cache: читать и пополнять кэш страниц
+    :param fingerprints: отпечатки страниц PDF (page_fingerprints(..., mode="content")), если уже посчитаны
+    :return: {номер страницы: markdown} в порядке страниц
+    """
+    from utils.page_manifest import page_fingerprints
+
+    levels_json = _load_levels(levels)
+    if use_cache and fingerprints is None:
+        fingerprints = page_fingerprints(pdf_path, mode="content")
+    if page_numbers is None:
+        if fingerprints is not None:
+            page_numbers = list(range(1, len(fingerprints) + 1))
+        else:
+            import fitz  # PyMuPDF
+            with fitz.open(pdf_path) as doc:
+                page_numbers = list(range(1, doc.page_count + 1))
+    page_numbers = sorted(set(int(p) for p in page_numbers))
+
+    cache: Optional[MarkdownPageCache] = None
+    pages: Dict[int, str] = {}
+    if use_cache:
+        if cache_dir is None:
+            from settings import MARKDOWN_CACHE_DIR
+            cache_dir = MARKDOWN_CACHE_DIR
+        cache = MarkdownPageCache(cache_dir, levels_fingerprint(levels_json, size_tol),
+                                  MarkdownPageCache.file_key(pdf_path))
+        for p in page_numbers:
+            cached = cache.get(fingerprints[p - 1])
+            if cached is not None:
+                pages[p] = cached
+
+    todo = [p for p in page_numbers if p not in pages]
+    step = max(1, int(pages_per_task))
+    ranges = [todo[i:i + step] for i in range(0, len(todo), step)]
+
+    if max_workers == 1 or len(ranges) == 1:
+        _init_worker(levels_json, size_tol)
+        parts = [convert_pages(pdf_path, r) for r in ranges]
+    elif ranges:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(levels_json, size_tol)) as pool:
+            parts = list(pool.map(convert_pages, [pdf_path] * len(ranges), ranges))
+    else:
+        parts = []
+
+    for part in parts:
+        for p, markdown in part.items():
+            pages[p] = markdown
+            if cache is not None:
+                cache.put(fingerprints[p - 1], markdown)
+    return {p: pages[p] for p in page_numbers}
+
+
+def convert_pdf_to_markdown(
+        pdf_path: str,
+        levels: LevelsSource,
+        page_numbers: Optional[Sequence[int]] = None,
+        *,
+        page_separator: str = "\n",
+        **kwargs: Any,
+) -> str:
+    """
+    Markdown всего PDF (или выбранных страниц), склеенный по порядку страниц.
+
+    :param page_separator: разделитель между страницами
+    :param kwargs: параметры convert_pdf_to_markdown_pages
+    """
+    pages = convert_pdf_to_markdown_pages(pdf_path, levels, page_numbers, **kwargs)
+    return page_separator.join(pages.values())
+
+
+if __name__ == "__main__":
+    from time import perf_counter
+    from utils.formatting import format_time
+
+    PDF_BOOKS_DIR = "../../data/med_sources"
+    LEVELS_DIR = "../../tests/data/"
+    PDF_FILES = ("Guide-to-Common-Childhood-Infections-2023_Final-Approved.pdf",
+                 "Easy Paediatrics.pdf",
+                 "Manual_of_childhood_infections.pdf")
+    PDF_FILE = PDF_FILES[1]
+    pdf_path_ = os.path.join(PDF_BOOKS_DIR, PDF_FILE)
+    levels_path_ = os.path.join(LEVELS_DIR, PDF_FILE.replace(".pdf", "_heading_levels.json"))
+
+    for workers_ in (1, None):
+        t1 = perf_counter()
+        md_ = convert_pdf_to_markdown(pdf_path_, levels_path_, max_workers=workers_, use_cache=False)
+        t2 = perf_counter()
+        print(f"max_workers={workers_}: {len(md_)} символов за {format_time(t2 - t1)}")
+
+    convert_pdf_to_markdown(pdf_path_, levels_path_)  # заполняет кэш страниц
+    t1 = perf_counter()
+    md_ = convert_pdf_to_markdown(pdf_path_, levels_path_)
+    t2 = perf_counter()
+    print(f"С кэшем страниц (второй проход): {format_time(t2 - t1)}")
+    with open(os.path.join(LEVELS_DIR, PDF_FILE.replace(".pdf", ".md")), "w", encoding="utf-8") as fp_:
+        fp_.write(md_)
@@ -1,17 +1,29 @@
 from __future__ import annotations
+import os
 import re
 import unicodedata
-from typing import Iterable, Dict, Any, List, Tuple, Sequence, Optional
+from collections import Counter
+from typing import Iterable, Dict, Any, List, Tuple, Sequence, Optional, Literal
 from functools import lru_cache
 
+import numpy as np
 from sentence_transformers import SentenceTransformer
 
 from toolkit.pdf_preprocessing.utilities import DEFAULT_STYLE_KEYS  # ("color", "font", "size")
-from style_frequency import Span, Style
+from toolkit.pdf_preprocessing.style_frequency import Span, Style
+from toolkit.pdf_preprocessing.style_index import StyleIndex
+from utils.embedding_cache import EmbeddingCache, _st_backend, st_cache_name
+
+try:  # необязательная зависимость для лексического фильтра
+    from rapidfuzz import fuzz as _rf_fuzz, process as _rf_process
+except ImportError:  # pragma: no cover
+    _rf_fuzz = _rf_process = None
 
 
 _WORD_RE = re.compile(r"\w+", re.UNICODE)
 
+LexicalScreen = Literal["token", "trigram", "rapidfuzz"]
+
 
 def match_headings_to_styles(
         spans: Iterable[Span],
@@ -26,11 +38,30 @@ def match_headings_to_styles(
         merge_before: bool = True,
         line_tol: float = 2.0,
         joiner: str = " ",
+        top_k: Optional[int] = None,
+        batch_size: int = 256,
+        model: Optional[SentenceTransformer] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        exact_match: bool = False,
+        lexical_screen: Optional[LexicalScreen] = None,
+        min_lexical: float = 0.1,
+        stats: Optional[Dict[str, int]] = None,
 ) -> List[Tuple[str, Style]]:
     """
     Сопоставляет список LLM-заголовков со «строками» документа (объединённые спаны)
     и возвращает пары (исходный_заголовок, стиль_строки). Вместо мешков слов
-    использует эмбеддинги (SentenceTransformer) через `_cosine_sim`.
+    использует эмбеддинги (SentenceTransformer): уникальные заголовки и уникальные тексты
+    подходящих сегментов кодируются один раз батчами, а все косинусы считаются одним
+    матричным произведением нормализованных эмбеддингов.
+
+    Перед эмбеддингами пары (заголовок, текст сегмента) проходят каскад дешёвых фильтров:
+      1) точное совпадение нормализованного текста (_normalize_text) — пара принимается сразу со score 1.0,
+         остальные пары этого заголовка отбрасываются;
+      2) лексический фильтр (Жаккар по токенам / символьным триграммам или rapidfuzz) — пары
+         со сходством ниже min_lexical отбрасываются как безнадёжные;
+      3) эмбеддинги считаются только для выживших пар.
+    Обе стадии меняют набор результатов (точное совпадение отбрасывает другие стили выше min_cosine
+    для заголовка, фильтр — пары, которые прошли бы по эмбеддингам), поэтому по умолчанию выключены.
 
     :param spans: итерируемая коллекция спанов с полями text, size, font, color, bbox, page_number
     :param levels_dict: словарь уровней от rank_heading_candidates:
@@ -51,6 +82,19 @@ def match_headings_to_styles(
     :param merge_before: если True, сначала объединить соседние спаны в строки по стилю и линии
     :param line_tol: допуск по вертикали (pt) для объединения спанов в строку
     :param joiner: строка-соединитель при склейке текста спанов в строку
+    :param top_k: если задано, для каждого заголовка рассматриваются только top_k сегментов
+                  с наибольшим сходством (отбор через np.argpartition); по умолчанию — все выше min_cosine
+    :param batch_size: размер батча для SentenceTransformer.encode
+    :param model: уже созданная модель SentenceTransformer; если None — get_st_model_cached()
+    :param embedding_cache: персистентный кэш эмбеддингов той же модели (utils.embedding_cache);
+                            если задан, уже встречавшиеся тексты повторно не кодируются
+    :param exact_match: включить стадию точного совпадения нормализованного текста (по умолчанию выключена)
+    :param lexical_screen: лексический фильтр: "token" (Жаккар по словам), "trigram" (Жаккар по символьным
+                           триграммам), "rapidfuzz" (token_set_ratio, нужен пакет rapidfuzz) или None — без фильтра
+                           (по умолчанию)
+    :param min_lexical: порог лексического сходства (0..1), ниже которого пара отбрасывается
+    :param stats: если передан словарь, в него пишутся счётчики уникальных пар по стадиям каскада:
+                  pairs_total, exact_accepted, exact_eliminated, lexical_eliminated, embedded_pairs, texts_encoded
     :return: список кортежей (llm_heading, style_dict) только для успешно сматченных заголовков
     """
     # 1) Соберём стили-кандидаты из словаря уровней
@@ -72,12 +116,11 @@ def match_headings_to_styles(
         return []
     levels.sort(key=lambda t: t[0])  # 1..N
 
+    # Скомпилированный индекс: первый по порядку уровней стиль, совпавший с учётом size_tol.
+    level_index = StyleIndex.from_levels(levels, size_tol=size_tol)
+
     def _resolve_level_for_style(seg_style: Style) -> Optional[int]:
-        for lvl_no, styles_in_level in levels:
-            for cs in styles_in_level:
-                if _style_matches(seg_style, cs, size_tol=size_tol):
-                    return lvl_no
-        return None
+        return level_index.lookup(seg_style)
 
     # --- 2) сегменты (строки) ---
     if merge_before:
@@ -108,41 +151,98 @@ def match_headings_to_styles(
     if not eligible:
         return []
 
-    # --- 4) матчинг ---
-    results: List[Tuple[str, Style, Dict[str, Optional[int]]]] = []
-    used_seg_ids: set[int] = set()  # применяется только при deduplicate_segments=True
-
-    def _size_of(seg: Dict[str, Any]) -> float:
-        v = seg.get("style", {}).get("size")
-        return float(v) if isinstance(v, (int, float)) else 0.0
+    # --- 4) кандидаты: каждый уникальный текст обрабатывается один раз ---
+    headings = [h.strip() for h in llm_headings if h.strip()]
+    cand = [(seg_idx, seg, level_no, str(seg.get("text", "")).strip()) for seg_idx, seg, level_no in eligible]
+    cand = [c for c in cand if c[3]]
+    if not headings or not cand:
+        return []
 
-    for heading in llm_headings:
-        heading = heading.strip()
-        if not heading:
-            continue
+    unique_headings = list(dict.fromkeys(headings))
+    unique_texts = list(dict.fromkeys(c[3] for c in cand))
+    text_col = {t: j for j, t in enumerate(unique_texts)}
+    heading_row = {h: i for i, h in enumerate(unique_headings)}
+
+    # --- 4.1 каскад: точное совпадение -> лексический фильтр -> эмбеддинги ---
+    n_h, n_t = len(unique_headings), len(unique_texts)
+    counters = {"pairs_total": n_h * n_t, "exact_accepted": 0, "exact_eliminated": 0,
+                "lexical_eliminated": 0, "embedded_pairs": 0, "texts_encoded": 0}
+    sim_u = np.full((n_h, n_t), -np.inf, dtype=np.float32)
+    survivors = np.ones((n_h, n_t), dtype=bool)
+
+    heading_norm = [" ".join(_normalize_text(h)) for h in unique_headings]
+    text_norm = [" ".join(_normalize_text(t)) for t in unique_texts]
+
+    if exact_match:
+        by_norm: Dict[str, List[int]] = {}
+        for j, t in enumerate(text_norm):
+            if t:
+                by_norm.setdefault(t, []).append(j)
+        for i, h in enumerate(heading_norm):
+            cols = by_norm.get(h) if h else None
+            if cols:
+                sim_u[i, cols] = 1.0
+                survivors[i, :] = False
+                counters["exact_accepted"] += len(cols)
+                counters["exact_eliminated"] += n_t - len(cols)
+
+    if lexical_screen is not None:
+        before = int(survivors.sum())
+        rows = np.flatnonzero(survivors.any(axis=1))
+        if rows.size:
+            lex = _lexical_similarity([heading_norm[i] for i in rows], text_norm, method=lexical_screen)
+            # заголовок, который после нормализации пуст, фильтром не оценивается
+            lex[[k for k, i in enumerate(rows) if not heading_norm[i]]] = 1.0
+            survivors[rows] &= lex >= float(min_lexical)
+        counters["lexical_eliminated"] = before - int(survivors.sum())
+
+    rows = np.flatnonzero(survivors.any(axis=1))
+    cols = np.flatnonzero(survivors.any(axis=0))
+    if rows.size and cols.size:
+        m = model or get_st_model_cached()
+        heading_emb = encode_texts([unique_headings[i] for i in rows], model=m, batch_size=batch_size,
+                                   cache=embedding_cache)
+        text_emb = encode_texts([unique_texts[j] for j in cols], model=m, batch_size=batch_size,
+                                cache=embedding_cache)
+        block = heading_emb @ text_emb.T
+        block[~survivors[np.ix_(rows, cols)]] = -np.inf
+        sim_u[np.ix_(rows, cols)] = np.maximum(sim_u[np.ix_(rows, cols)], block)
+        counters["embedded_pairs"] = int(survivors.sum())
+        counters["texts_encoded"] = int(rows.size + cols.size)
+    if stats is not None:
+        stats.update(counters)
+
+    # (уникальные заголовки × уникальные тексты) -> (уникальные заголовки × кандидаты)
+    sim = sim_u[:, np.array([text_col[c[3]] for c in cand])]
+
+    cand_levels = np.array([c[2] for c in cand], dtype=np.int64)
+    cand_sizes = np.array([_segment_size(c[1]) for c in cand], dtype=np.float64)
+    cand_pos = np.arange(len(cand))
+    available = np.ones(len(cand), dtype=bool)  # снимается только при deduplicate_segments=True
+    threshold = float(min_cosine)
+
+    # --- 5) матчинг ---
+    results: List[Tuple[str, Style, Dict[str, Optional[int]]]] = []
 
-        # 4.1 посчитать скоры со всеми подходящими сегментами
-        scored: List[Tuple[float, int, Dict[str, Any], int]] = []  # (score, seg_idx, seg, level)
-        for seg_idx, seg, level_no in eligible:
-            if deduplicate_segments and seg_idx in used_seg_ids:
-                continue
-            seg_text = str(seg.get("text", "")).strip()
-            if not seg_text:
-                continue
-            score = _cosine_sim(heading, seg_text)
-            if score >= float(min_cosine):
-                scored.append((score, seg_idx, seg, level_no))
+    for heading in headings:
+        row = sim[heading_row[heading]]
 
-        if not scored:
+        # 5.1 кандидаты: выше порога (и, если задано, только top_k лучших)
+        idx = np.flatnonzero(available & (row >= threshold))
+        if top_k is not None and 0 < int(top_k) < idx.size:
+            part = np.argpartition(-row[idx], int(top_k) - 1)[:int(top_k)]
+            idx = idx[part]
+        if idx.size == 0:
             continue
 
-        # сортировка для устойчивого выбора «лучшего»
-        # при равном score предпочтём меньший уровень (крупнее иерархия), затем больший size
-        scored.sort(key=lambda t: (-t[0], t[3], -_size_of(t[2])))
+        # 5.2 устойчивый порядок: score desc, затем меньший уровень (крупнее иерархия),
+        #     затем больший size, затем исходный порядок сегментов
+        idx = idx[np.lexsort((cand_pos[idx], -cand_sizes[idx], cand_levels[idx], -row[idx]))]
 
         if deduplicate_segments:
             # только один лучший
-            best_score, best_seg_idx, best_seg, best_level = scored[0]
+            best = int(idx[0])
+            _, best_seg, best_level = cand[best][:3]
             results.append((
                 heading,
                 best_seg.get("style", {}),
@@ -152,28 +252,16 @@ def match_headings_to_styles(
                     "block_index": best_seg.get("block_index"),
                 },
             ))
-            used_seg_ids.add(best_seg_idx)
+            available[best] = False
         else:
-            # лучший ДЛЯ КАЖДОГО уникального стиля ('color','font','size')
-            best_for_style: Dict[Tuple, Tuple[float, int, Dict[str, Any], int]] = {}
-            for score, seg_idx, seg, level_no in scored:
+            # лучший ДЛЯ КАЖДОГО уникального стиля ('color','font','size'): первый в порядке сортировки
+            seen_styles: set = set()
+            for j in idx.tolist():
+                _, seg, level_no = cand[j][:3]
                 sig = _style_signature(seg.get("style", {}), style_keys)
-                prev = best_for_style.get(sig)
-                if prev is None:
-                    best_for_style[sig] = (score, seg_idx, seg, level_no)
-                else:
-                    # выбираем лучший по score; при равенстве — меньший уровень, затем больший size
-                    p_score, p_idx, p_seg, p_lvl = prev
-                    better = (score > p_score) or (
-                            score == p_score and (
-                                level_no < p_lvl or (level_no == p_lvl and _size_of(seg) > _size_of(p_seg)))
-                    )
-                    if better:
-                        best_for_style[sig] = (score, seg_idx, seg, level_no)
-
-            # добавить в results (порядок — по убыванию score для читабельности)
-            selected = sorted(best_for_style.values(), key=lambda t: (-t[0], t[3], -_size_of(t[2])))
-            for score, seg_idx, seg, level_no in selected:
+                if sig in seen_styles:
+                    continue
+                seen_styles.add(sig)
                 results.append((
                     heading,
                     seg.get("style", {}),
@@ -183,7 +271,7 @@ def match_headings_to_styles(
                         "block_index": seg.get("block_index"),
                     },
                 ))
-            # здесь НЕ помечаем used_seg_ids — т.к. deduplicate_segments=False означает, что
+            # здесь НЕ снимаем available — т.к. deduplicate_segments=False означает, что
             # один и тот же сегмент можно использовать и для других заголовков
 
     return results
@@ -206,6 +294,58 @@ def _canonical_style(span: Span, keys: Sequence[str] = ("color", "font", "size")
     return out
 
 
+def _lexical_similarity(headings: Sequence[str], texts: Sequence[str], *, method: LexicalScreen) -> np.ndarray:
+    """
+    Матрица лексического сходства (0..1) между нормализованными заголовками и текстами.
+
+    "token"/"trigram" — коэффициент Жаккара по множествам слов / символьных триграмм; пересечения
+    считаются через инвертированный индекс, поэтому пары без общих признаков не перебираются.
+    "rapidfuzz" — fuzz.token_set_ratio / 100 (при отсутствии пакета используется "trigram").
+
+    :param headings: нормализованные заголовки
+    :param texts: нормализованные тексты сегментов
+    :param method: способ оценки
+    :return: матрица float32 формы (len(headings), len(texts))
+    """
+    if method == "rapidfuzz":
+        if _rf_process is not None:
+            scores = _rf_process.cdist(headings, texts, scorer=_rf_fuzz.token_set_ratio, workers=-1)
+            return np.asarray(scores, dtype=np.float32) / 100.0
+        method = "trigram"
+
+    def features(s: str) -> set:
+        if method == "token":
+            return set(s.split())
+        padded = f" {s} "
+        return {padded[k:k + 3] for k in range(len(padded) - 2)}
+
+    text_feats = [features(t) for t in texts]
+    postings: Dict[str, List[int]] = {}
+    for j, feats in enumerate(text_feats):
+        for f in feats:
+            postings.setdefault(f, []).append(j)
+    text_sizes = np.array([len(f) for f in text_feats], dtype=np.float32)
+
+    out = np.zeros((len(headings), len(texts)), dtype=np.float32)
+    for i, h in enumerate(headings):
+        feats = features(h)
+        inter: Counter = Counter()
+        for f in feats:
+            inter.update(postings.get(f, ()))
+        if not inter:
+            continue
+        cols = np.fromiter(inter.keys(), dtype=np.int64, count=len(inter))
+        common = np.fromiter(inter.values(), dtype=np.float32, count=len(inter))
+        out[i, cols] = common / (len(feats) + text_sizes[cols] - common)
+    return out
+
+
+def _segment_size(seg: Dict[str, Any]) -> float:
+    """Размер шрифта сегмента (0.0, если не число)."""
+    v = seg.get("style", {}).get("size")
+    return float(v) if isinstance(v, (int, float)) else 0.0
+
+
 def _style_matches(span_style: Style, cand_style: Style, *, size_tol: float = 0.25) -> bool:
     """
     Сравнивает стилевые словари, разрешая небольшую погрешность по size.
@@ -228,9 +368,6 @@ def _style_matches(span_style: Style, cand_style: Style, *, size_tol: float = 0.
     return True
 
 
-_WORD_RE = re.compile(r"\w+", re.UNICODE)
-
-
 def _normalize_text(s: str) -> List[str]:
     """
     Нормализует текст: нижний регистр, удаление диакритики, выделение 'слов'.
@@ -243,14 +380,78 @@ def _normalize_text(s: str) -> List[str]:
     return _WORD_RE.findall(s)
 
 
-@lru_cache(maxsize=1)
-def get_st_model_cached(model_name: str = "all-MiniLM-L6-v2") -> SentenceTransformer:
-    print(f"{model_name} loading...", end="", flush=True)
-    model = SentenceTransformer(model_name)
+def _load_onnx_int8(model_name: str) -> SentenceTransformer:
+    """
+    ONNX-модель с динамической int8-квантизацией (onnxruntime). Квантизованная копия один раз
+    экспортируется в settings.ST_ONNX_DIR и дальше грузится оттуда без сети.
+    """
+    from settings import ST_ONNX_DIR, ST_QUANTIZATION
+
+    local_dir = os.path.join(ST_ONNX_DIR, re.sub(r"[^\w.\-]+", "_", model_name))
+    file_name = f"onnx/model_qint8_{ST_QUANTIZATION}.onnx"
+    if not os.path.isfile(os.path.join(local_dir, file_name)):
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+
+        base = SentenceTransformer(model_name, backend="onnx", device="cpu")
+        base.save(local_dir)
+        export_dynamic_quantized_onnx_model(base, ST_QUANTIZATION, local_dir)
+    return SentenceTransformer(local_dir, backend="onnx", device="cpu", model_kwargs={"file_name": file_name})
+
+
+@lru_cache(maxsize=4)
+def get_st_model_cached(model_name: str = "all-MiniLM-L6-v2", backend: Optional[str] = None) -> SentenceTransformer:
+    """
+    Модель SentenceTransformer (одна на процесс для пары модель/backend).
+
+    :param model_name: имя модели
+    :param backend: "torch" (fp32), "onnx" (ONNX Runtime, fp32) или "onnx-int8" (ONNX Runtime, динамическая
+                    int8-квантизация — быстрее на CPU); None — settings.ST_BACKEND
+    """
+    backend = _st_backend(backend)
+    print(f"{model_name} ({backend}) loading...", end="", flush=True)
+    if backend == "onnx-int8":
+        model = _load_onnx_int8(model_name)
+    elif backend == "onnx":
+        model = SentenceTransformer(model_name, backend="onnx", device="cpu")
+    else:
+        model = SentenceTransformer(model_name)
     print(f"\r\rLoaded")
     return model
 
 
+def encode_texts(
+        texts: Sequence[str],
+        *,
+        model: Optional[SentenceTransformer] = None,
+        batch_size: int = 256,
+        cache: Optional[EmbeddingCache] = None,
+) -> np.ndarray:
+    """
+    Кодирует тексты батчами в L2-нормализованные эмбеддинги: косинус становится скалярным произведением.
+
+    :param texts: тексты для кодирования
+    :param model: уже созданная модель SentenceTransformer; если None — get_st_model_cached()
+    :param batch_size: размер батча для SentenceTransformer.encode
+    :param cache: персистентный кэш эмбеддингов; промахи кодируются моделью и дописываются в кэш
+    :return: матрица float32 формы (len(texts), dim)
+    """
+    m = model or get_st_model_cached()
+    if not texts:
+        return np.zeros((0, m.get_sentence_embedding_dimension() or 0), dtype=np.float32)
+
+    def _encode(batch: List[str]) -> np.ndarray:
+        emb = m.encode(batch, normalize_embeddings=True, batch_size=batch_size,
+                       show_progress_bar=False, convert_to_numpy=True)
+        return np.asarray(emb, dtype=np.float32)
+
+    if cache is None:
+        return _encode(list(texts))
+    # float16 в кэше слегка нарушает единичную норму — нормализуем повторно
+    emb = cache.encode(list(texts), _encode, batch_size=max(batch_size, 1024))
+    norms = np.linalg.norm(emb, axis=1, keepdims=True)
+    return emb / np.where(norms > 0, norms, 1.0)
+
+
 def _cosine_sim(llm_heading: str, spam_text: str, *, model: Optional[SentenceTransformer] = None) -> float:
     """
     Косинусное сходство между строкой-заголовком и текстом спана с помощью SentenceTransformer.
@@ -381,10 +582,52 @@ def _style_signature(style: Style, keys: Sequence[str] = ("color", "font", "size
     return tuple(sig)
 
 
+def compare_st_backends(
+        spans: Iterable[Span],
+        levels_dict: Dict[str, Any],
+        llm_headings: List[str],
+        *,
+        backends: Sequence[str] = ("torch", "onnx-int8"),
+        model_name: str = "all-MiniLM-L6-v2",
+        **match_kwargs: Any,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Сравнение backend'ов на матчинге заголовков: скорость кодирования (эмбеддингов/с, без кэша) и
+    recall — доля пар (заголовок, стиль) первого backend'а (эталон, обычно fp32), найденных остальными.
+
+    :param match_kwargs: параметры match_headings_to_styles
+    :return: {backend: {"embeddings_per_sec", "matched", "recall", "speedup"}}
+    """
+    import time
+
+    spans = list(spans)
+    texts = sorted({seg["text"] for seg in merge_spans_by_style_and_line(spans)} | set(llm_headings))
+    report: Dict[str, Dict[str, Any]] = {}
+    reference: Optional[set] = None
+    for backend in backends:
+        model = get_st_model_cached(model_name, backend)
+        encode_texts(texts[:64], model=model)  # прогрев
+        t0 = time.perf_counter()
+        encode_texts(texts, model=model)
+        rate = len(texts) / max(time.perf_counter() - t0, 1e-9)
+        pairs = {(h, _style_signature(st)) for h, st, *_ in
+                 match_headings_to_styles(spans, levels_dict, llm_headings, model=model, **match_kwargs)}
+        if reference is None:
+            reference = pairs
+        first = report[backends[0]] if report else None
+        report[backend] = {
+            "embeddings_per_sec": round(rate, 1),
+            "matched": len(pairs),
+            "recall": round(len(pairs & reference) / len(reference), 4) if reference else 1.0,
+            "speedup": round(rate / first["embeddings_per_sec"], 2) if first else 1.0,
+        }
+    return report
+
+
 # ===== Пример использования =====
 if __name__ == "__main__":
-    import os
     from utils.general import load_json  # create_local_logger,
+    from utils.embedding_cache import get_embedding_cache
     from utils.custom_print import custom_pretty_print
 
     LLM_HEADINGS = ["PAEDIATRIC HISTORY", "INFANT AND CHILD", "MYOCARDITIS", "Clinical features", "DILATED CARDIOMYOPATHY"]
@@ -400,5 +643,19 @@ if __name__ == "__main__":
 
     spans_ = load_json(spans_path)
     heading_levels_ = load_json(heading_levels_path)
-    matched_headings = match_headings_to_styles(spans_, heading_levels_, LLM_HEADINGS, min_cosine=0.9, deduplicate_segments=False)
+
+    st_model = get_st_model_cached()
+    with get_embedding_cache(st_cache_name(), st_model.get_sentence_embedding_dimension()) as emb_cache:
+        cascade_stats: Dict[str, int] = {}
+        matched_headings = match_headings_to_styles(spans_, heading_levels_, LLM_HEADINGS, min_cosine=0.9,
+                                                    deduplicate_segments=False, embedding_cache=emb_cache,
+                                                    exact_match=True, lexical_screen="trigram",
+                                                    stats=cascade_stats)
+        custom_pretty_print("Каскад (уникальные пары):", cascade_stats)
+        print(f"Embedding cache: {len(emb_cache)} векторов, hit rate {emb_cache.hit_rate():.1%}")
     custom_pretty_print("matched_headings:", matched_headings)
+
+    # fp32 против int8 (ONNX Runtime): recall пар на фикстурах и ускорение в эмбеддингах/с
+    custom_pretty_print("Backend'ы SentenceTransformer:",
+                        compare_st_backends(spans_, heading_levels_, LLM_HEADINGS, min_cosine=0.9,
+                                            deduplicate_segments=False))
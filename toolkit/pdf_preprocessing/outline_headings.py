@@ -0,0 +1,223 @@
+"""
+Уровни заголовков по встроенному оглавлению PDF (outline / закладки, fitz.Document.get_toc()).
+
+Быстрый путь вместо «частоты стилей + LLM-заголовки + эмбеддинг-матчинг»: каждая запись оглавления
+ищется среди строк (merge_spans_by_style_and_line) своей страницы, стиль найденной строки относится
+к уровню записи. Результат — в формате levels_dict (как у rank_heading_candidates) плюс пары
+(заголовок, стиль), как у match_headings_to_styles. Если оглавления нет или оно плохо ложится на текст
+(покрытие ниже min_coverage), возвращается None и используется обычный путь.
+
+Основной стиль текста (StyleStats.main_style) заголовком не бывает: запись оглавления, совпавшая
+с абзацем тела (нечёткое сравнение, соседние страницы), не должна сделать весь текст заголовком.
+"""
+from __future__ import annotations
+import re
+import unicodedata
+from collections import Counter
+from difflib import SequenceMatcher
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from toolkit.pdf_preprocessing.style_frequency import Span, Style, _hashable
+
+OutlineEntry = Tuple[int, str, int]  # (уровень, заголовок, страница 1-based)
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _norm(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text or "").encode("ascii", "ignore").decode("ascii")
+    return " ".join(_WORD_RE.findall(text.lower()))
+
+
+def read_outline(pdf_path: str) -> List[OutlineEntry]:
+    """Оглавление PDF: [(уровень, заголовок, страница), ...]; записи без страницы отбрасываются."""
+    import fitz  # PyMuPDF
+
+    with fitz.open(pdf_path) as doc:
+        toc = doc.get_toc(simple=True)
+    return [(int(level), str(title).strip(), int(page)) for level, title, page, *_ in toc if int(page) > 0]
+
+
+def _title_score(title: str, text: str) -> float:
+    """Сходство нормализованных записи оглавления и строки (difflib ratio)."""
+    if not title or not text:
+        return 0.0
+    if title == text:
+        return 1.0
+    return SequenceMatcher(None, title, text, autojunk=False).ratio()
+
+
+def _page_candidates(segments: List[Tuple[str, Style]], max_lines: int) -> List[Tuple[str, Style]]:
+    """Строки страницы и склейки до max_lines подряд идущих строк одного стиля (многострочные заголовки)."""
+    out = list(segments)
+    for i, (text, style) in enumerate(segments):
+        joined = text
+        for next_text, next_style in segments[i + 1:i + max_lines]:
+            if next_style != style:
+                break
+            joined = f"{joined} {next_text}"
+            out.append((joined, style))
+    return out
+
+
+def outline_heading_levels(
+        outline: Sequence[OutlineEntry],
+        spans: Iterable[Span],
+        *,
+        levels: int = 3,
+        style_keys: Sequence[str] = ("color", "font", "size"),
+        min_ratio: float = 0.85,
+        page_slack: int = 1,
+        max_lines: int = 3,
+        min_entries: int = 5,
+        min_coverage: float = 0.6,
+) -> Optional[Tuple[Dict[str, Any], List[Tuple[str, Style]]]]:
+    """
+    Уровни стилей заголовков по оглавлению.
+
+    :param outline: записи оглавления (read_outline)
+    :param spans: спаны документа (extract_spans/create_spans)
+    :param levels: сколько верхних уровней оглавления учитывать
+    :param style_keys: ключи стиля
+    :param min_ratio: минимальное сходство записи и строки
+    :param page_slack: на сколько страниц в стороны искать, если на указанной странице не нашлось
+    :param max_lines: сколько подряд идущих строк одного стиля может занимать заголовок
+    :param min_entries: минимум записей оглавления (в пределах levels), чтобы доверять ему
+    :param min_coverage: минимальная доля записей, найденных в тексте
+    :return: (levels_dict, [(заголовок, стиль), ...]) или None, если оглавления недостаточно
+    """
+    from toolkit.pdf_preprocessing.headings_to_styles_matching import merge_spans_by_style_and_line
+    from toolkit.pdf_preprocessing.style_frequency import StyleStats
+
+    entries = [e for e in outline if 1 <= e[0] <= levels and _norm(e[1])]
+    if len(entries) < max(1, min_entries):
+        return None
+
+    def style_key(style: Style) -> Tuple:
+        return tuple((k, _hashable(style.get(k))) for k in style_keys)
+
+    spans = list(spans)
+    body_key = style_key(StyleStats(spans, tuple(style_keys)).main_style())
+
+    pages = {p for _, _, page in entries for p in range(page - page_slack, page + page_slack + 1)}
+    by_page: Dict[Any, List[Tuple[str, Style]]] = {}
+    for seg in merge_spans_by_style_and_line([sp for sp in spans if sp.get("page_number") in pages],
+                                             style_keys=style_keys):
+        by_page.setdefault(seg["page_number"], []).append((_norm(seg["text"]), seg["style"]))
+    by_page = {page: _page_candidates(segments, max_lines) for page, segments in by_page.items()}
+
+    matched: List[Tuple[int, str, Style]] = []
+    for level, title, page in entries:
+        title_norm = _norm(title)
+        best: Tuple[float, Optional[Style]] = (0.0, None)
+        for p in [page] + [page + d * s for d in range(1, page_slack + 1) for s in (-1, 1)]:
+            for text, style in by_page.get(p, ()):
+                if style_key(style) == body_key:
+                    continue
+                score = _title_score(title_norm, text)
+                if score > best[0]:
+                    best = (score, style)
+            if best[0] >= min_ratio:
+                break
+        if best[0] >= min_ratio and best[1] is not None:
+            matched.append((level, title, best[1]))
+
+    coverage = len(matched) / len(entries)
+    if coverage < min_coverage:
+        return None
+
+    # Стиль — уровню, на котором он встречается чаще всего (при равенстве — более высокому).
+    style_levels: Dict[Any, Counter] = {}
+    style_of: Dict[Any, Style] = {}
+    for level, _, style in matched:
+        key = style_key(style)
+        style_levels.setdefault(key, Counter())[level] += 1
+        style_of.setdefault(key, style)
+
+    buckets: List[List[Dict[str, Any]]] = [[] for _ in range(levels)]
+    for key, counter in style_levels.items():
+        level = min(counter, key=lambda lv: (-counter[lv], lv))
+        style = style_of[key]
+        size = style.get("size")
+        buckets[level - 1].append({
+            "style": style,
+            "count": int(sum(counter.values())),
+            "size": float(size) if isinstance(size, (int, float)) else None,
+            "font": style.get("font"),
+        })
+    levels_dict: Dict[str, Any] = {
+        "meta": {
+            "levels_count": levels,
+            "source": "outline",
+            "outline_entries": len(entries),
+            "coverage": round(coverage, 4),
+            "min_ratio": float(min_ratio),
+        },
+        "levels": [
+            {"level": i + 1, "items": sorted(items, key=lambda it: -it["count"]), "total": len(items)}
+            for i, items in enumerate(buckets)
+        ],
+    }
+    return levels_dict, [(title, style) for _, title, style in matched]
+
+
+def detect_heading_levels(
+        pdf_path: str,
+        spans: Sequence[Span],
+        *,
+        levels: int = 3,
+        llm_headings: Optional[Callable[[], List[str]]] = None,
+        outline_kwargs: Optional[Dict[str, Any]] = None,
+        match_kwargs: Optional[Dict[str, Any]] = None,
+) -> Tuple[Dict[str, Any], List[Tuple[str, Style]], str]:
+    """
+    Уровни заголовков: сначала по оглавлению PDF; если его покрытия мало — частоты стилей
+    (rank_heading_candidates) и, если передан llm_headings, сопоставление LLM-заголовков эмбеддингами.
+
+    :param pdf_path: путь к PDF
+    :param spans: спаны документа
+    :param levels: число уровней
+    :param llm_headings: функция, возвращающая заголовки от LLM (вызывается только без оглавления)
+    :param outline_kwargs: параметры outline_heading_levels
+    :param match_kwargs: параметры match_headings_to_styles
+    :return: (levels_dict, [(заголовок, стиль), ...], источник: "outline" | "styles")
+    """
+    found = outline_heading_levels(read_outline(pdf_path), spans, levels=levels, **(outline_kwargs or {}))
+    if found is not None:
+        return found[0], found[1], "outline"
+
+    from toolkit.pdf_preprocessing.style_frequency import StyleStats
+
+    _, levels_dict = StyleStats(spans).rank_heading_candidates(levels)
+    matched: List[Tuple[str, Style]] = []
+    if llm_headings is not None:
+        from toolkit.pdf_preprocessing.headings_to_styles_matching import match_headings_to_styles
+        matched = match_headings_to_styles(spans, levels_dict, llm_headings(), **(match_kwargs or {}))
+    return levels_dict, matched, "styles"
+
+
+if __name__ == "__main__":
+    import os
+    from time import perf_counter
+    from utils.general import load_json
+    from utils.formatting import format_time
+    from utils.custom_print import custom_pretty_print
+
+    PDF_BOOKS_DIR = "../../data/med_sources"
+    SPANS_DIR = "../../tests/data/"
+    PDF_FILES = ("Guide-to-Common-Childhood-Infections-2023_Final-Approved.pdf",
+                 "Easy Paediatrics.pdf",
+                 "Manual_of_childhood_infections.pdf")
+    PDF_FILE = PDF_FILES[1]
+    pdf_path_ = os.path.join(PDF_BOOKS_DIR, PDF_FILE)
+    spans_ = load_json(os.path.join(SPANS_DIR, PDF_FILE.replace(".pdf", "_spans.json")))
+
+    t1 = perf_counter()
+    outline_ = read_outline(pdf_path_)
+    result_ = outline_heading_levels(outline_, spans_, levels=3)
+    t2 = perf_counter()
+    print(f"Оглавление: {len(outline_)} записей за {format_time(t2 - t1)}")
+    if result_ is None:
+        print("Покрытия оглавления недостаточно — нужен путь через частоты стилей и LLM")
+    else:
+        custom_pretty_print("Уровни по оглавлению:", result_[0])
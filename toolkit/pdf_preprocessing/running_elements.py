@@ -0,0 +1,239 @@
+"""
+Удаление колонтитулов, номеров страниц и водяных знаков по повторяемости между страницами.
+
+Элемент (спан или строка текста страницы) сводится к ключу (нормализованный текст, полоса по вертикали):
+цифры заменяются на "#" (номер страницы, "Chapter 3"), регистр и пробелы нормализуются, позиция
+округляется до полосы band pt (для строк текста — «k-я строка сверху/снизу»). Ключ, встречающийся
+больше чем на min_fraction страниц, считается бегущим элементом. Доля считается и отдельно по чётным
+и нечётным страницам, поэтому чередующиеся колонтитулы (автор/глава) тоже находятся.
+
+Элементы тела страницы (позиция ("body", полоса)) — кандидаты в водяные знаки — учитываются только
+при заданном body_min_fraction, который должен быть заметно выше min_fraction: повторяющиеся в тексте
+подзаголовки ("Symptoms", "Treatment") и короткие фразы не должны приниматься за водяной знак.
+Полоса тела есть только у спанов (реальный bbox); у строк текста страницы тело не учитывается,
+а строки-заголовки markdown не считаются бегущими никогда.
+
+Детектор однопроходный: observe() вызывается в потоке элементов и только обновляет счётчики;
+решение для элемента принимается по его ключу после прохода.
+"""
+from __future__ import annotations
+import re
+import unicodedata
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+from toolkit.pdf_preprocessing.style_frequency import Span
+
+_DIGITS_RE = re.compile(r"\d+")
+_MARKUP_RE = re.compile(r"[#*_`|>]+")
+_HEADING_RE = re.compile(r"^\s{0,3}#{1,6}\s")
+
+RunningKey = Tuple[str, Hashable]
+
+
+def normalize_running_text(text: str) -> str:
+    """Текст для ключа: NFKC, без markdown-разметки, цифры -> "#", нижний регистр, схлопнутые пробелы."""
+    text = unicodedata.normalize("NFKC", text or "")
+    text = _DIGITS_RE.sub("#", _MARKUP_RE.sub(" ", text))
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class RunningElementDetector:
+    """
+    Потоковый счётчик повторяющихся между страницами элементов.
+
+    Пример:
+        detector = RunningElementDetector(min_fraction=0.5)
+        keys = [detector.observe(sp["page_number"], sp["text"], band) for sp in spans]
+        kept = [sp for sp, key in zip(spans, keys) if not detector.is_running(key)]
+    """
+
+    def __init__(self, min_fraction: float = 0.5, min_pages: int = 3, band: float = 10.0,
+                 body_min_fraction: Optional[float] = None) -> None:
+        """
+        :param min_fraction: доля страниц (всех, чётных или нечётных), начиная с которой элемент — бегущий
+        :param min_pages: минимальное число страниц с элементом (на коротких документах повторов мало)
+        :param band: высота полосы по вертикали (pt) при округлении позиции
+        :param body_min_fraction: то же для элементов тела страницы (водяные знаки); None — тело не учитывается
+        """
+        self.min_fraction = float(min_fraction)
+        self.body_min_fraction = None if body_min_fraction is None else float(body_min_fraction)
+        self.min_pages = int(min_pages)
+        self.band = float(band)
+        # ключ -> [последняя страница, страниц всего, чётных, нечётных]
+        self._counts: Dict[RunningKey, List[Any]] = {}
+        self._pages: Dict[Any, int] = {}  # страница -> чётность
+        self._tokens_total = 0
+        self._tokens_by_key: Dict[RunningKey, int] = {}
+        self._running: Optional[set] = None
+
+    def band_of(self, y: float) -> int:
+        return int(round(float(y) / self.band))
+
+    @staticmethod
+    def is_body(position: Hashable) -> bool:
+        return isinstance(position, tuple) and bool(position) and position[0] == "body"
+
+    def observe(self, page: Any, text: str, position: Hashable) -> Optional[RunningKey]:
+        """
+        Учитывает элемент страницы.
+
+        :param page: номер страницы
+        :param text: текст элемента
+        :param position: полоса (например, band_of(y0), ("top", 0) или ("body", band_of(y0)))
+        :return: ключ элемента (None для пустого текста и не учитываемых элементов тела)
+        """
+        self._running = None
+        parity = int(page) % 2 if isinstance(page, int) else 0
+        self._pages.setdefault(page, parity)
+        tokens = len(text.split())
+        self._tokens_total += tokens
+        norm = normalize_running_text(text)
+        if not norm:
+            return None
+        if self.is_body(position) and (self.body_min_fraction is None or not any(ch.isalpha() for ch in norm)):
+            return None  # тело без порога водяных знаков; числа/символы в теле (таблицы, списки) не считаются
+        key = (norm, position)
+        entry = self._counts.get(key)
+        if entry is None:
+            entry = self._counts[key] = [None, 0, 0, 0]
+        if entry[0] != page:  # страницы идут потоком — повтор внутри страницы не считается
+            entry[0] = page
+            entry[1] += 1
+            entry[2 + parity] += 1
+        self._tokens_by_key[key] = self._tokens_by_key.get(key, 0) + tokens
+        return key
+
+    @property
+    def running_keys(self) -> set:
+        if self._running is None:
+            total = len(self._pages)
+            by_parity = [0, 0]
+            for parity in self._pages.values():
+                by_parity[parity] += 1
+            running = set()
+            for key, (_, pages, even, odd) in self._counts.items():
+                if pages < self.min_pages or not total:
+                    continue
+                fraction = max(
+                    pages / total,
+                    even / by_parity[0] if by_parity[0] and not odd else 0.0,
+                    odd / by_parity[1] if by_parity[1] and not even else 0.0,
+                )
+                if fraction > (self.body_min_fraction if self.is_body(key[1]) else self.min_fraction):
+                    running.add(key)
+            self._running = running
+        return self._running
+
+    def is_running(self, key: Optional[RunningKey]) -> bool:
+        return key is not None and key in self.running_keys
+
+    def report(self, top: int = 10) -> Dict[str, Any]:
+        """
+        Сводка: страниц, найденных шаблонов, удаляемых токенов (по пробелам) и их доля в процентах.
+        """
+        running = self.running_keys
+        removed = sum(self._tokens_by_key[key] for key in running)
+        patterns = sorted(running, key=lambda key: -self._counts[key][1])[:top]
+        return {
+            "pages": len(self._pages),
+            "patterns_total": len(running),
+            "tokens_total": self._tokens_total,
+            "tokens_removed": removed,
+            "tokens_removed_pct": round(100.0 * removed / self._tokens_total, 2) if self._tokens_total else 0.0,
+            "patterns": [{"text": key[0], "position": key[1], "pages": self._counts[key][1]} for key in patterns],
+        }
+
+
+def _span_y(span: Span) -> Tuple[float, float]:
+    """(верх, низ) спана: по bbox, иначе по origin."""
+    box = span.get("bbox")
+    if box:
+        return float(box[1]), float(box[3])
+    origin = span.get("origin") or (0.0, 0.0)
+    return float(origin[1]), float(origin[1])
+
+
+def strip_running_spans(
+        spans: Sequence[Span],
+        *,
+        min_fraction: float = 0.5,
+        min_pages: int = 3,
+        band: float = 10.0,
+        edge_margin: float = 60.0,
+        body_min_fraction: Optional[float] = 0.8,
+) -> Tuple[List[Span], Dict[str, Any]]:
+    """
+    Удаляет из спанов (extract_spans) колонтитулы, номера страниц и водяные знаки.
+
+    Спаны в пределах edge_margin pt от верхнего или нижнего края текста страницы — кандидаты
+    в колонтитулы (порог min_fraction); остальные — в водяные знаки (порог body_min_fraction).
+
+    :param spans: спаны, упорядоченные по страницам
+    :param edge_margin: высота полос колонтитулов сверху и снизу текста страницы (pt)
+    :param body_min_fraction: порог для спанов тела страницы; None — тело не трогается
+    :return: (оставшиеся спаны, report())
+    """
+    detector = RunningElementDetector(min_fraction, min_pages, band, body_min_fraction=body_min_fraction)
+    extents: Dict[Any, List[float]] = {}
+    for sp in spans:
+        top, bottom = _span_y(sp)
+        extent = extents.get(sp.get("page_number", None))
+        if extent is None:
+            extents[sp.get("page_number", None)] = [top, bottom]
+        else:
+            extent[0], extent[1] = min(extent[0], top), max(extent[1], bottom)
+
+    keys = []
+    for sp in spans:
+        page = sp.get("page_number", None)
+        top, bottom = _span_y(sp)
+        page_top, page_bottom = extents[page]
+        position: Hashable = detector.band_of(top)
+        if page_top + edge_margin < top and bottom < page_bottom - edge_margin:
+            position = ("body", position)
+        keys.append(detector.observe(page, str(sp.get("text", "") or ""), position))
+    kept = [sp for sp, key in zip(spans, keys) if not detector.is_running(key)]
+    return kept, detector.report()
+
+
+def _is_heading(line: str) -> bool:
+    return _HEADING_RE.match(line) is not None
+
+
+def strip_running_lines(
+        pages: Dict[int, str],
+        *,
+        edge_lines: int = 3,
+        min_fraction: float = 0.5,
+        min_pages: int = 3,
+) -> Tuple[Dict[int, str], Dict[str, Any]]:
+    """
+    То же для текста страниц (markdown страниц, текст PDFReader): позиция строки — её номер среди первых
+    и последних edge_lines непустых строк страницы. Остальные строки не учитываются: без bbox водяной знак
+    не отличить от повторяющейся фразы текста. Заголовки markdown ("### Symptoms") не учитываются никогда —
+    по ним чанкуется текст.
+
+    :param pages: {номер страницы: текст}
+    :return: ({номер страницы: текст без бегущих строк}, report())
+    """
+    detector = RunningElementDetector(min_fraction, min_pages)
+    page_lines: Dict[int, List[Tuple[str, Optional[RunningKey]]]] = {}
+    for page in sorted(pages):
+        lines = pages[page].splitlines()
+        filled = [i for i, line in enumerate(lines) if line.strip()]
+        position: Dict[int, Hashable] = {}
+        for k, i in enumerate(reversed(filled[-edge_lines:])):
+            position[i] = ("bottom", k)
+        for k, i in enumerate(filled[:edge_lines]):
+            position[i] = ("top", k)
+        # тело и заголовки идут в observe только для учёта токенов: без body_min_fraction они не считаются
+        body = ("body", None)
+        page_lines[page] = [
+            (line, detector.observe(page, line, body if _is_heading(line) else position.get(i, body)))
+            for i, line in enumerate(lines)
+        ]
+    stripped = {
+        page: "\n".join(line for line, key in items if not detector.is_running(key))
+        for page, items in page_lines.items()
+    }
+    return stripped, detector.report()
@@ -6,23 +6,75 @@
 import re
 import fitz  # PyMuPDF
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional, Set, Union
 
 from tqdm import tqdm
 
-from utilities import get_main_text_properties, get_style
-
-
-def create_spans(pdf_path: str, page_numbers: Optional[List[int]] = None) -> List[Dict]:
-    spans = extract_spans(pdf_path, page_numbers)
+from toolkit.pdf_preprocessing.utilities import get_main_text_properties, get_style
+from toolkit.pdf_preprocessing.running_elements import strip_running_spans
+
+# Профили извлечения текста (page.get_text("dict", ...)):
+#   flags  — флаги fitz; без TEXT_PRESERVE_IMAGES картинки не декодируются и не попадают в блоки
+#   sort   — сортировка блоков и строк внутри fitz
+#   resort — сортировка блоков в Python по (y0, x0)
+#   clip   — поля страницы (left, top, right, bottom) в pt, которые отрезаются (None — вся страница)
+# "legacy" — прежнее поведение (картинки декодируются, блоки сортируются дважды).
+# "fast" — без картинок, блоки сортируются один раз в том же порядке (y0, x0); строки внутри блока — в порядке
+# извлечения. "fast_clip" — то же, без полей страницы (колонтитулы, номера страниц).
+EXTRACTION_PROFILES: Dict[str, Dict[str, Any]] = {
+    "legacy": {"flags": None, "sort": True, "resort": True, "clip": None},
+    "fast": {"flags": fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES, "sort": False, "resort": True, "clip": None},
+    "fast_clip": {"flags": fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES, "sort": False, "resort": True,
+                  "clip": (0.0, 36.0, 0.0, 36.0)},
+}
+
+ExtractionProfile = Union[str, Dict[str, Any]]
+
+
+def _get_profile(profile: ExtractionProfile) -> Dict[str, Any]:
+    if isinstance(profile, dict):
+        return {**EXTRACTION_PROFILES["fast"], **profile}
+    if profile not in EXTRACTION_PROFILES:
+        raise ValueError(f"Неизвестный профиль извлечения: {profile} (есть: {', '.join(EXTRACTION_PROFILES)})")
+    return EXTRACTION_PROFILES[profile]
+
+
+def _page_text_dict(page: fitz.Page, profile: Dict[str, Any]) -> Dict:
+    """page.get_text("dict") с параметрами профиля."""
+    kwargs: Dict[str, Any] = {"sort": profile["sort"]}
+    if profile["flags"] is not None:
+        kwargs["flags"] = profile["flags"]
+    if profile["clip"] is not None:
+        left, top, right, bottom = profile["clip"]
+        rect = page.rect
+        kwargs["clip"] = fitz.Rect(rect.x0 + left, rect.y0 + top, rect.x1 - right, rect.y1 - bottom)
+    return page.get_text("dict", **kwargs)
+
+
+def create_spans(pdf_path: str, page_numbers: Optional[List[int]] = None, strip_running: bool = True,
+                 profile: ExtractionProfile = "legacy") -> List[Dict]:
+    spans = extract_spans(pdf_path, page_numbers, profile=profile)
+    if strip_running:
+        # колонтитулы, номера страниц и водяные знаки не должны попадать в статистику стилей и чанки
+        spans, report = strip_running_spans(spans)
+        print(f"Удалено бегущих элементов: {report['patterns_total']} шаблонов, "
+              f"{report['tokens_removed_pct']}% токенов")
     main_text_styles = get_main_text_properties(spans)
     spans = remove_text_hyphenation(spans)
     spans = add_headings(spans, main_text_styles)
     return spans
 
 
-def extract_spans(pdf_path: str, page_numbers: Optional[List[int]] = None) -> List[Dict]:
+def extract_spans(pdf_path: str, page_numbers: Optional[List[int]] = None,
+                  profile: ExtractionProfile = "legacy") -> List[Dict]:
+    """
+    Спаны текста страниц PDF.
 
+    :param pdf_path: путь к PDF
+    :param page_numbers: номера страниц (1-based); None — все страницы
+    :param profile: имя профиля из EXTRACTION_PROFILES или словарь с его полями (недостающие — из "fast")
+    """
+    options = _get_profile(profile)
     spans = []
 
     if not Path(pdf_path).is_file():
@@ -45,12 +97,13 @@ def extract_spans(pdf_path: str, page_numbers: Optional[List[int]] = None) -> Li
 
             page = doc[page_index]
 
-            text_dict = page.get_text("dict", sort=True)
+            text_dict = _page_text_dict(page, options)
             # text_blocks = page.get_text("blocks")
 
             # Для сортировки блоков как они появляются на странице page.get_text("dict")
-            sorted_dict_blocks = sorted(text_dict.get("blocks", []),
-                                        key=lambda block: (block["bbox"][1], block["bbox"][0]))
+            sorted_dict_blocks = text_dict.get("blocks", [])
+            if options["resort"]:
+                sorted_dict_blocks = sorted(sorted_dict_blocks, key=lambda block: (block["bbox"][1], block["bbox"][0]))
             # Для сортировки блоков как они появляются на странице page.get_text("blocks")
             # sorted_blocks = sorted(text_blocks, key=lambda block: (block[1], block[0]))
             for block_index, block in enumerate(sorted_dict_blocks):
@@ -97,6 +150,24 @@ def extract_spans(pdf_path: str, page_numbers: Optional[List[int]] = None) -> Li
     return spans
 
 
+def refresh_spans(pdf_path: str, spans: List[Dict], pages: Set[int], page_count: Optional[int] = None,
+                  profile: ExtractionProfile = "legacy") -> List[Dict]:
+    """
+    Инкрементальное обновление сырых спанов (extract_spans): заново извлекаются только страницы pages
+    (например, изменённые по PageManifest.diff), спаны остальных страниц берутся из spans.
+
+    :param pdf_path: путь к PDF (новая версия)
+    :param spans: спаны прошлой версии
+    :param pages: номера изменённых страниц (1-based)
+    :param page_count: число страниц новой версии (спаны удалённых страниц отбрасываются)
+    :param profile: профиль извлечения (тот же, что для spans)
+    """
+    from utils.page_manifest import replace_pages
+
+    fresh = extract_spans(pdf_path, sorted(pages), profile=profile) if pages else []
+    return replace_pages(spans, fresh, set(pages), lambda sp: sp.get("page_number"), page_count)
+
+
 def remove_text_hyphenation(spans: List[Dict]) -> List[Dict]:
     """
     Убирает переносы для одинаковых стилей и объединяет реливантный текст
@@ -181,6 +252,16 @@ if __name__ == "__main__":
     PDF_FILE = PDF_FILES[1]
 
     pdf_path = os.path.join(PDF_BOOKS_DIR, PDF_FILE)
+
+    # Сравнение профилей извлечения по скорости (на книгах с картинками разница больше)
+    from time import perf_counter
+    from utils.formatting import format_time
+    for profile_name in EXTRACTION_PROFILES:
+        t1 = perf_counter()
+        profile_spans = extract_spans(pdf_path, page_numbers=None, profile=profile_name)
+        t2 = perf_counter()
+        print(f"Профиль {profile_name}: {len(profile_spans)} спанов за {format_time(t2 - t1)}")
+
     block_spans = extract_spans(pdf_path, page_numbers=None)
     # pretty_print_json(block_spans)
 
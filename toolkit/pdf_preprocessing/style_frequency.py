@@ -1,6 +1,7 @@
-from collections import Counter
 from typing import Iterable, Dict, Tuple, List, Any, Literal, Optional
 
+import numpy as np
+
 from toolkit.pdf_preprocessing.utilities import DEFAULT_STYLE_KEYS  # ("color", "font", "size")
 
 Style = Dict[str, Any]
@@ -48,27 +49,178 @@ def count_styles(
     :param skip_empty_text: если True, спаны с пустым или пробельным текстом пропускаются
     :return: список пар (стиль, количество), отсортированный по частоте
     """
-    counter: Counter = Counter()
+    return StyleStats(spans, keys, size_round=size_round, skip_empty_text=skip_empty_text).style_counts()
+
 
-    for s in spans:
-        if skip_empty_text and not str(s.get("text", "")).strip():
-            continue
+class StyleStats:
+    """
+    NumPy-движок статистики стилей.
 
-        style = canonical_style(s, keys, size_round=size_round)
-        key = tuple((k, style.get(k)) for k in keys)
-        counter[key] += 1
+    Один раз интернирует стиль каждого спана в целочисленный id, после чего частоты стилей,
+    основной стиль и свойства основного текста считаются через np.bincount по массиву id —
+    без повторного обхода спанов и построения кортежей-ключей. Удобно при подборе параметров
+    rank_heading_candidates: спаны разбираются один раз, а ранжирование можно звать сколько угодно.
 
-    items: List[Tuple[Style, int]] = []
-    for key, cnt in counter.items():
-        style_dict = {k: v for k, v in key}
-        items.append((style_dict, cnt))
+    Форматы результатов совпадают с count_styles, get_main_text_properties и rank_heading_candidates.
 
-    def sort_key(item: Tuple[Style, int]):
-        style, cnt = item
-        return -cnt, str(style.get("font")), float(style.get("size", 0)), style.get("color")
+    Пример:
+        stats = StyleStats(spans, size_round=1)
+        main_style, levels = stats.rank_heading_candidates(levels=5, per_level_limit=5)
+    """
 
-    items.sort(key=sort_key)
-    return items
+    def __init__(
+            self,
+            spans: Iterable[Span],
+            keys: Tuple[str, ...] = DEFAULT_STYLE_KEYS,
+            *,
+            size_round: int | None = None,
+            skip_empty_text: bool = True,
+    ) -> None:
+        """
+        :param spans: список/итерируемый объект спанов (dict)
+        :param keys: поля, которые определяют стиль (по умолчанию color, font, size)
+        :param size_round: если задано, округляет size до указанного числа знаков
+        :param skip_empty_text: если True, спаны с пустым или пробельным текстом не учитываются в частотах стилей
+        """
+        self.keys: Tuple[str, ...] = tuple(keys)
+        self.size_round = size_round
+        self.skip_empty_text = skip_empty_text
+
+        # «Сырые» ключи: поля стиля + поля основного текста (size, font, color) без округления.
+        raw_keys = tuple(dict.fromkeys((*self.keys, *DEFAULT_STYLE_KEYS)))
+        raw_index: Dict[Tuple, int] = {}
+        raw_values: List[Tuple] = []
+        raw_ids: List[int] = []
+        non_empty: List[bool] = []
+
+        for s in spans:
+            values = tuple(map(s.get, raw_keys))
+            try:
+                rid = raw_index.get(values)
+                key = values
+            except TypeError:  # нехэшируемое значение, например цвет-список [r, g, b]
+                key = tuple(_hashable(v) for v in values)
+                rid = raw_index.get(key)
+            if rid is None:
+                rid = raw_index[key] = len(raw_values)
+                raw_values.append(values)
+            raw_ids.append(rid)
+            if skip_empty_text:
+                non_empty.append(bool(str(s.get("text", "")).strip()))
+
+        self._raw_keys = raw_keys
+        self._raw_values = raw_values
+        self.raw_ids: np.ndarray = np.fromiter(raw_ids, dtype=np.int64, count=len(raw_ids))
+        self.mask: Optional[np.ndarray] = (
+            np.fromiter(non_empty, dtype=bool, count=len(non_empty)) if skip_empty_text else None
+        )
+
+        # Канонизация (округление size) выполняется по уникальным «сырым» стилям, а не по спанам.
+        size_pos = self.keys.index("size") if "size" in self.keys else None
+        style_index: Dict[Tuple, int] = {}
+        self.styles: List[Style] = []
+        remap = np.empty(len(raw_values), dtype=np.int64)
+        for rid, values in enumerate(raw_values):
+            style_values = list(values[:len(self.keys)])
+            if size_pos is not None and size_round is not None:
+                v = style_values[size_pos]
+                if isinstance(v, (float, int)):
+                    style_values[size_pos] = round(float(v), size_round)
+            key = tuple(_hashable(v) for v in style_values)
+            sid = style_index.get(key)
+            if sid is None:
+                sid = style_index[key] = len(self.styles)
+                self.styles.append(dict(zip(self.keys, style_values)))
+            remap[rid] = sid
+
+        # id канонического стиля для каждого спана
+        self.style_ids: np.ndarray = remap[self.raw_ids]
+        self._style_counts: Optional[List[StyleCount]] = None
+
+    def __len__(self) -> int:
+        return int(self.raw_ids.size)
+
+    def counts(self) -> np.ndarray:
+        """Массив частот: counts[style_id] — число (непустых) спанов со стилем self.styles[style_id]."""
+        ids = self.style_ids if self.mask is None else self.style_ids[self.mask]
+        return np.bincount(ids, minlength=len(self.styles))
+
+    def style_counts(self) -> List[StyleCount]:
+        """
+        Частоты стилей в формате count_styles: список пар (стиль, количество),
+        отсортированный по убыванию частоты (затем font, size, color).
+        """
+        if self._style_counts is None:
+            counts = self.counts()
+            present = np.flatnonzero(counts)
+            items = [(self.styles[i], int(counts[i])) for i in present.tolist()]
+
+            def sort_key(item: Tuple[Style, int]):
+                style, cnt = item
+                return -cnt, str(style.get("font")), float(style.get("size", 0)), style.get("color")
+
+            items.sort(key=sort_key)
+            self._style_counts = items
+        return [(dict(style), cnt) for style, cnt in self._style_counts]
+
+    def main_style(self) -> Style:
+        """Основной (самый частый) стиль или {} для пустого набора спанов."""
+        style_counts = self.style_counts()
+        return style_counts[0][0] if style_counts else {}
+
+    def main_text_properties(self) -> Dict[str, Any]:
+        """
+        Наиболее частые size, font и color по всем спанам (без округления и без фильтра пустого текста) —
+        тот же результат, что у get_main_text_properties. При равенстве частот побеждает значение,
+        встретившееся раньше.
+        """
+        out: Dict[str, Any] = {}
+        for field in ("size", "font", "color"):
+            if self.raw_ids.size == 0:
+                out[field] = None
+                continue
+            values, ids = self.field_ids(field)
+            counts = np.bincount(ids, minlength=len(values))
+            out[field] = values[int(np.argmax(counts))]
+        return out
+
+    def field_ids(self, field: str) -> Tuple[List[Any], np.ndarray]:
+        """
+        Интернирует значения одного поля (без округления) по всем спанам.
+
+        Значения нумеруются в порядке первых появлений «сырых» стилей, что совпадает
+        с порядком первого появления значения среди спанов.
+
+        :param field: имя поля (одно из keys или size/font/color)
+        :return: (список уникальных значений, массив id значения для каждого спана)
+        """
+        pos = self._raw_keys.index(field)
+        value_index: Dict[Any, int] = {}
+        values: List[Any] = []
+        field_of_raw = np.empty(len(self._raw_values), dtype=np.int64)
+        for rid, raw in enumerate(self._raw_values):
+            v = raw[pos]
+            key = _hashable(v)
+            vid = value_index.get(key)
+            if vid is None:
+                vid = value_index[key] = len(values)
+                values.append(v)
+            field_of_raw[rid] = vid
+        return values, field_of_raw[self.raw_ids]
+
+    def rank_heading_candidates(self, levels: int = 3, **kwargs: Any) -> Tuple[Style, Dict[str, Any]]:
+        """
+        Ранжирует кандидатов на заголовки по уже посчитанным частотам.
+        Параметры — как у rank_heading_candidates.
+        """
+        return rank_heading_candidates(self.style_counts(), levels, **kwargs)
+
+
+def _hashable(value: Any) -> Any:
+    """Списки (например, цвет [r, g, b]) превращает в кортежи, чтобы значение годилось в ключ словаря."""
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    return value
 
 
 def rank_heading_candidates(
@@ -154,32 +306,22 @@ def rank_heading_candidates(
     size_w = float(size_weight) / w_sum if w_sum > 0 else 0.5
     freq_w = float(freq_weight) / w_sum if w_sum > 0 else 0.5
 
-    # Ряды для нормализации.
-    sizes = [float(s["size"]) for s, _ in candidates]
-    freqs = [int(c) for _, c in candidates]
-
-    size_min, size_max = min(sizes), max(sizes)
-    size_range = size_max - size_min
-    freq_max = max(freqs)
-    freq_range = float(freq_max)
-
-    def norm_size(x: float) -> float:
-        if size_range <= 0:
-            return 0.0
-        return (x - size_min) / size_range
-
-    def norm_freq(x: int) -> float:
-        if freq_range <= 0:
-            return 0.0
-        return x / freq_range
-
-    # Посчитаем score для каждого кандидата.
-    scored: List[Tuple[Style, int, float]] = []
-    for style, cnt in candidates:
-        s_norm = norm_size(float(style["size"]))
-        f_norm = norm_freq(int(cnt))
-        score = size_w * s_norm + freq_w * f_norm
-        scored.append((style, cnt, float(score)))
+    # Ряды для нормализации и score — векторно.
+    sizes = np.array([float(s["size"]) for s, _ in candidates], dtype=np.float64)
+    freqs = np.array([int(c) for _, c in candidates], dtype=np.float64)
+
+    size_min = float(sizes.min())
+    size_range = float(sizes.max()) - size_min
+    freq_range = float(freqs.max())
+
+    # Если разброс нулевой, признак даёт 0 вклад.
+    size_norm = (sizes - size_min) / size_range if size_range > 0 else np.zeros_like(sizes)
+    freq_norm = freqs / freq_range if freq_range > 0 else np.zeros_like(freqs)
+    scores = size_w * size_norm + freq_w * freq_norm
+
+    scored: List[Tuple[Style, int, float]] = [
+        (style, cnt, float(score)) for (style, cnt), score in zip(candidates, scores.tolist())
+    ]
 
     # Сортировка по score (desc), затем по size (desc), затем по font.
     scored.sort(key=lambda t: (t[2], float(t[0]["size"]), str(t[0].get("font", ""))), reverse=True)
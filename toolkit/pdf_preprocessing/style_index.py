@@ -0,0 +1,132 @@
+"""
+Скомпилированный индекс «стиль -> значение» (уровень заголовка, префикс "#"/"##"/...).
+
+Заменяет линейный перебор правил с допуском по size: стили группируются по точным полям
+(например, (font, color)), внутри группы размеры хранятся отсортированными и ищутся через bisect
+в окне ±size_tol. Результаты повторяющихся стилей мемоизируются, поэтому классификация спана
+стоит O(log n), а на практике — один поиск в словаре.
+"""
+from __future__ import annotations
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from toolkit.pdf_preprocessing.style_frequency import Style, _hashable
+
+# Запас для bisect-окна: окончательное сравнение |size - v| <= size_tol делается точно, как в _style_matches.
+_EPS = 1e-9
+
+
+class StyleIndex:
+    """
+    Индекс кандидатных стилей с допуском по size.
+
+    Семантика совпадает с последовательной проверкой _style_matches(style, candidate, size_tol=...)
+    по кандидатам в порядке приоритета: возвращается значение совпавшего кандидата
+    с наименьшим приоритетом (по умолчанию — порядок добавления).
+
+    Пример:
+        index = StyleIndex(size_tol=0.25)
+        index.add({"font": "Arial-Bold", "color": 0, "size": 18.0}, 1)
+        index.lookup({"font": "Arial-Bold", "color": 0, "size": 18.1})  # -> 1
+    """
+
+    def __init__(self, size_tol: float = 0.25, *, size_key: str = "size", memo_limit: int = 100_000) -> None:
+        """
+        :param size_tol: допустимое абсолютное отклонение по size (pt)
+        :param size_key: имя поля размера шрифта
+        :param memo_limit: максимум мемоизированных стилей (при переполнении мемо очищается)
+        """
+        self.size_tol = float(size_tol)
+        self.size_key = size_key
+        self.memo_limit = int(memo_limit)
+        # точные поля -> значения точных полей -> (отсортированные sizes, [(size, priority, value)])
+        self._sized: Dict[Tuple[str, ...], Dict[Tuple, Tuple[List[float], List[Tuple[float, int, Any]]]]] = {}
+        # кандидаты без size: точные поля -> значения -> (priority, value)
+        self._sizeless: Dict[Tuple[str, ...], Dict[Tuple, Tuple[int, Any]]] = {}
+        self._memo: Dict[Tuple, Any] = {}
+        self._next_priority = 0
+        self._all_keys: Tuple[str, ...] = ()
+
+    def __len__(self) -> int:
+        return self._next_priority
+
+    def add(self, style: Style, value: Any, priority: Optional[int] = None) -> None:
+        """
+        Добавляет кандидатный стиль.
+
+        :param style: стиль-кандидат (любой набор полей; size — с допуском, остальные — точно)
+        :param value: значение, возвращаемое при совпадении
+        :param priority: приоритет (меньше — важнее); по умолчанию — порядок добавления
+        """
+        if priority is None:
+            priority = self._next_priority
+        self._next_priority = max(self._next_priority, priority) + 1
+        self._memo.clear()
+
+        exact_keys = tuple(sorted(k for k in style if k != self.size_key))
+        self._all_keys = tuple(dict.fromkeys((*self._all_keys, *exact_keys, self.size_key)))
+        exact_values = tuple(_hashable(style[k]) for k in exact_keys)
+
+        if self.size_key not in style:
+            group = self._sizeless.setdefault(exact_keys, {})
+            prev = group.get(exact_values)
+            if prev is None or priority < prev[0]:
+                group[exact_values] = (priority, value)
+            return
+
+        size = style[self.size_key]
+        if not isinstance(size, (int, float)):
+            return  # как в _style_matches: нечисловой size кандидата не совпадает ни с чем
+        sizes, entries = self._sized.setdefault(exact_keys, {}).setdefault(exact_values, ([], []))
+        pos = bisect_right(sizes, float(size))
+        sizes.insert(pos, float(size))
+        entries.insert(pos, (float(size), priority, value))
+
+    def lookup(self, style: Style, default: Any = None) -> Any:
+        """
+        Значение лучшего (с наименьшим приоритетом) совпавшего кандидата или default.
+        """
+        memo_key = tuple(_hashable(style.get(k)) for k in self._all_keys)
+        try:
+            hit = self._memo[memo_key]
+        except KeyError:
+            hit = self._memo[memo_key] = self._lookup(style)
+            if len(self._memo) > self.memo_limit:
+                self._memo.clear()
+        except TypeError:  # нехэшируемое значение — без мемо
+            hit = self._lookup(style)
+        return default if hit is None else hit[1]
+
+    def _lookup(self, style: Style) -> Optional[Tuple[int, Any]]:
+        best: Optional[Tuple[int, Any]] = None
+
+        for exact_keys, group in self._sizeless.items():
+            found = group.get(tuple(_hashable(style.get(k)) for k in exact_keys))
+            if found is not None and (best is None or found[0] < best[0]):
+                best = found
+
+        size = style.get(self.size_key)
+        if isinstance(size, (int, float)) and self._sized:
+            s = float(size)
+            for exact_keys, group in self._sized.items():
+                bucket = group.get(tuple(_hashable(style.get(k)) for k in exact_keys))
+                if bucket is None:
+                    continue
+                sizes, entries = bucket
+                lo = bisect_left(sizes, s - self.size_tol - _EPS)
+                hi = bisect_right(sizes, s + self.size_tol + _EPS)
+                for cand_size, priority, value in entries[lo:hi]:
+                    if abs(s - cand_size) <= self.size_tol and (best is None or priority < best[0]):
+                        best = (priority, value)
+        return best
+
+    @classmethod
+    def from_levels(cls, levels: Sequence[Tuple[int, Sequence[Style]]], size_tol: float = 0.25) -> "StyleIndex":
+        """
+        Индекс «стиль -> номер уровня» из списка [(level_no, [style, ...]), ...] (уровни по возрастанию).
+        """
+        index = cls(size_tol)
+        for level_no, styles in levels:
+            for st in styles:
+                index.add(st, level_no)
+        return index
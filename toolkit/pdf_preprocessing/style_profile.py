@@ -0,0 +1,504 @@
+"""
+Сливаемый профиль частот стилей (StyleProfile).
+
+Профиль строится по диапазону страниц (например, в отдельном процессе), сливается с другими
+профилями ассоциативно и коммутативно, дополняется по мере поступления новых страниц
+и сохраняется на диск рядом с PDF. rank_heading_candidates работает по профилю напрямую,
+без сырых спанов.
+
+sample_style_profile — выборочный режим для больших книг: профиль строится по стратифицированной
+выборке страниц, пока назначение уровней заголовков не стабилизируется.
+"""
+from __future__ import annotations
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Dict, Tuple, List, Any, Optional, Sequence
+
+import numpy as np
+
+from toolkit.pdf_preprocessing.utilities import DEFAULT_STYLE_KEYS  # ("color", "font", "size")
+from toolkit.pdf_preprocessing.style_frequency import (
+    Span, Style, StyleCount, StyleStats, rank_heading_candidates, _hashable
+)
+
+# Позиция первого появления: (page_number, порядковый номер спана на странице)
+Position = Tuple[int, int]
+
+PROFILE_SUFFIX = "_style_profile.json"
+MAIN_TEXT_FIELDS: Tuple[str, str, str] = ("size", "font", "color")
+
+
+class StyleProfile:
+    """
+    Аккумулятор частот стилей, который можно строить частями и сливать.
+
+    Хранит:
+      - частоты канонических стилей (как count_styles) с позицией первого появления;
+      - частоты size/font/color по всем спанам (как get_main_text_properties);
+      - множество уже учтённых страниц — страница не может быть учтена дважды.
+
+    Позиция первого появления (page_number, номер спана на странице) нужна для детерминированного
+    выбора при равных частотах: merge(a, merge(b, c)) == merge(merge(a, b), c) == merge(c, b, a).
+
+    Пример:
+        profile = StyleProfile.from_spans(spans_part_1)
+        profile.merge(StyleProfile.from_spans(spans_part_2))
+        main_style, levels = profile.rank_heading_candidates(levels=5)
+    """
+
+    def __init__(
+            self,
+            keys: Tuple[str, ...] = DEFAULT_STYLE_KEYS,
+            *,
+            size_round: int | None = None,
+            skip_empty_text: bool = True,
+    ) -> None:
+        """
+        :param keys: поля, которые определяют стиль (по умолчанию color, font, size)
+        :param size_round: если задано, округляет size до указанного числа знаков
+        :param skip_empty_text: если True, спаны с пустым текстом не учитываются в частотах стилей
+        """
+        self.keys: Tuple[str, ...] = tuple(keys)
+        self.size_round = size_round
+        self.skip_empty_text = skip_empty_text
+        # hashable-ключ стиля -> [style_dict, count, first_position]
+        self._styles: Dict[Tuple, List[Any]] = {}
+        # поле -> hashable-значение -> [value, count, first_position]
+        self._fields: Dict[str, Dict[Any, List[Any]]] = {f: {} for f in MAIN_TEXT_FIELDS}
+        self.pages: set[int] = set()
+
+    # ───────────────────────────── построение ─────────────────────────────
+
+    @classmethod
+    def from_spans(
+            cls,
+            spans: Iterable[Span],
+            keys: Tuple[str, ...] = DEFAULT_STYLE_KEYS,
+            *,
+            size_round: int | None = None,
+            skip_empty_text: bool = True,
+    ) -> "StyleProfile":
+        """Строит профиль по спанам (все спаны одной страницы должны прийти в одном вызове)."""
+        profile = cls(keys, size_round=size_round, skip_empty_text=skip_empty_text)
+        profile.add_spans(spans)
+        return profile
+
+    def add_spans(self, spans: Iterable[Span]) -> "StyleProfile":
+        """
+        Добавляет в профиль спаны новых страниц (инкрементальное обновление).
+
+        :param spans: спаны с полем page_number; все спаны страницы — в одном вызове
+        :raises ValueError: если какая-то страница уже учтена в профиле
+        :return: self
+        """
+        spans = list(spans)
+        if not spans:
+            return self
+
+        pages = np.fromiter((int(s.get("page_number", 0) or 0) for s in spans), dtype=np.int64, count=len(spans))
+        new_pages = set(np.unique(pages).tolist())
+        overlap = new_pages & self.pages
+        if overlap:
+            raise ValueError(f"Страницы уже учтены в профиле: {sorted(overlap)[:10]}")
+
+        stats = StyleStats(spans, self.keys, size_round=self.size_round, skip_empty_text=self.skip_empty_text)
+
+        # Порядковый номер спана внутри своей страницы и порядок спанов по позиции (page, ordinal).
+        order = np.argsort(pages, kind="stable")
+        sorted_pages = pages[order]
+        starts = np.r_[0, np.flatnonzero(np.diff(sorted_pages)) + 1]
+        group_start = np.repeat(starts, np.diff(np.r_[starts, len(spans)]))
+        ordinal = np.empty(len(spans), dtype=np.int64)
+        ordinal[order] = np.arange(len(spans)) - group_start
+
+        # Частоты стилей (с учётом фильтра пустого текста).
+        style_order = order if stats.mask is None else order[stats.mask[order]]
+        counts = stats.counts()
+        _, first = np.unique(stats.style_ids[style_order], return_index=True)
+        for idx in style_order[first].tolist():
+            sid = int(stats.style_ids[idx])
+            self._add_style(stats.styles[sid], int(counts[sid]), (int(pages[idx]), int(ordinal[idx])))
+
+        # Частоты полей основного текста (по всем спанам).
+        for field in MAIN_TEXT_FIELDS:
+            values, ids = stats.field_ids(field)
+            field_counts = np.bincount(ids, minlength=len(values))
+            _, first = np.unique(ids[order], return_index=True)
+            for idx in order[first].tolist():
+                vid = int(ids[idx])
+                self._add_field_value(field, values[vid], int(field_counts[vid]), (int(pages[idx]), int(ordinal[idx])))
+
+        self.pages |= new_pages
+        return self
+
+    def merge(self, other: "StyleProfile") -> "StyleProfile":
+        """
+        Сливает другой профиль в текущий (ассоциативно и коммутативно).
+
+        :raises ValueError: если профили построены с разными параметрами или пересекаются по страницам
+        :return: self
+        """
+        if (self.keys, self.size_round, self.skip_empty_text) != (other.keys, other.size_round, other.skip_empty_text):
+            raise ValueError("Нельзя слить профили с разными keys/size_round/skip_empty_text")
+        overlap = self.pages & other.pages
+        if overlap:
+            raise ValueError(f"Профили пересекаются по страницам: {sorted(overlap)[:10]}")
+
+        for style, cnt, pos in other._styles.values():
+            self._add_style(style, cnt, pos)
+        for field, entries in other._fields.items():
+            for value, cnt, pos in entries.values():
+                self._add_field_value(field, value, cnt, pos)
+        self.pages |= other.pages
+        return self
+
+    @classmethod
+    def merged(cls, profiles: Iterable["StyleProfile"]) -> "StyleProfile":
+        """Сливает несколько профилей в новый профиль (исходные не изменяются)."""
+        result: Optional[StyleProfile] = None
+        for p in profiles:
+            if result is None:
+                result = cls(p.keys, size_round=p.size_round, skip_empty_text=p.skip_empty_text)
+            result.merge(p)
+        return result if result is not None else cls()
+
+    def _add_style(self, style: Style, count: int, pos: Position) -> None:
+        key = tuple(_hashable(style.get(k)) for k in self.keys)
+        entry = self._styles.get(key)
+        if entry is None:
+            self._styles[key] = [dict(style), count, pos]
+        else:
+            entry[1] += count
+            entry[2] = min(entry[2], pos)
+
+    def _add_field_value(self, field: str, value: Any, count: int, pos: Position) -> None:
+        key = _hashable(value)
+        entry = self._fields[field].get(key)
+        if entry is None:
+            self._fields[field][key] = [value, count, pos]
+        else:
+            entry[1] += count
+            entry[2] = min(entry[2], pos)
+
+    # ───────────────────────────── результаты ─────────────────────────────
+
+    def style_counts(self) -> List[StyleCount]:
+        """Частоты стилей в формате count_styles (отсортированы по убыванию частоты)."""
+        items = [(dict(style), int(cnt)) for style, cnt, _ in self._styles.values() if cnt > 0]
+
+        def sort_key(item: Tuple[Style, int]):
+            style, cnt = item
+            return -cnt, str(style.get("font")), float(style.get("size", 0)), style.get("color")
+
+        items.sort(key=sort_key)
+        return items
+
+    def main_text_properties(self) -> Dict[str, Any]:
+        """Наиболее частые size, font, color — как get_main_text_properties по спанам в порядке страниц."""
+        out: Dict[str, Any] = {}
+        for field in MAIN_TEXT_FIELDS:
+            entries = self._fields[field].values()
+            if not entries:
+                out[field] = None
+                continue
+            value, _, _ = min(entries, key=lambda e: (-e[1], e[2]))
+            out[field] = value
+        return out
+
+    def rank_heading_candidates(self, levels: int = 3, **kwargs: Any) -> Tuple[Style, Dict[str, Any]]:
+        """Ранжирует кандидатов на заголовки по профилю. Параметры — как у rank_heading_candidates."""
+        return rank_heading_candidates(self.style_counts(), levels, **kwargs)
+
+    @property
+    def total_spans(self) -> int:
+        """Число учтённых спанов (по полю size — учитываются все спаны, включая пустые)."""
+        return int(sum(cnt for _, cnt, _ in self._fields["size"].values()))
+
+    # ───────────────────────────── сериализация ─────────────────────────────
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "keys": list(self.keys),
+            "size_round": self.size_round,
+            "skip_empty_text": self.skip_empty_text,
+            "pages": sorted(self.pages),
+            "styles": [
+                {"style": style, "count": cnt, "first": list(pos)}
+                for style, cnt, pos in self._styles.values()
+            ],
+            "fields": {
+                field: [{"value": value, "count": cnt, "first": list(pos)} for value, cnt, pos in entries.values()]
+                for field, entries in self._fields.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "StyleProfile":
+        profile = cls(
+            tuple(data.get("keys", DEFAULT_STYLE_KEYS)),
+            size_round=data.get("size_round"),
+            skip_empty_text=bool(data.get("skip_empty_text", True)),
+        )
+        for item in data.get("styles", []):
+            profile._add_style(item["style"], int(item["count"]), tuple(item["first"]))
+        for field, entries in data.get("fields", {}).items():
+            for item in entries:
+                profile._add_field_value(field, item["value"], int(item["count"]), tuple(item["first"]))
+        profile.pages = set(int(p) for p in data.get("pages", []))
+        return profile
+
+    def save(self, filepath: str) -> bool:
+        from utils.general import save_json
+        return save_json(self.to_dict(), filepath)
+
+    @classmethod
+    def load(cls, filepath: str) -> Optional["StyleProfile"]:
+        from utils.general import load_json
+        data = load_json(filepath)
+        return cls.from_dict(data) if isinstance(data, dict) else None
+
+
+def profile_path_for(pdf_path: str) -> str:
+    """Путь к файлу профиля рядом с PDF: 'book.pdf' -> 'book_style_profile.json'."""
+    return os.path.splitext(pdf_path)[0] + PROFILE_SUFFIX
+
+
+# ───────────────────────────── построение по PDF ─────────────────────────────
+
+def profile_pages(
+        pdf_path: str,
+        page_numbers: Sequence[int],
+        keys: Tuple[str, ...] = DEFAULT_STYLE_KEYS,
+        size_round: int | None = None,
+        strip_running: bool = False,
+        extraction_profile: str = "fast",
+) -> StyleProfile:
+    """
+    Профиль по диапазону страниц PDF (1-based). Функция верхнего уровня — пригодна для ProcessPoolExecutor.
+    Порядок спанов статистике не важен, поэтому по умолчанию — профиль извлечения "fast" (без картинок).
+
+    Бегущие элементы по умолчанию не удаляются: повторы внутри диапазона зависят от того, как книга
+    разбита на диапазоны, и слитые профили перестали бы совпадать с профилем всей книги. strip_running —
+    только для профиля, который не сливается с другими; профиль без колонтитулов по всей книге —
+    StyleProfile.from_spans(create_spans(pdf_path)).
+    """
+    from toolkit.pdf_preprocessing.span_creator import extract_spans
+    from toolkit.pdf_preprocessing.running_elements import strip_running_spans
+
+    spans = extract_spans(pdf_path, list(page_numbers), profile=extraction_profile)
+    if strip_running:
+        spans, _ = strip_running_spans(spans)
+    profile = StyleProfile.from_spans(spans, keys, size_round=size_round)
+    # Пустые страницы тоже считаются учтёнными, чтобы не извлекать их повторно.
+    profile.pages |= set(int(p) for p in page_numbers)
+    return profile
+
+
+def build_style_profile(
+        pdf_path: str,
+        page_numbers: Optional[Sequence[int]] = None,
+        *,
+        keys: Tuple[str, ...] = DEFAULT_STYLE_KEYS,
+        size_round: int | None = None,
+        pages_per_task: int = 25,
+        max_workers: Optional[int] = None,
+        base: Optional[StyleProfile] = None,
+) -> StyleProfile:
+    """
+    Строит профиль стилей PDF, распределяя диапазоны страниц по процессам и сливая частичные профили.
+
+    :param pdf_path: путь к PDF
+    :param page_numbers: номера страниц (1-based); None — все страницы документа
+    :param keys: поля, которые определяют стиль
+    :param size_round: если задано, округляет size до указанного числа знаков
+    :param pages_per_task: сколько страниц обрабатывает один воркер за задачу
+    :param max_workers: число процессов (None — по числу ядер; 1 — без пула)
+    :param base: уже накопленный профиль; его страницы повторно не извлекаются
+    :return: объединённый профиль
+    """
+    if page_numbers is None:
+        import fitz  # PyMuPDF
+        with fitz.open(pdf_path) as doc:
+            page_numbers = list(range(1, doc.page_count + 1))
+
+    profile = base if base is not None else StyleProfile(keys, size_round=size_round)
+    todo = [p for p in page_numbers if p not in profile.pages]
+    if not todo:
+        return profile
+
+    step = max(1, int(pages_per_task))
+    ranges = [todo[i:i + step] for i in range(0, len(todo), step)]
+
+    if max_workers == 1 or len(ranges) == 1:
+        parts = [profile_pages(pdf_path, r, profile.keys, profile.size_round) for r in ranges]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            parts = list(pool.map(
+                profile_pages,
+                [pdf_path] * len(ranges),
+                ranges,
+                [profile.keys] * len(ranges),
+                [profile.size_round] * len(ranges),
+            ))
+
+    for part in parts:
+        profile.merge(part)
+    return profile
+
+
+def load_or_build_style_profile(
+        pdf_path: str,
+        page_numbers: Optional[Sequence[int]] = None,
+        *,
+        save: bool = True,
+        **kwargs: Any,
+) -> StyleProfile:
+    """
+    Загружает сохранённый рядом с PDF профиль, дополняет его недостающими страницами и сохраняет обратно.
+
+    :param pdf_path: путь к PDF
+    :param page_numbers: какие страницы должны быть учтены (None — все)
+    :param save: сохранять ли обновлённый профиль
+    :param kwargs: параметры build_style_profile (keys, size_round, pages_per_task, max_workers)
+    """
+    path = profile_path_for(pdf_path)
+    base = StyleProfile.load(path) if os.path.isfile(path) else None
+    if base is not None and (base.keys, base.size_round) != (
+            tuple(kwargs.get("keys", base.keys)), kwargs.get("size_round", base.size_round)):
+        base = None  # параметры поменялись — профиль пересчитывается
+    before = set(base.pages) if base is not None else set()
+
+    profile = build_style_profile(pdf_path, page_numbers, base=base, **kwargs)
+    if save and profile.pages != before:
+        profile.save(path)
+    return profile
+
+
+def level_assignment(main_style: Style, levels_dict: Dict[str, Any], keys: Sequence[str] = DEFAULT_STYLE_KEYS) -> Tuple:
+    """
+    Хэшируемая «подпись» результата rank_heading_candidates: основной стиль и множества стилей по уровням.
+    Две подписи равны, если уровни заголовков назначены одинаково.
+    """
+    def style_key(st: Style) -> Tuple:
+        return tuple(_hashable(st.get(k)) for k in keys)
+
+    return (
+        style_key(main_style),
+        tuple(
+            (int(lvl.get("level", 0)), frozenset(style_key(item.get("style", {})) for item in lvl.get("items", [])))
+            for lvl in levels_dict.get("levels", [])
+        ),
+    )
+
+
+def sample_style_profile(
+        pdf_path: str,
+        *,
+        levels: int = 3,
+        rank_kwargs: Optional[Dict[str, Any]] = None,
+        pages_per_round: int = 12,
+        patience: int = 2,
+        max_pages: Optional[int] = None,
+        seed: int = 0,
+        keys: Tuple[str, ...] = DEFAULT_STYLE_KEYS,
+        size_round: int | None = None,
+        max_workers: Optional[int] = 1,
+) -> Tuple[StyleProfile, Dict[str, Any]]:
+    """
+    Выборочный профиль стилей: вместо всех страниц извлекается стратифицированная случайная выборка,
+    которая растёт, пока назначение уровней от rank_heading_candidates не перестанет меняться.
+
+    Книга делится на pages_per_round равных страт; в каждом раунде из каждой страты берётся одна ещё
+    не просмотренная случайная страница. После раунда уровни пересчитываются по накопленному профилю;
+    если подпись level_assignment не менялась patience раундов подряд — выборка сошлась.
+
+    :param pdf_path: путь к PDF
+    :param levels: число уровней заголовков (как в rank_heading_candidates)
+    :param rank_kwargs: прочие параметры rank_heading_candidates (min_size_diff, per_level_limit, ...)
+    :param pages_per_round: сколько страниц добавляется за раунд (= число страт)
+    :param patience: сколько раундов подряд назначение уровней должно оставаться неизменным
+    :param max_pages: верхняя граница выборки (None — без ограничения, вплоть до всей книги)
+    :param seed: зерно генератора случайных чисел (для воспроизводимости)
+    :param keys: поля, которые определяют стиль
+    :param size_round: если задано, округляет size до указанного числа знаков
+    :param max_workers: процессы для извлечения страниц раунда (1 — в текущем процессе)
+    :return: (профиль, сводка {"converged", "rounds", "pages_sampled", "pages_total"})
+    """
+    import fitz  # PyMuPDF
+
+    with fitz.open(pdf_path) as doc:
+        total = doc.page_count
+    rank_kwargs = dict(rank_kwargs or {})
+    limit = total if max_pages is None else min(total, int(max_pages))
+
+    # Страты: равные диапазоны страниц, внутри каждой — случайный порядок обхода.
+    n_strata = max(1, min(int(pages_per_round), total))
+    rng = np.random.default_rng(seed)
+    bounds = np.linspace(1, total + 1, n_strata + 1).astype(int)
+    strata = [rng.permutation(np.arange(lo, hi)).tolist() for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+    profile = StyleProfile(keys, size_round=size_round)
+    prev_signature: Optional[Tuple] = None
+    stable_rounds = 0
+    rounds = 0
+    converged = False
+
+    while len(profile.pages) < limit:
+        batch = [stratum.pop() for stratum in strata if stratum][:limit - len(profile.pages)]
+        if not batch:
+            break
+        rounds += 1
+        # страницы раунда делятся между процессами поровну (не одна задача на раунд)
+        per_task = -(-len(batch) // max(1, max_workers or os.cpu_count() or 1))
+        build_style_profile(pdf_path, sorted(batch), base=profile, pages_per_task=per_task, max_workers=max_workers)
+
+        signature = level_assignment(*profile.rank_heading_candidates(levels, **rank_kwargs), keys=keys)
+        if signature == prev_signature:
+            stable_rounds += 1
+            if stable_rounds >= patience:
+                converged = True
+                break
+        else:
+            stable_rounds = 0
+        prev_signature = signature
+
+    summary = {
+        "converged": converged or len(profile.pages) >= total,
+        "rounds": rounds,
+        "pages_sampled": len(profile.pages),
+        "pages_total": total,
+    }
+    return profile, summary
+
+
+# ===== Пример использования =====
+if __name__ == "__main__":
+    from time import perf_counter
+    from utils.formatting import format_time
+
+    PDF_BOOKS_DIR = "../../data/med_sources"
+    PDF_FILES = ("Guide-to-Common-Childhood-Infections-2023_Final-Approved.pdf",
+                 "Easy Paediatrics.pdf",
+                 "Manual_of_childhood_infections.pdf")
+    PDF_FILE = PDF_FILES[1]
+    pdf_path_ = os.path.join(PDF_BOOKS_DIR, PDF_FILE)
+
+    t1 = perf_counter()
+    profile_ = load_or_build_style_profile(pdf_path_, size_round=1)
+    t2 = perf_counter()
+    print(f"Профиль: {len(profile_.pages)} стр., {profile_.total_spans} спанов за {format_time(t2 - t1)}")
+    print("Основной текст:", profile_.main_text_properties())
+
+    main_style_, heading_levels_ = profile_.rank_heading_candidates(levels=5, per_level_limit=5, include_scores=True)
+    print("Основной стиль:", main_style_)
+    for level_ in heading_levels_["levels"]:
+        print(f"Уровень {level_['level']}: {[item['style'] for item in level_['items']]}")
+
+    # Выборочный режим: уровни заголовков по нескольким десяткам страниц вместо всей книги
+    t1 = perf_counter()
+    sampled_, summary_ = sample_style_profile(pdf_path_, levels=5, rank_kwargs={"per_level_limit": 5}, size_round=1)
+    t2 = perf_counter()
+    print(f"Выборка: {summary_} за {format_time(t2 - t1)}")
+    same_ = level_assignment(*sampled_.rank_heading_candidates(5, per_level_limit=5)) == \
+        level_assignment(*profile_.rank_heading_candidates(5, per_level_limit=5))
+    print("Совпадает с полным профилем:", same_)
@@ -1,7 +1,6 @@
 import re
 import unicodedata
 from typing import Any, Tuple, List, Dict, Union, Final
-from collections import Counter
 
 
 # Константа для базового набора ключей стиля
@@ -67,34 +66,13 @@ def normalize_text(text: str) -> str:
 def get_main_text_properties(all_spans: List[Dict[str, Any]]) -> Dict[str, any]:
     """
     Определяет размер шрифта и цвет основного текста на основе частоты их появления.
-    Возвращает словарь с наиболее частыми размером шрифта и цветом.
+    Возвращает словарь с наиболее частыми размером шрифта и цветом (подсчёт — через StyleStats).
     {'color': '#000000', 'font': 'Calibri', 'size': 9.960000038146973}
     """
-    font_sizes = []
-    fonts = []
-    colors = []
-
-    # Собираем все размеры шрифта и цвета из спанов
-    for span in all_spans:
-        font_sizes.append(span["size"])
-        fonts.append(span["font"])
-        colors.append(span["color"])
-
-    # Подсчитываем частоту
-    size_counter = Counter(font_sizes)
-    font_counter = Counter(fonts)
-    color_counter = Counter(colors)
-
-    # Определяем наиболее частые значения
-    main_font_size = size_counter.most_common(1)[0][0] if size_counter else None
-    main_font = font_counter.most_common(1)[0][0] if font_counter else None
-    main_color = color_counter.most_common(1)[0][0] if color_counter else None
-
-    return {
-        "size": main_font_size,
-        "font": main_font,
-        "color": main_color
-    }
+    # Ленивый импорт: style_frequency сам импортирует этот модуль.
+    from toolkit.pdf_preprocessing.style_frequency import StyleStats
+
+    return StyleStats(all_spans, skip_empty_text=False).main_text_properties()
 
 
 def rgb_to_hex(color: Union[int, List[float], tuple, None], is_background: bool = False) -> str:
@@ -0,0 +1,203 @@
+"""
+bm25_index.py
+
+Персистентный инвертированный индекс BM25 по текстам узлов llama-index (SQLite, bm25.sqlite в директории
+индекса). Дополняет векторный поиск точными совпадениями: названия препаратов, дозировки, редкие диагнозы.
+
+Хранится только словарь постингов (term, doc, tf) и длины документов; тексты узлов остаются в индексе.
+Индекс обновляется инкрементально вместе с векторным (add / delete_ref_doc в medreader/index_creator.py);
+для индекса, созданного до появления BM25, он строится при первом обращении (ensure_bm25_index).
+
+Пример:
+    bm25 = BM25Index(os.path.join(PERSISTED_INDEX_DIR, BM25_FILE))
+    bm25.add(nodes)
+    bm25.search("amoxicillin 40 mg/kg", top_k=20)   # [(node_id, score), ...]
+"""
+from __future__ import annotations
+import os
+import re
+import math
+import heapq
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+BM25_FILE = "bm25.sqlite"
+_SQL_BATCH = 500
+
+# составные токены (0.5, mg/kg, co-amoxiclav) индексируются целиком и по частям
+_TOKEN_RE = re.compile(r"[^\W_]+(?:[.,/\-][^\W_]+)*")
+_PART_RE = re.compile(r"[^\W_]+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were which with "
+    "what how when who whom why does do can should may".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Токены BM25: NFKC, нижний регистр, без стоп-слов; составной токен плюс его части."""
+    tokens: List[str] = []
+    for token in _TOKEN_RE.findall(unicodedata.normalize("NFKC", text or "").lower()):
+        parts = _PART_RE.findall(token)
+        if len(parts) > 1:
+            tokens.append(token)
+        tokens.extend(p for p in parts if p not in STOPWORDS)
+    return tokens
+
+
+class BM25Index:
+    """
+    Инвертированный индекс BM25 (Okapi, k1/b) в SQLite. Потокобезопасен в пределах процесса.
+    """
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75) -> None:
+        """
+        :param path: файл SQLite
+        :param k1: насыщение частоты термина
+        :param b: нормализация по длине документа
+        """
+        self.path = path
+        self.k1 = float(k1)
+        self.b = float(b)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS docs (
+                doc INTEGER PRIMARY KEY,
+                node_id TEXT UNIQUE NOT NULL,
+                ref_doc_id TEXT,
+                length INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS docs_ref_doc ON docs (ref_doc_id);
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                doc INTEGER NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term, doc)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc);
+            """
+        )
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, **kwargs: Any) -> "BM25Index":
+        return cls(os.path.join(persist_dir, BM25_FILE), **kwargs)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return int(self._conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0])
+
+    def _delete_docs(self, docs: List[int]) -> None:
+        for start in range(0, len(docs), _SQL_BATCH):
+            part = docs[start:start + _SQL_BATCH]
+            marks = ",".join("?" * len(part))
+            self._conn.execute(f"DELETE FROM postings WHERE doc IN ({marks})", part)
+            self._conn.execute(f"DELETE FROM docs WHERE doc IN ({marks})", part)
+
+    def _docs_where(self, column: str, values: Sequence[Any]) -> List[int]:
+        docs: List[int] = []
+        values = list(values)
+        for start in range(0, len(values), _SQL_BATCH):
+            part = values[start:start + _SQL_BATCH]
+            docs.extend(d for (d,) in self._conn.execute(
+                f"SELECT doc FROM docs WHERE {column} IN ({','.join('?' * len(part))})", part))
+        return docs
+
+    def add(self, nodes: Iterable[Any]) -> int:
+        """
+        Индексирует узлы (node_id, ref_doc_id, get_content()); узел с тем же node_id заменяется.
+
+        :return: число добавленных узлов
+        """
+        nodes = list(nodes)
+        if not nodes:
+            return 0
+        with self._lock:
+            self._delete_docs(self._docs_where("node_id", [n.node_id for n in nodes]))
+            for node in nodes:
+                counts = Counter(tokenize(node.get_content()))
+                cur = self._conn.execute("INSERT INTO docs (node_id, ref_doc_id, length) VALUES (?, ?, ?)",
+                                         (node.node_id, node.ref_doc_id, sum(counts.values())))
+                self._conn.executemany("INSERT INTO postings (term, doc, tf) VALUES (?, ?, ?)",
+                                       [(term, cur.lastrowid, tf) for term, tf in counts.items()])
+            self._conn.commit()
+        return len(nodes)
+
+    def delete_ref_doc(self, ref_doc_id: str) -> int:
+        """Удаляет узлы документа; возвращает их число."""
+        with self._lock:
+            docs = self._docs_where("ref_doc_id", [ref_doc_id])
+            self._delete_docs(docs)
+            self._conn.commit()
+        return len(docs)
+
+    def delete_nodes(self, node_ids: Sequence[str]) -> int:
+        """Удаляет узлы по node_id; возвращает их число."""
+        with self._lock:
+            docs = self._docs_where("node_id", node_ids)
+            self._delete_docs(docs)
+            self._conn.commit()
+        return len(docs)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM postings")
+            self._conn.execute("DELETE FROM docs")
+            self._conn.commit()
+
+    def search(self, query: str, top_k: int = 20) -> List[Tuple[str, float]]:
+        """
+        Лучшие узлы по BM25.
+
+        :return: [(node_id, score)] по убыванию score
+        """
+        terms = sorted(set(tokenize(query)))
+        if not terms or top_k <= 0:
+            return []
+        with self._lock:
+            n_docs, total_len = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs").fetchone()
+            if not n_docs:
+                return []
+            avgdl = max(total_len / n_docs, 1.0)
+            marks = ",".join("?" * len(terms))
+            df = dict(self._conn.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE term IN ({marks}) GROUP BY term", terms))
+            idf = {t: math.log(1.0 + (n_docs - d + 0.5) / (d + 0.5)) for t, d in df.items()}
+            scores: Dict[int, float] = {}
+            for term, doc, tf, length in self._conn.execute(
+                    f"SELECT p.term, p.doc, p.tf, d.length FROM postings p JOIN docs d ON d.doc = p.doc "
+                    f"WHERE p.term IN ({marks})", terms):
+                norm = self.k1 * (1.0 - self.b + self.b * length / avgdl)
+                scores[doc] = scores.get(doc, 0.0) + idf[term] * tf * (self.k1 + 1.0) / (tf + norm)
+            best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+            node_ids = dict(self._conn.execute(
+                f"SELECT doc, node_id FROM docs WHERE doc IN ({','.join('?' * len(best))})",
+                [doc for doc, _ in best])) if best else {}
+        return [(node_ids[doc], score) for doc, score in best if doc in node_ids]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def index_nodes(index: Any) -> List[Any]:
+    """Все узлы индекса llama-index: из docstore или (stores_text, например MmapVectorStore) из хранилища."""
+    nodes = list(index.docstore.docs.values())
+    if not nodes and getattr(index.vector_store, "stores_text", False):
+        nodes = list(index.vector_store.get_nodes())
+    return nodes
+
+
+def ensure_bm25_index(index: Any, persist_dir: str, bm25: Optional[BM25Index] = None) -> BM25Index:
+    """BM25-индекс директории индекса; пустой строится по всем узлам индекса."""
+    bm25 = bm25 or BM25Index.from_persist_dir(persist_dir)
+    if len(bm25) == 0:
+        nodes = index_nodes(index)
+        if nodes:
+            print(f"BM25: индексируется {len(nodes)} узлов")
+            bm25.add(nodes)
+    return bm25
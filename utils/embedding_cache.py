@@ -0,0 +1,413 @@
+"""
+embedding_cache.py
+
+Персистентный кэш эмбеддингов текстов, общий для матчинга заголовков, связывания чанков и индексации.
+
+Ключ — (имя модели, sha1 нормализованного текста). Векторы хранятся в float16 в memory-mapped файле
+(vectors.f16), соответствие ключ -> строка и время последнего обращения — в снимке index.json
+и журнале index.log. При превышении лимита размера вытесняются давно не использованные (LRU) векторы.
+
+Кэш общий для нескольких процессов (индексатор, сервис запросов, матчинг заголовков): выделение строк,
+запись векторов и журнала, а также чтение выполняются под файловой блокировкой (cache.lock). Новые записи
+put_many дописывает в журнал одной строкой (стоимость — по размеру пачки, а не кэша); другие процессы
+дочитывают журнал с места, где остановились, и перечитывают снимок, если его переписали. Снимок
+(со временем обращений LRU) переписывается в flush(), когда обращений накопилось много, и когда журнал
+вырос до LOG_COMPACT_LINES строк; журнал после этого обнуляется.
+
+Пример:
+    cache = EmbeddingCache("storage/embedding_cache", "all-MiniLM-L6-v2", dim=384)
+    vectors = cache.encode(texts, lambda batch: model.encode(batch, normalize_embeddings=True))
+    cache.flush()
+"""
+from __future__ import annotations
+import os
+import re
+import json
+import hashlib
+import threading
+import unicodedata
+from functools import lru_cache
+from typing import Callable, Dict, List, Literal, Optional, Sequence, Tuple
+
+import numpy as np
+from filelock import FileLock
+
+VECTORS_FILE = "vectors.f16"
+INDEX_FILE = "index.json"
+LOG_FILE = "index.log"
+LOCK_FILE = "cache.lock"
+# flush() без force пишет время обращений, только если обращений к разным ключам накопилось не меньше
+TICKS_FLUSH_MIN = 256
+# после стольких строк журнала put_many переписывает снимок index.json (амортизированно O(1) на запись)
+LOG_COMPACT_LINES = 1024
+
+
+def normalize_cache_text(text: str) -> str:
+    """Нормализация текста для ключа кэша: Unicode NFC, схлопывание пробельных символов, strip."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text or "")).strip()
+
+
+def text_key(text: str) -> str:
+    """sha1 нормализованного текста (hex)."""
+    return hashlib.sha1(normalize_cache_text(text).encode("utf-8")).hexdigest()
+
+
+STBackend = Literal["torch", "onnx", "onnx-int8"]
+
+
+def _st_backend(backend: Optional[str]) -> str:
+    if backend is None:
+        from settings import ST_BACKEND
+        backend = ST_BACKEND
+    if backend not in ("torch", "onnx", "onnx-int8"):
+        raise ValueError(f"Неизвестный backend SentenceTransformer: {backend} (torch, onnx, onnx-int8)")
+    return backend
+
+
+def st_cache_name(model_name: str = "all-MiniLM-L6-v2", backend: Optional[str] = None) -> str:
+    """
+    Имя модели для ключа EmbeddingCache: векторы int8-модели отличаются от fp32 и хранятся отдельно.
+    """
+    return f"{model_name}@int8" if _st_backend(backend) == "onnx-int8" else model_name
+
+
+class EmbeddingCache:
+    """
+    Персистентный LRU-кэш эмбеддингов одной модели.
+
+    Потокобезопасен в пределах процесса и безопасен для нескольких процессов с общей директорией
+    (файловая блокировка). Новые векторы и журнал пишутся на диск сразу, время обращений — лениво (flush()).
+    """
+
+    def __init__(
+            self,
+            cache_dir: str,
+            model_name: str,
+            dim: int,
+            *,
+            max_bytes: int = 256 * 1024 * 1024,
+            initial_rows: int = 1024,
+    ) -> None:
+        """
+        :param cache_dir: корневая директория кэша (для модели создаётся своя поддиректория)
+        :param model_name: имя модели — часть ключа
+        :param dim: размерность эмбеддингов модели
+        :param max_bytes: лимит размера файла векторов; сверх него вытесняются LRU-записи
+        :param initial_rows: начальная ёмкость файла векторов (растёт удвоением)
+        """
+        self.model_name = model_name
+        self.dim = int(dim)
+        self.max_rows = max(1, int(max_bytes) // (self.dim * 2))
+        self.path = os.path.join(cache_dir, re.sub(r"[^\w.\-]+", "_", model_name))
+        self._lock = threading.RLock()
+        self._entries: Dict[str, List[int]] = {}  # key -> [row, last_used]
+        self._free: List[int] = []
+        self._tick = 0
+        self._touched: Dict[str, int] = {}  # key -> last_used, ещё не записанные в index.json
+        self._disk_stamp: Optional[Tuple[int, int]] = None
+        self._log_offset = 0  # сколько байт журнала уже применено
+        self._log_lines = 0  # строк журнала после последнего снимка
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self._index_path = os.path.join(self.path, INDEX_FILE)
+        self._log_path = os.path.join(self.path, LOG_FILE)
+        self._file_lock = FileLock(os.path.join(self.path, LOCK_FILE))
+        with self._file_lock:
+            self._vectors = self._open(min(int(initial_rows), self.max_rows))
+            self._reload_locked()
+            self._rebuild_free()
+
+    # ───────────────────────────── хранилище ─────────────────────────────
+
+    def _open(self, capacity: int) -> np.memmap:
+        """Открывает (или создаёт/расширяет) memory-mapped файл векторов на capacity строк."""
+        vec_path = os.path.join(self.path, VECTORS_FILE)
+        size = capacity * self.dim * 2
+        mode = "r+" if os.path.isfile(vec_path) else "w+"
+        if mode == "r+" and os.path.getsize(vec_path) < size:
+            with open(vec_path, "r+b") as fp:
+                fp.truncate(size)
+        return np.memmap(vec_path, dtype=np.float16, mode=mode, shape=(capacity, self.dim))
+
+    @property
+    def capacity(self) -> int:
+        return int(self._vectors.shape[0])
+
+    def _stamp(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self._index_path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _rebuild_free(self) -> None:
+        used = {row for row, _ in self._entries.values()}
+        self._free = [r for r in range(self.capacity - 1, -1, -1) if r not in used]
+
+    def _reload_locked(self) -> bool:
+        """
+        Приводит индекс к состоянию на диске (вызывается под файловой блокировкой): перечитывает снимок
+        index.json, если его переписал другой процесс, и применяет новые строки журнала.
+        Незаписанное время обращений переносится на перечитанные записи.
+
+        :return: True, если что-то изменилось
+        """
+        changed = False
+        stamp = self._stamp()
+        if stamp is not None and stamp != self._disk_stamp:
+            with open(self._index_path, "r", encoding="utf-8") as fp:
+                meta = json.load(fp)
+            self._disk_stamp = stamp
+            self._log_offset = self._log_lines = 0
+            if meta.get("dim") == self.dim and meta.get("model_name") == self.model_name:
+                self._entries = {k: list(v) for k, v in meta.get("entries", {}).items()}
+                for key, tick in self._touched.items():
+                    entry = self._entries.get(key)
+                    if entry is not None:
+                        entry[1] = max(entry[1], tick)
+                self._tick = max(self._tick, int(meta.get("tick", 0)))
+                self._ensure_capacity(int(meta.get("capacity", 0)))
+                changed = True
+        changed = self._read_log_locked() or changed
+        if changed:
+            self._rebuild_free()
+        return changed
+
+    def _read_log_locked(self) -> bool:
+        """Применяет строки журнала, дописанные после _log_offset. Строка назначает ключам строки файла векторов."""
+        try:
+            size = os.path.getsize(self._log_path)
+        except FileNotFoundError:
+            return False
+        if size < self._log_offset:
+            self._log_offset = 0  # журнал обнулён при записи снимка, который не удалось отличить по stamp
+        if size <= self._log_offset:
+            return False
+        with open(self._log_path, "r", encoding="utf-8") as fp:
+            fp.seek(self._log_offset)
+            lines = fp.readlines()
+            self._log_offset = fp.tell()
+        owners = {row: key for key, (row, _) in self._entries.items()}
+        for line in lines:
+            record = json.loads(line)
+            self._log_lines += 1
+            self._ensure_capacity(int(record.get("capacity", 0)))
+            tick = int(record.get("tick", 0))
+            self._tick = max(self._tick, tick)
+            for key, row in record.get("entries", {}).items():
+                previous = owners.get(row)
+                if previous is not None and previous != key:
+                    self._entries.pop(previous, None)  # строку вытеснил и переназначил другой процесс
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] != row:
+                    owners.pop(entry[0], None)
+                self._entries[key] = [row, max(tick, entry[1] if entry is not None else 0)]
+                owners[row] = key
+        return True
+
+    def _append_log_locked(self, rows: Dict[str, int]) -> None:
+        """Дописывает в журнал назначенные строки (после записи векторов, под файловой блокировкой)."""
+        self._vectors.flush()
+        line = json.dumps({"tick": self._tick, "capacity": self.capacity, "entries": rows}) + "\n"
+        with open(self._log_path, "a", encoding="utf-8") as fp:
+            fp.write(line)
+            self._log_offset = fp.tell()
+        self._log_lines += 1
+
+    def _ensure_capacity(self, capacity: int) -> None:
+        """Переоткрывает файл векторов, если другой процесс его расширил."""
+        if capacity > self.capacity:
+            self._vectors.flush()
+            del self._vectors
+            self._vectors = self._open(capacity)
+
+    def _write_index_locked(self) -> None:
+        """
+        Атомарно записывает снимок index.json и обнуляет журнал (под файловой блокировкой,
+        после _reload_locked: журнал уже применён).
+        """
+        self._vectors.flush()
+        meta = {
+            "model_name": self.model_name,
+            "dim": self.dim,
+            "capacity": self.capacity,
+            "tick": self._tick,
+            "entries": self._entries,
+        }
+        tmp_path = f"{self._index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fp:
+            json.dump(meta, fp)
+        os.replace(tmp_path, self._index_path)
+        open(self._log_path, "w").close()
+        self._disk_stamp = self._stamp()
+        self._log_offset = self._log_lines = 0
+        self._touched.clear()
+
+    def _grow(self, need: int) -> None:
+        """Расширяет файл векторов (удвоением, но не выше max_rows)."""
+        old = self.capacity
+        new = min(self.max_rows, max(old * 2, old + need))
+        if new <= old:
+            return
+        self._vectors.flush()
+        del self._vectors
+        self._vectors = self._open(new)
+        self._free.extend(range(new - 1, old - 1, -1))
+
+    def _evict(self, count: int, protected: set) -> None:
+        """Вытесняет count давно не использованных записей (LRU), не трогая ключи из protected."""
+        victims = sorted(
+            ((k, v) for k, v in self._entries.items() if k not in protected), key=lambda kv: kv[1][1]
+        )[:count]
+        for key, (row, _) in victims:
+            del self._entries[key]
+            self._free.append(row)
+
+    # ───────────────────────────── API ─────────────────────────────
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, text: str) -> bool:
+        return text_key(text) in self._entries
+
+    def get_many(self, texts: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Пакетное чтение.
+
+        :param texts: тексты
+        :return: (матрица float32 (len(texts), dim) — нули для промахов, маска найденных)
+        """
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        found = np.zeros(len(texts), dtype=bool)
+        keys = [text_key(t) for t in texts]
+        # под файловой блокировкой: другой процесс не переназначит строку между проверкой индекса и чтением
+        with self._lock, self._file_lock:
+            self._reload_locked()
+            self._tick += 1
+            rows: List[int] = []
+            positions: List[int] = []
+            for i, key in enumerate(keys):
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                entry[1] = self._tick
+                self._touched[key] = self._tick  # на диск — лениво (put_many / flush)
+                rows.append(entry[0])
+                positions.append(i)
+            if rows:
+                out[positions] = self._vectors[rows]
+                found[positions] = True
+            self.hits += len(rows)
+            self.misses += len(texts) - len(rows)
+        return out, found
+
+    def put_many(self, texts: Sequence[str], vectors: np.ndarray) -> None:
+        """
+        Пакетная запись (перезаписывает существующие ключи). Строки выделяются по актуальному индексу
+        под файловой блокировкой; векторы и строка журнала записываются сразу, снимок index.json —
+        раз в LOG_COMPACT_LINES записей.
+
+        :param texts: тексты
+        :param vectors: матрица (len(texts), dim)
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(texts), self.dim)
+        # последний вектор для повторяющегося ключа
+        batch: Dict[str, int] = {text_key(t): i for i, t in enumerate(texts)}
+        if len(batch) > self.max_rows:
+            batch = dict(list(batch.items())[-self.max_rows:])
+        with self._lock, self._file_lock:
+            self._reload_locked()
+            self._tick += 1
+            new_keys = [k for k in batch if k not in self._entries]
+            if len(new_keys) > len(self._free):
+                self._grow(len(new_keys) - len(self._free))
+            if len(new_keys) > len(self._free):
+                protected = set(batch)
+                # вытесняем с запасом 10%, чтобы не вытеснять на каждой записи
+                overflow = len(new_keys) - len(self._free)
+                extra = max(overflow, self.max_rows // 10)
+                candidates = len(self._entries) - len(protected & set(self._entries))
+                self._evict(min(extra, candidates), protected)
+            assigned: Dict[str, int] = {}
+            src: List[int] = []
+            for key, i in batch.items():
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = self._entries[key] = [self._free.pop(), self._tick]
+                entry[1] = self._tick
+                self._touched.pop(key, None)  # время обращения уже в журнале
+                assigned[key] = entry[0]
+                src.append(i)
+            self._vectors[list(assigned.values())] = vectors[src].astype(np.float16)
+            self._append_log_locked(assigned)
+            if self._log_lines >= LOG_COMPACT_LINES:
+                self._write_index_locked()
+
+    def encode(
+            self,
+            texts: Sequence[str],
+            encode_fn: Callable[[List[str]], np.ndarray],
+            *,
+            batch_size: int = 256,
+    ) -> np.ndarray:
+        """
+        Эмбеддинги текстов через кэш: найденные берутся из кэша, остальные (уникальные)
+        кодируются через encode_fn батчами по batch_size и записываются в кэш.
+
+        :param texts: тексты
+        :param encode_fn: функция list[str] -> матрица (n, dim)
+        :param batch_size: сколько промахов передаётся в encode_fn за один вызов
+        :return: матрица float32 (len(texts), dim)
+        """
+        out, found = self.get_many(texts)
+        missing = [i for i in range(len(texts)) if not found[i]]
+        if not missing:
+            return out
+        unique: Dict[str, int] = {}
+        for i in missing:
+            unique.setdefault(texts[i], len(unique))
+        todo = list(unique)
+        computed = np.zeros((len(todo), self.dim), dtype=np.float32)
+        for start in range(0, len(todo), max(1, int(batch_size))):
+            chunk = todo[start:start + batch_size]
+            computed[start:start + len(chunk)] = np.asarray(encode_fn(chunk), dtype=np.float32)
+        self.put_many(todo, computed)
+        for i in missing:
+            out[i] = computed[unique[texts[i]]]
+        return out
+
+    def flush(self, force: bool = False) -> None:
+        """
+        Переписывает снимок index.json со временем обращений (LRU): только если обращений накопилось
+        не меньше TICKS_FLUSH_MIN или force. Векторы и новые записи уже сохранены в put_many (журнал).
+        """
+        with self._lock:
+            if not self._touched or (not force and len(self._touched) < TICKS_FLUSH_MIN):
+                return
+            with self._file_lock:
+                self._reload_locked()
+                self._write_index_locked()
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __enter__(self) -> "EmbeddingCache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.flush()
+
+
+@lru_cache(maxsize=None)
+def get_embedding_cache(model_name: str, dim: int, cache_dir: Optional[str] = None) -> EmbeddingCache:
+    """
+    Общий экземпляр кэша на процесс для модели (по умолчанию в settings.EMBEDDING_CACHE_DIR).
+    """
+    if cache_dir is None:
+        from settings import EMBEDDING_CACHE_DIR
+        cache_dir = EMBEDDING_CACHE_DIR
+    return EmbeddingCache(cache_dir, model_name, dim)
@@ -0,0 +1,64 @@
+"""
+embedding_signature.py
+
+Подпись модели эмбеддингов индекса: {"backend", "model", "st_backend", "dim"} в директории индекса
+(embedding.json) и в манифесте индексатора.
+
+Модуль лёгкий (без llama-index и torch): индексатор сверяет подпись до того, как решит, есть ли работа,
+и ничего не изменившаяся библиотека не платит за загрузку модели. Подпись загруженной модели
+(с размерностью) — utils/local_embedding.embedding_signature.
+"""
+from __future__ import annotations
+import os
+import json
+from typing import Any, Dict, Optional
+
+from settings import ST_MODEL_NAME
+
+EMBEDDING_META_FILE = "embedding.json"
+# поля подписи, по которым индекс несовместим с моделью (st_backend — справочно: torch и onnx дают те же векторы)
+_SIGNATURE_KEYS = ("backend", "model", "dim")
+
+
+def expected_embedding_signature(model_name: str = ST_MODEL_NAME) -> Dict[str, Any]:
+    """
+    Подпись текущей модели по settings, без загрузки SentenceTransformer: размерность неизвестна (None)
+    и при сравнении пропускается. Для EMBEDDING_BACKEND, отличного от "local", — подпись модели
+    llama-index (удалённый API, локально ничего не грузится).
+
+    :param model_name: имя модели SentenceTransformer
+    """
+    from settings import EMBEDDING_BACKEND, ST_BACKEND
+
+    if EMBEDDING_BACKEND != "local":
+        from utils.local_embedding import embedding_signature
+        return embedding_signature()
+    from utils.embedding_cache import st_cache_name
+    return {"backend": "local", "model": st_cache_name(model_name), "st_backend": ST_BACKEND, "dim": None}
+
+
+def same_embedding(recorded: Optional[Dict[str, Any]], current: Dict[str, Any]) -> bool:
+    """Совместимы ли подписи: backend и модель совпадают, размерность — если известна у обеих."""
+    if not recorded:
+        return False
+    for key in _SIGNATURE_KEYS:
+        if key == "dim" and (recorded.get(key) is None or current.get(key) is None):
+            continue
+        if recorded.get(key) != current.get(key):
+            return False
+    return True
+
+
+def read_index_embedding(persist_dir: str) -> Optional[Dict[str, Any]]:
+    """Подпись модели из директории индекса (None — индекс без embedding.json)."""
+    path = os.path.join(persist_dir, EMBEDDING_META_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r", encoding="utf-8") as fp:
+        return json.load(fp)
+
+
+def write_index_embedding(persist_dir: str, signature: Dict[str, Any]) -> None:
+    os.makedirs(persist_dir, exist_ok=True)
+    with open(os.path.join(persist_dir, EMBEDDING_META_FILE), "w", encoding="utf-8") as fp:
+        json.dump(signature, fp, ensure_ascii=False, indent=2)
@@ -1,6 +1,7 @@
 import os
 import logging
 import json
+import hashlib
 from typing import List, Dict, Optional, Union
 
 
@@ -89,4 +90,15 @@ def load_json(filepath: str, logger: Optional[logging.Logger] = None) -> Optiona
             logger.error(f"❌ Ошибка чтения файла {filepath}: {str(e)}")
         else:
             print(f"❌ Ошибка чтения файла {filepath}: {str(e)}")
-        return None
\ No newline at end of file
+        return None
+
+
+def file_sha256(filepath: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    sha256 содержимого файла (hex), читается блоками по chunk_size байт.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
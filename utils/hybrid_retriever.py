@@ -0,0 +1,116 @@
+"""
+hybrid_retriever.py
+
+Гибридный retriever llama-index: векторный поиск + BM25 (utils/bm25_index.py), ранги объединяются
+reciprocal rank fusion: score(d) = Σ w_i / (rrf_k + rank_i(d)).
+
+Каждый поиск отдаёт candidate_k кандидатов, после слияния остаются similarity_top_k. Точные совпадения
+(препараты, дозировки, редкие диагнозы) попадают в top_k без увеличения k, то есть без лишних map-вызовов LLM.
+score у NodeWithScore — косинус векторного поиска; у найденных только BM25 — None (отсечение по сходству
+в AdaptiveQA к ним не применяется). Порядок узлов — по RRF.
+
+Пример:
+    retriever = build_retriever(index, similarity_top_k=5)          # settings.HYBRID_RETRIEVAL
+    lc_retriever = LlamaRetrieverForLangChain.from_index(index, similarity_top_k=5)
+"""
+import asyncio
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+from utils.bm25_index import BM25Index, ensure_bm25_index
+from utils.mmap_vector_store import get_nodes_by_id
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], rrf_k: int = 60,
+                           weights: Optional[Sequence[float]] = None) -> List[Tuple[str, float]]:
+    """
+    Reciprocal rank fusion нескольких ранжирований.
+
+    :param rankings: списки id по убыванию релевантности
+    :param rrf_k: сглаживание рангов (60 — значение из статьи Cormack et al.)
+    :param weights: веса ранжирований (по умолчанию 1)
+    :return: [(id, score)] по убыванию score; при равенстве — в порядке первого появления
+    """
+    weights = list(weights) if weights is not None else [1.0] * len(rankings)
+    fused: Dict[str, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, item in enumerate(ranking, start=1):
+            fused[item] = fused.get(item, 0.0) + weight / (rrf_k + rank)
+    return sorted(fused.items(), key=lambda item: -item[1])
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Векторный retriever индекса + BM25 с объединением по RRF.
+    """
+
+    def __init__(
+            self,
+            index: Any,
+            bm25: BM25Index,
+            similarity_top_k: int = 5,
+            candidate_k: int = 20,
+            rrf_k: int = 60,
+            weights: Tuple[float, float] = (1.0, 1.0),
+            **kwargs: Any,
+    ) -> None:
+        """
+        :param index: VectorStoreIndex
+        :param bm25: BM25-индекс тех же узлов
+        :param similarity_top_k: сколько узлов вернуть
+        :param candidate_k: сколько кандидатов берёт каждый поиск
+        :param rrf_k: сглаживание рангов RRF
+        :param weights: веса (вектор, BM25)
+        """
+        super().__init__(**kwargs)
+        self._index = index
+        self._bm25 = bm25
+        self._similarity_top_k = int(similarity_top_k)
+        self._candidate_k = max(int(candidate_k), self._similarity_top_k)
+        self._rrf_k = int(rrf_k)
+        self._weights = tuple(weights)
+        self._vector_retriever = index.as_retriever(similarity_top_k=self._candidate_k)
+
+    def _fuse(self, vector_hits: List[NodeWithScore], lexical_hits: List[Tuple[str, float]]) -> List[NodeWithScore]:
+        by_id = {hit.node.node_id: hit for hit in vector_hits}
+        fused = reciprocal_rank_fusion(
+            [[hit.node.node_id for hit in vector_hits], [node_id for node_id, _ in lexical_hits]],
+            rrf_k=self._rrf_k, weights=self._weights,
+        )[:self._similarity_top_k]
+        loaded = get_nodes_by_id(self._index, [node_id for node_id, _ in fused if node_id not in by_id])
+        result: List[NodeWithScore] = []
+        for node_id, _ in fused:
+            if node_id in by_id:
+                result.append(by_id[node_id])
+            elif node_id in loaded:
+                result.append(NodeWithScore(node=loaded[node_id], score=None))
+        return result
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        vector_hits = self._vector_retriever.retrieve(query_bundle)
+        lexical_hits = self._bm25.search(query_bundle.query_str, self._candidate_k)
+        return self._fuse(vector_hits, lexical_hits)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        vector_hits, lexical_hits = await asyncio.gather(
+            self._vector_retriever.aretrieve(query_bundle),
+            asyncio.to_thread(self._bm25.search, query_bundle.query_str, self._candidate_k),
+        )
+        return await asyncio.to_thread(self._fuse, vector_hits, lexical_hits)
+
+
+def build_retriever(index: Any, similarity_top_k: int = 5, hybrid: Optional[bool] = None,
+                    persist_dir: Optional[str] = None) -> Any:
+    """
+    Retriever llama-index по settings.HYBRID_RETRIEVAL: HybridRetriever (BM25 из persist_dir строится,
+    если его ещё нет) или обычный векторный.
+    """
+    from settings import HYBRID_RETRIEVAL, BM25_CANDIDATES, RRF_K, PERSISTED_INDEX_DIR
+
+    if not (HYBRID_RETRIEVAL if hybrid is None else hybrid):
+        return index.as_retriever(similarity_top_k=similarity_top_k)
+    bm25 = ensure_bm25_index(index, persist_dir or PERSISTED_INDEX_DIR)
+    return HybridRetriever(index, bm25, similarity_top_k=similarity_top_k,
+                           candidate_k=max(BM25_CANDIDATES, similarity_top_k), rrf_k=RRF_K)
@@ -0,0 +1,250 @@
+"""
+local_embedding.py
+
+Локальные эмбеддинги SentenceTransformer (settings.ST_MODEL_NAME) для llama-index — без сетевых вызовов.
+
+Тексты кодируются крупными батчами; большие объёмы (индексация всей библиотеки) — пулом процессов
+по ядрам CPU (SentenceTransformer.start_multi_process_pool). Векторы чанков кэшируются по хэшу текста
+в EmbeddingCache (utils/embedding_cache.py), поэтому переиндексация не кодирует уже встречавшиеся чанки.
+
+Модель, которой построен индекс (EMBEDDING_BACKEND, имя модели с учётом int8, размерность), записывается
+в директорию индекса (embedding.json): индексатор по ней решает, нужна ли полная переиндексация,
+а load_index отказывается открывать индекс другой модели. Чтение и сравнение подписи без загрузки
+модели — utils/embedding_signature.py.
+
+Пример:
+    configure_embeddings()              # Settings.embed_model = LocalSTEmbedding()
+    embed_nodes(nodes)                  # векторы всех узлов одним проходом (с пулом процессов)
+    index = VectorStoreIndex(nodes)     # узлы с готовым embedding повторно не кодируются
+"""
+from __future__ import annotations
+import os
+import asyncio
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+
+from settings import ST_MODEL_NAME, EMBED_BATCH_SIZE, EMBED_MULTI_PROCESS_MIN, EMBED_WORKERS
+from utils.embedding_signature import expected_embedding_signature, read_index_embedding, same_embedding
+
+
+
+def _normalize_rows(emb: np.ndarray) -> np.ndarray:
+    emb = np.asarray(emb, dtype=np.float32)
+    norms = np.linalg.norm(emb, axis=1, keepdims=True)
+    return emb / np.maximum(norms, 1e-12)
+
+
+def encode_multi_process(model: Any, texts: Sequence[str], *, batch_size: int = 256,
+                         workers: Optional[int] = None) -> np.ndarray:
+    """
+    L2-нормализованные эмбеддинги пулом процессов SentenceTransformer (по процессу на ядро, не более workers).
+
+    :param model: SentenceTransformer
+    :param texts: тексты
+    :param batch_size: батч каждого процесса
+    :param workers: число процессов (None — по числу ядер)
+    :return: матрица float32 (len(texts), dim)
+    """
+    workers = workers or os.cpu_count() or 1
+    pool = model.start_multi_process_pool(target_devices=["cpu"] * workers)
+    try:
+        chunk_size = max(batch_size, -(-len(texts) // (workers * 4)))  # ~4 задачи на процесс
+        emb = model.encode_multi_process(list(texts), pool, batch_size=batch_size, chunk_size=chunk_size)
+    finally:
+        model.stop_multi_process_pool(pool)
+    return _normalize_rows(emb)
+
+
+class LocalSTEmbedding(BaseEmbedding):
+    """
+    Эмбеддинг-модель llama-index поверх локального SentenceTransformer с кэшем векторов чанков.
+    """
+
+    model_name: str = Field(default=ST_MODEL_NAME, description="Имя модели SentenceTransformer.")
+    multi_process_min: int = Field(
+        default=EMBED_MULTI_PROCESS_MIN,
+        description="С какого числа текстов кодировать пулом процессов (0 — никогда).",
+    )
+    workers: Optional[int] = Field(default=EMBED_WORKERS, description="Число процессов пула (None — по ядрам).")
+    use_cache: bool = Field(default=True, description="Кэшировать векторы текстов (не запросов).")
+
+    _model: Any = PrivateAttr()
+    _cache: Any = PrivateAttr()
+
+    def __init__(self, model_name: str = ST_MODEL_NAME, *, embed_batch_size: int = EMBED_BATCH_SIZE,
+                 **kwargs: Any) -> None:
+        super().__init__(model_name=model_name, embed_batch_size=embed_batch_size, **kwargs)
+        from toolkit.pdf_preprocessing.headings_to_styles_matching import get_st_model_cached
+        from utils.embedding_cache import st_cache_name
+
+        self._model = get_st_model_cached(model_name)  # backend — settings.ST_BACKEND
+        self._cache = None
+        if self.use_cache:
+            from utils.embedding_cache import get_embedding_cache
+            self._cache = get_embedding_cache(st_cache_name(model_name), self._model.get_sentence_embedding_dimension())
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LocalSTEmbedding"
+
+    @property
+    def cache(self) -> Any:
+        return self._cache
+
+    @property
+    def dim(self) -> int:
+        return int(self._model.get_sentence_embedding_dimension())
+
+    def _encode_uncached(self, texts: List[str]) -> np.ndarray:
+        if 0 < self.multi_process_min <= len(texts) and (self.workers or os.cpu_count() or 1) > 1:
+            return encode_multi_process(self._model, texts, batch_size=self.embed_batch_size, workers=self.workers)
+        return np.asarray(
+            self._model.encode(texts, batch_size=self.embed_batch_size, normalize_embeddings=True,
+                               convert_to_numpy=True, show_progress_bar=False),
+            dtype=np.float32,
+        )
+
+    def embed_texts(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Эмбеддинги текстов одним вызовом: промахи кэша кодируются все вместе (пулом процессов,
+        если их не меньше multi_process_min), а не батчами llama-index по embed_batch_size.
+
+        :return: матрица float32 (len(texts), dim)
+        """
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self._model.get_sentence_embedding_dimension()), dtype=np.float32)
+        if self._cache is None:
+            return self._encode_uncached(texts)
+        return self._cache.encode(texts, self._encode_uncached, batch_size=max(len(texts), 1))
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._encode_uncached([query])[0].tolist()
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        # кодирование в пуле потоков, чтобы aretrieve не блокировал event loop
+        return await asyncio.to_thread(self._get_query_embedding, query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self.embed_texts([text])[0].tolist()
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_texts(texts).tolist()
+
+
+@lru_cache(maxsize=None)
+def get_local_embed_model(model_name: str = ST_MODEL_NAME) -> LocalSTEmbedding:
+    """Общий экземпляр LocalSTEmbedding на процесс."""
+    return LocalSTEmbedding(model_name)
+
+
+def configure_embeddings() -> Optional[BaseEmbedding]:
+    """
+    Выставляет llama_index Settings.embed_model по settings.EMBEDDING_BACKEND
+    ("local" — LocalSTEmbedding; иначе настройки llama-index не меняются).
+    Индексация и запросы должны использовать одну и ту же модель.
+    """
+    from llama_index.core import Settings
+    from settings import EMBEDDING_BACKEND
+
+    if EMBEDDING_BACKEND != "local":
+        return None
+    Settings.embed_model = get_local_embed_model()
+    return Settings.embed_model
+
+
+def embedding_signature(embed_model: Optional[BaseEmbedding] = None) -> Dict[str, Any]:
+    """
+    Подпись модели эмбеддингов индекса: {"backend", "model", "st_backend", "dim"}.
+    Для локальной модели имя — st_cache_name (int8-векторы отличаются от fp32); для модели llama-index
+    по умолчанию размерность без обращения к API неизвестна (None).
+
+    :param embed_model: модель (None — по settings.EMBEDDING_BACKEND)
+    """
+    from settings import EMBEDDING_BACKEND
+
+    if EMBEDDING_BACKEND == "local":
+        model = embed_model if isinstance(embed_model, LocalSTEmbedding) else get_local_embed_model()
+        return {**expected_embedding_signature(model.model_name), "dim": model.dim}
+    if embed_model is None:
+        from llama_index.core import Settings
+        embed_model = Settings.embed_model
+    return {"backend": EMBEDDING_BACKEND, "model": getattr(embed_model, "model_name", None) or embed_model.class_name(),
+            "st_backend": None, "dim": None}
+
+
+def check_index_embedding(persist_dir: str, embed_model: Optional[BaseEmbedding] = None) -> None:
+    """
+    Проверяет, что индекс построен текущей моделью эмбеддингов.
+
+    :raises ValueError: модель, backend или размерность индекса не совпадают с текущими
+    """
+    recorded = read_index_embedding(persist_dir)
+    if recorded is None:
+        print(f"[embeddings] {persist_dir}: модель эмбеддингов индекса не записана — "
+              f"при смене модели переиндексируйте (python -m medreader.index_creator)")
+        return
+    current = embedding_signature(embed_model)
+    if not same_embedding(recorded, current):
+        raise ValueError(
+            f"Индекс {persist_dir} построен моделью {recorded.get('model')} ({recorded.get('backend')}, "
+            f"dim={recorded.get('dim')}), а текущая — {current.get('model')} ({current.get('backend')}, "
+            f"dim={current.get('dim')}). Переиндексируйте: python -m medreader.index_creator"
+        )
+
+
+def embed_nodes(nodes: Sequence[Any], embed_model: Optional[LocalSTEmbedding] = None) -> int:
+    """
+    Заполняет node.embedding у узлов без вектора одним проходом embed_texts (текст — как его видит
+    llama-index при эмбеддинге, MetadataMode.EMBED). VectorStoreIndex такие узлы повторно не кодирует.
+
+    :return: число заполненных узлов
+    """
+    from llama_index.core.schema import MetadataMode
+
+    todo = [node for node in nodes if node.embedding is None]
+    if not todo:
+        return 0
+    model = embed_model or get_local_embed_model()
+    vectors = model.embed_texts([node.get_content(metadata_mode=MetadataMode.EMBED) for node in todo])
+    for node, vector in zip(todo, vectors):
+        node.embedding = vector.tolist()
+    if model.cache is not None:
+        model.cache.flush()
+    return len(todo)
+
+
+if __name__ == "__main__":
+    from time import perf_counter
+    from utils.formatting import format_time
+
+    MD_PATH = os.path.join("../tests/data", "Easy Paediatrics.md")
+    if os.path.isfile(MD_PATH):
+        with open(MD_PATH, "r", encoding="utf-8") as fp:
+            paragraphs = [p.strip() for p in fp.read().split("\n\n") if p.strip()]
+    else:
+        paragraphs = [f"Synthetic clinical paragraph {i} about fever, rash and cough in children." for i in range(500)]
+    bench_texts = [f"{paragraphs[i % len(paragraphs)]} [{i}]" for i in range(max(4000, len(paragraphs)))]
+
+    model_ = LocalSTEmbedding(use_cache=False, multi_process_min=0)
+    for label, fn in (
+            ("один процесс", lambda: model_.embed_texts(bench_texts)),
+            ("пул процессов", lambda: encode_multi_process(model_._model, bench_texts,
+                                                           batch_size=EMBED_BATCH_SIZE)),
+    ):
+        t1 = perf_counter()
+        fn()
+        t2 = perf_counter()
+        print(f"{label}: {len(bench_texts)} узлов за {format_time(t2 - t1)} — {len(bench_texts) / (t2 - t1):.0f} узлов/с")
+
+    cached_ = get_local_embed_model()
+    cached_.embed_texts(bench_texts)  # заполняет кэш
+    t1 = perf_counter()
+    cached_.embed_texts(bench_texts)
+    t2 = perf_counter()
+    print(f"из кэша: {len(bench_texts) / (t2 - t1):.0f} узлов/с, hit rate {cached_.cache.hit_rate():.2%}")
+    cached_.cache.flush()
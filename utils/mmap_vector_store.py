@@ -0,0 +1,411 @@
+"""
+mmap_vector_store.py
+
+Векторное хранилище llama-index с быстрой холодной загрузкой.
+
+Эмбеддинги лежат в memory-mapped матрице (vectors.f16 или vectors.f32, строки L2-нормализованы),
+тексты и метаданные узлов — в SQLite (nodes.sqlite). При открытии читается только список удалённых строк:
+страницы матрицы подгружаются ОС по мере поиска, узлы — из SQLite только для top_k результатов.
+Хранилище хранит текст (stores_text=True), поэтому docstore индекса не наполняется узлами и не парсится
+при загрузке.
+
+Пример:
+    index = load_index(PERSISTED_INDEX_DIR)                       # settings.VECTOR_STORE == "mmap"
+    retriever = index.as_retriever(similarity_top_k=7)
+"""
+from __future__ import annotations
+import os
+import json
+import asyncio
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    FilterCondition,
+    FilterOperator,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.utils import metadata_dict_to_node, node_to_metadata_dict
+
+MMAP_STORE_DIRNAME = "mmap_vector_store"
+SQLITE_FILE = "nodes.sqlite"
+_SQL_BATCH = 500  # параметров в одном IN (...)
+_DTYPES = {"float16": (np.float16, "vectors.f16"), "float32": (np.float32, "vectors.f32")}
+
+
+def _match_filters(metadata: Dict[str, Any], filters: Optional[MetadataFilters]) -> bool:
+    """Проверка метаданных узла по MetadataFilters (==, !=, in, nin, >, <, >=, <=; AND/OR, вложенные фильтры)."""
+    if filters is None or not filters.filters:
+        return True
+    results = []
+    for flt in filters.filters:
+        if isinstance(flt, MetadataFilters):
+            results.append(_match_filters(metadata, flt))
+            continue
+        value = metadata.get(flt.key)
+        op = flt.operator
+        if op == FilterOperator.EQ:
+            ok = value == flt.value
+        elif op == FilterOperator.NE:
+            ok = value != flt.value
+        elif op == FilterOperator.IN:
+            ok = value in flt.value
+        elif op == FilterOperator.NIN:
+            ok = value not in flt.value
+        elif value is None:
+            ok = False
+        elif op == FilterOperator.GT:
+            ok = value > flt.value
+        elif op == FilterOperator.LT:
+            ok = value < flt.value
+        elif op == FilterOperator.GTE:
+            ok = value >= flt.value
+        elif op == FilterOperator.LTE:
+            ok = value <= flt.value
+        else:
+            raise NotImplementedError(f"Оператор фильтра {op} не поддерживается MmapVectorStore")
+        results.append(ok)
+    return any(results) if filters.condition == FilterCondition.OR else all(results)
+
+
+class MmapVectorStore(BasePydanticVectorStore):
+    """
+    Векторное хранилище: memory-mapped матрица эмбеддингов + SQLite с узлами. Поиск — косинус (скалярное
+    произведение нормализованных векторов) блоками по block_rows строк.
+
+    Потокобезопасно в пределах процесса. Изменения пишутся на диск в persist() (StorageContext.persist).
+    """
+
+    stores_text: bool = True
+    flat_metadata: bool = False
+
+    path: str
+    dtype: str = "float16"
+    block_rows: int = 65536
+
+    _lock: Any = PrivateAttr()
+    _conn: Any = PrivateAttr()
+    _vectors: Any = PrivateAttr()
+    _dim: Any = PrivateAttr()
+    _count: int = PrivateAttr()
+    _deleted: Any = PrivateAttr()
+
+    def __init__(self, path: str, dtype: str = "float16", block_rows: int = 65536, **kwargs: Any) -> None:
+        """
+        :param path: директория хранилища
+        :param dtype: тип матрицы: "float16" (вдвое меньше памяти) или "float32"
+        :param block_rows: по сколько строк матрицы считать скалярные произведения при поиске
+        """
+        if dtype not in _DTYPES:
+            raise ValueError(f"dtype должен быть одним из {', '.join(_DTYPES)}")
+        super().__init__(path=path, dtype=dtype, block_rows=block_rows, **kwargs)
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(path, SQLITE_FILE), check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS nodes (
+                row INTEGER PRIMARY KEY,
+                node_id TEXT UNIQUE,
+                ref_doc_id TEXT,
+                node_json TEXT,
+                deleted INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS nodes_ref_doc ON nodes (ref_doc_id);
+            """
+        )
+        meta = dict(self._conn.execute("SELECT key, value FROM meta").fetchall())
+        if meta.get("dtype", dtype) != dtype:
+            raise ValueError(f"Хранилище {path} создано с dtype={meta['dtype']}")
+        self._dim = int(meta["dim"]) if "dim" in meta else None
+        self._count = int(self._conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM nodes").fetchone()[0])
+        self._vectors = None
+        self._deleted = None
+        if self._dim is not None:
+            self._vectors = self._open(max(int(meta.get("capacity", self._count)), self._count, 1))
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MmapVectorStore"
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, **kwargs: Any) -> "MmapVectorStore":
+        """Хранилище в поддиректории MMAP_STORE_DIRNAME директории индекса."""
+        return cls(os.path.join(persist_dir, MMAP_STORE_DIRNAME), **kwargs)
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    # ───────────────────────────── хранилище ─────────────────────────────
+
+    def _open(self, capacity: int) -> np.memmap:
+        np_dtype, file_name = _DTYPES[self.dtype]
+        vec_path = os.path.join(self.path, file_name)
+        size = capacity * self._dim * np.dtype(np_dtype).itemsize
+        mode = "r+" if os.path.isfile(vec_path) else "w+"
+        if mode == "r+" and os.path.getsize(vec_path) < size:
+            with open(vec_path, "r+b") as fp:
+                fp.truncate(size)
+        return np.memmap(vec_path, dtype=np_dtype, mode=mode, shape=(capacity, self._dim))
+
+    def _ensure_capacity(self, rows: int) -> None:
+        capacity = 0 if self._vectors is None else int(self._vectors.shape[0])
+        if rows <= capacity:
+            return
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        self._vectors = self._open(max(rows, capacity * 2, 1024))
+
+    def _deleted_mask(self) -> np.ndarray:
+        """Маска удалённых строк (читается из SQLite один раз)."""
+        if self._deleted is None or self._deleted.shape[0] < self._count:
+            mask = np.zeros(self._count, dtype=bool)
+            rows = [r for (r,) in self._conn.execute("SELECT row FROM nodes WHERE deleted = 1")]
+            if rows:
+                mask[rows] = True
+            self._deleted = mask
+        return self._deleted
+
+    def _rows_where(self, column: str, values: Sequence[Any]) -> List[int]:
+        """Живые строки, у которых column входит в values (порциями — лимит параметров SQLite)."""
+        rows: List[int] = []
+        values = list(values)
+        for start in range(0, len(values), _SQL_BATCH):
+            part = values[start:start + _SQL_BATCH]
+            rows.extend(r for (r,) in self._conn.execute(
+                f"SELECT row FROM nodes WHERE deleted = 0 AND {column} IN ({','.join('?' * len(part))})", part))
+        return rows
+
+    def _mark_deleted(self, rows: List[int]) -> None:
+        """Помечает строки удалёнными (узел из SQLite стирается, строка матрицы остаётся до compact())."""
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany("UPDATE nodes SET deleted = 1, node_json = NULL, node_id = NULL WHERE row = ?",
+                                   [(r,) for r in rows])
+            self._deleted_mask()[rows] = True
+
+    # ───────────────────────────── API vector store ─────────────────────────────
+
+    def add(self, nodes: Sequence[BaseNode], **add_kwargs: Any) -> List[str]:
+        if not nodes:
+            return []
+        emb = np.asarray([node.get_embedding() for node in nodes], dtype=np.float32)
+        emb /= np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            if self._dim is None:
+                self._dim = int(emb.shape[1])
+                self._conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                       [("dim", str(self._dim)), ("dtype", self.dtype)])
+            elif emb.shape[1] != self._dim:
+                raise ValueError(f"Размерность эмбеддингов {emb.shape[1]} не совпадает с хранилищем ({self._dim})")
+            # повторно добавленный узел заменяет прежний
+            self._mark_deleted(self._rows_where("node_id", [n.node_id for n in nodes]))
+            start = self._count
+            self._ensure_capacity(start + len(nodes))
+            self._vectors[start:start + len(nodes)] = emb.astype(self._vectors.dtype)
+            self._conn.executemany(
+                "INSERT INTO nodes (row, node_id, ref_doc_id, node_json) VALUES (?, ?, ?, ?)",
+                [
+                    (start + i, node.node_id, node.ref_doc_id,
+                     json.dumps(node_to_metadata_dict(node, remove_text=False, flat_metadata=self.flat_metadata),
+                                ensure_ascii=False))
+                    for i, node in enumerate(nodes)
+                ],
+            )
+            self._count = start + len(nodes)
+            if self._deleted is not None:
+                self._deleted = np.concatenate([self._deleted, np.zeros(len(nodes), dtype=bool)])
+        return [node.node_id for node in nodes]
+
+    def get_nodes(self, node_ids: Optional[List[str]] = None, filters: Optional[MetadataFilters] = None,
+                  **kwargs: Any) -> List[BaseNode]:
+        """Узлы по node_ids (None — все живые узлы) в порядке строк, с фильтром по метаданным."""
+        with self._lock:
+            if node_ids is None:
+                rows = [r for (r,) in self._conn.execute("SELECT row FROM nodes WHERE deleted = 0 ORDER BY row")]
+            else:
+                rows = sorted(self._rows_where("node_id", node_ids))
+            loaded = self._load_nodes(rows)
+        return [loaded[r] for r in rows if r in loaded and _match_filters(loaded[r].metadata, filters)]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        with self._lock:
+            self._mark_deleted(self._rows_where("ref_doc_id", [ref_doc_id]))
+
+    def delete_nodes(self, node_ids: Optional[List[str]] = None, filters: Optional[MetadataFilters] = None,
+                     **delete_kwargs: Any) -> None:
+        if filters is not None:
+            raise NotImplementedError("MmapVectorStore.delete_nodes поддерживает только node_ids")
+        if node_ids:
+            with self._lock:
+                self._mark_deleted(self._rows_where("node_id", node_ids))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM nodes")
+            self._conn.commit()
+            self._count = 0
+            self._deleted = None
+
+    def _scores(self, query: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        """Косинус запроса со строками (все строки или rows); удалённые — -inf."""
+        if rows is not None:
+            scores = self._vectors[rows].astype(np.float32) @ query
+            scores[self._deleted_mask()[rows]] = -np.inf
+            return scores
+        scores = np.empty(self._count, dtype=np.float32)
+        for start in range(0, self._count, self.block_rows):
+            end = min(start + self.block_rows, self._count)
+            scores[start:end] = self._vectors[start:end].astype(np.float32) @ query
+        scores[self._deleted_mask()] = -np.inf
+        return scores
+
+    def _load_nodes(self, rows: Sequence[int]) -> Dict[int, BaseNode]:
+        rows = [int(r) for r in rows]
+        found = []
+        for start in range(0, len(rows), _SQL_BATCH):
+            part = rows[start:start + _SQL_BATCH]
+            found.extend(self._conn.execute(
+                f"SELECT row, node_json FROM nodes WHERE row IN ({','.join('?' * len(part))})", part))
+        return {row: metadata_dict_to_node(json.loads(node_json)) for row, node_json in found if node_json}
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.query_embedding is None:
+            raise ValueError("MmapVectorStore поддерживает только запросы с эмбеддингом")
+        top_k = int(query.similarity_top_k or 1)
+        with self._lock:
+            if self._count == 0 or self._dim is None:
+                return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+            q = np.asarray(query.query_embedding, dtype=np.float32)
+            q /= max(float(np.linalg.norm(q)), 1e-12)
+
+            rows: Optional[np.ndarray] = None
+            if query.node_ids:
+                rows = np.array(sorted(self._rows_where("node_id", query.node_ids)), dtype=np.int64)
+                if rows.size == 0:
+                    return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+            scores = self._scores(q, rows)
+            alive = int(np.isfinite(scores).sum())
+
+            nodes: List[BaseNode] = []
+            similarities: List[float] = []
+            # без фильтров — ровно top_k; с фильтрами — кандидаты по убыванию сходства порциями
+            step = top_k if query.filters is None else max(4 * top_k, 64)
+            taken = 0
+            while len(nodes) < top_k and taken < alive:
+                want = min(taken + step, alive)
+                part = np.argpartition(-scores, want - 1)[:want] if want < scores.size else np.arange(scores.size)
+                part = part[np.argsort(-scores[part], kind="stable")][taken:want]
+                positions = rows[part] if rows is not None else part
+                loaded = self._load_nodes(positions)
+                for pos, idx in zip(positions.tolist(), part.tolist()):
+                    node = loaded.get(pos)
+                    if node is None or not _match_filters(node.metadata, query.filters):
+                        continue
+                    nodes.append(node)
+                    similarities.append(float(scores[idx]))
+                    if len(nodes) == top_k:
+                        break
+                taken = want
+        return VectorStoreQueryResult(nodes=nodes, similarities=similarities, ids=[n.node_id for n in nodes])
+
+    async def aquery(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """query в пуле потоков: блочный поиск по матрице и чтение SQLite не блокируют event loop."""
+        return await asyncio.to_thread(self.query, query, **kwargs)
+
+    def persist(self, persist_path: str = "", fs: Any = None) -> None:
+        """
+        Сбрасывает матрицу и SQLite на диск. persist_path (файл JSON-хранилища по умолчанию) не используется:
+        данные живут в self.path.
+        """
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+                self._conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                   ("capacity", str(int(self._vectors.shape[0]))))
+            self._conn.commit()
+
+    def compact(self) -> int:
+        """
+        Переписывает хранилище без удалённых строк (после массовых удалений).
+
+        :return: число освободившихся строк
+        """
+        with self._lock:
+            mask = self._deleted_mask()
+            keep = np.flatnonzero(~mask)
+            removed = self._count - int(keep.size)
+            if removed == 0:
+                return 0
+            if keep.size:
+                self._vectors[:keep.size] = self._vectors[keep]
+            self._conn.execute("DELETE FROM nodes WHERE deleted = 1")
+            self._conn.execute("UPDATE nodes SET row = -row - 1")
+            self._conn.executemany("UPDATE nodes SET row = ? WHERE row = ?",
+                                   [(new, -int(old) - 1) for new, old in enumerate(keep.tolist())])
+            self._count = int(keep.size)
+            self._deleted = np.zeros(self._count, dtype=bool)
+        self.persist()
+        return removed
+
+
+def get_storage_context(persist_dir: str, vector_store: Optional[str] = None) -> Any:
+    """
+    StorageContext для директории индекса с векторным хранилищем по settings.VECTOR_STORE
+    ("mmap" — MmapVectorStore, "simple" — JSON-хранилище llama-index по умолчанию).
+    Для несуществующей директории — новый пустой контекст.
+    """
+    from llama_index.core import StorageContext
+
+    if vector_store is None:
+        from settings import VECTOR_STORE
+        vector_store = VECTOR_STORE
+    exists = os.path.isdir(persist_dir) and os.path.isfile(os.path.join(persist_dir, "docstore.json"))
+    if vector_store == "mmap":
+        store = MmapVectorStore.from_persist_dir(persist_dir)
+        if exists:
+            return StorageContext.from_defaults(persist_dir=persist_dir, vector_store=store)
+        return StorageContext.from_defaults(vector_store=store)
+    return StorageContext.from_defaults(persist_dir=persist_dir) if exists else StorageContext.from_defaults()
+
+
+def load_index(persist_dir: str, vector_store: Optional[str] = None, check_embedding: bool = True) -> Any:
+    """
+    Загружает индекс из persist_dir с хранилищем по settings.VECTOR_STORE.
+
+    :param check_embedding: проверить, что индекс построен текущей моделью эмбеддингов
+    :raises ValueError: индекс построен другой моделью (check_index_embedding)
+    """
+    from llama_index.core import load_index_from_storage
+
+    if check_embedding:
+        from utils.local_embedding import check_index_embedding
+        check_index_embedding(persist_dir)
+    return load_index_from_storage(get_storage_context(persist_dir, vector_store))
+
+
+def get_nodes_by_id(index: Any, node_ids: Sequence[str]) -> Dict[str, BaseNode]:
+    """
+    Узлы индекса по id: из docstore, недостающие — из векторного хранилища, если оно хранит текст
+    (MmapVectorStore). Отсутствующие id пропускаются.
+    """
+    found: Dict[str, BaseNode] = {}
+    for node_id in node_ids:
+        node = index.docstore.get_node(node_id, raise_error=False)
+        if node is not None:
+            found[node_id] = node
+    missing = [node_id for node_id in node_ids if node_id not in found]
+    if missing and getattr(index.vector_store, "stores_text", False):
+        found.update((node.node_id, node) for node in index.vector_store.get_nodes(node_ids=missing))
+    return found
@@ -0,0 +1,125 @@
+"""
+page_manifest.py
+
+Постраничные отпечатки PDF и манифест для инкрементальной переобработки.
+
+Отпечаток страницы — sha1 нормализованного текста (mode="text": не меняется от пересохранения PDF,
+перекомпоновки объектов и т.п.) или сырого content stream страницы (mode="content": ловит и правки
+без изменения текста — картинки, вёрстку). Манифест хранит отпечатки по файлам; по нему каждый этап
+(спаны, markdown, чанки, LLM-обогащение, эмбеддинги) переделывается только для изменённых страниц.
+
+Пример:
+    manifest = PageManifest.load(PAGE_MANIFEST_PATH)
+    fingerprints, changed = manifest.diff(pdf_path)
+    ...  # переобработать только страницы changed
+    manifest.update(pdf_path, fingerprints)
+    manifest.save()
+"""
+from __future__ import annotations
+import os
+import re
+import hashlib
+import unicodedata
+from typing import Any, Callable, Dict, Iterable, List, Literal, Optional, Set, Tuple, TypeVar
+
+FingerprintMode = Literal["text", "content"]
+T = TypeVar("T")
+
+
+def normalize_page_text(text: str) -> str:
+    """Нормализация текста страницы для отпечатка: NFC, схлопывание пробельных символов, strip."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text or "")).strip()
+
+
+def page_fingerprints(pdf_path: str, mode: FingerprintMode = "text") -> List[str]:
+    """
+    Отпечатки всех страниц PDF по порядку (индекс 0 — страница 1).
+
+    :param pdf_path: путь к PDF
+    :param mode: "text" — sha1 нормализованного текста; "content" — sha1 content stream страницы
+    """
+    import fitz  # PyMuPDF
+
+    out: List[str] = []
+    with fitz.open(pdf_path) as doc:
+        for page in doc:
+            if mode == "content":
+                payload = page.read_contents()
+            else:
+                payload = normalize_page_text(page.get_text("text")).encode("utf-8")
+            out.append(hashlib.sha1(payload).hexdigest())
+    return out
+
+
+def changed_pages(old: Optional[List[str]], new: List[str]) -> Set[int]:
+    """Номера (1-based) страниц, отпечаток которых отличается или которых не было."""
+    old = old or []
+    return {i + 1 for i, fp in enumerate(new) if i >= len(old) or old[i] != fp}
+
+
+def replace_pages(
+        previous: Iterable[T],
+        fresh: Iterable[T],
+        pages: Set[int],
+        page_of: Callable[[T], Any],
+        page_count: Optional[int] = None,
+) -> List[T]:
+    """
+    Заменяет элементы изменённых страниц свежими (спаны, чанки и т.п.); порядок — по странице.
+
+    :param previous: элементы прошлой обработки
+    :param fresh: элементы, заново полученные для страниц pages
+    :param pages: номера изменённых страниц
+    :param page_of: номер страницы элемента
+    :param page_count: число страниц новой версии (элементы удалённых хвостовых страниц отбрасываются)
+    """
+    kept = [
+        item for item in previous
+        if page_of(item) not in pages and (page_count is None or (page_of(item) or 0) <= page_count)
+    ]
+    return sorted(kept + list(fresh), key=lambda item: page_of(item) or 0)
+
+
+class PageManifest:
+    """
+    Манифест постраничных отпечатков: {file_name: {"mode": ..., "pages": [fingerprint, ...]}}.
+    """
+
+    def __init__(self, path: str, files: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
+        self.path = path
+        self.files: Dict[str, Dict[str, Any]] = files or {}
+
+    @classmethod
+    def load(cls, path: str) -> "PageManifest":
+        from utils.general import load_json
+        data = load_json(path) if os.path.isfile(path) else None
+        return cls(path, (data or {}).get("files", {}))
+
+    def save(self) -> bool:
+        from utils.general import save_json
+        return save_json({"files": self.files}, self.path)
+
+    def fingerprints(self, pdf_path: str) -> Optional[List[str]]:
+        entry = self.files.get(os.path.basename(pdf_path))
+        return list(entry["pages"]) if entry else None
+
+    def diff(self, pdf_path: str, mode: FingerprintMode = "text") -> Tuple[List[str], Set[int]]:
+        """
+        Текущие отпечатки файла и номера страниц, изменившихся с прошлой записи в манифесте.
+        Смена режима отпечатков считается изменением всех страниц.
+        """
+        new = page_fingerprints(pdf_path, mode)
+        entry = self.files.get(os.path.basename(pdf_path))
+        old = entry["pages"] if entry and entry.get("mode", "text") == mode else None
+        return new, changed_pages(old, new)
+
+    def update(self, pdf_path: str, fingerprints: List[str], mode: FingerprintMode = "text") -> None:
+        self.files[os.path.basename(pdf_path)] = {"mode": mode, "pages": list(fingerprints)}
+
+    def forget(self, file_name: str) -> None:
+        self.files.pop(os.path.basename(file_name), None)
+
+    def removed_files(self, present: Iterable[str]) -> List[str]:
+        """Файлы из манифеста, которых больше нет среди present (имена или пути)."""
+        names = {os.path.basename(p) for p in present}
+        return [name for name in self.files if name not in names]
@@ -1,20 +1,119 @@
 """
 Пример четырех способов чтения PDF файлов
+
+Документы открываются через общий пул дескрипторов (DocumentPool): повторное чтение страниц той же
+книги не открывает файл и не разбирает xref заново. Для обхода книги — пакетный
+read_pages_text_blocks и итератор iter_pages_text_blocks с чтением следующей страницы заранее.
 """
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
 import fitz  # PyMuPDF
 
 
+class DocumentPool:
+    """
+    Потокобезопасный пул открытых fitz.Document (на процесс) с LRU-лимитом открытых файлов.
+
+    Документ выдаётся под своей блокировкой (fitz.Document не потокобезопасен), так что разные книги
+    читаются параллельно, а одна — последовательно. Ключ — (абсолютный путь, mtime, размер):
+    заменённый файл открывается заново. После fork пул в дочернем процессе начинается с нуля.
+
+    Пример:
+        with get_document_pool().document(pdf_path) as doc:
+            text = doc[10].get_text("text")
+    """
+
+    def __init__(self, max_open: int = 8) -> None:
+        self.max_open = max(1, int(max_open))
+        self._lock = threading.Lock()
+        self._docs: "OrderedDict[Tuple[str, float, int], List]" = OrderedDict()  # key -> [doc, lock, in_use]
+        self._pid = os.getpid()
+
+    @staticmethod
+    def _key(pdf_path: str) -> Tuple[str, float, int]:
+        path = os.path.abspath(pdf_path)
+        st = os.stat(path)
+        return path, st.st_mtime, st.st_size
+
+    def _evict(self) -> None:
+        """Закрывает давно не использованные документы сверх лимита (кроме занятых)."""
+        for key in list(self._docs):
+            if len(self._docs) <= self.max_open:
+                break
+            doc, _, in_use = self._docs[key]
+            if in_use:
+                continue
+            del self._docs[key]
+            doc.close()
+
+    @contextmanager
+    def document(self, pdf_path: str) -> Iterator[fitz.Document]:
+        """Открытый документ из пула (под блокировкой документа на время with-блока)."""
+        key = self._key(pdf_path)
+        with self._lock:
+            if self._pid != os.getpid():  # дескрипторы родителя после fork не используем
+                self._docs = OrderedDict()
+                self._pid = os.getpid()
+            entry = self._docs.get(key)
+            if entry is None:
+                entry = self._docs[key] = [fitz.open(key[0]), threading.Lock(), 0]
+            self._docs.move_to_end(key)
+            entry[2] += 1
+            self._evict()
+        try:
+            with entry[1]:
+                yield entry[0]
+        finally:
+            with self._lock:
+                entry[2] -= 1
+                self._evict()
+
+    def close(self) -> None:
+        """Закрывает все свободные документы."""
+        with self._lock:
+            for key in list(self._docs):
+                doc, _, in_use = self._docs[key]
+                if not in_use:
+                    del self._docs[key]
+                    doc.close()
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+
+_POOL = DocumentPool()
+
+
+def get_document_pool() -> DocumentPool:
+    """Пул документов текущего процесса."""
+    return _POOL
+
+
+def _check_page(doc: fitz.Document, page_number: int) -> None:
+    if page_number < 0 or page_number >= len(doc):
+        raise ValueError(f"Номер страницы {page_number} вне диапазона (0-{len(doc) - 1})")
+
+
+def _text_blocks(page: fitz.Page) -> str:
+    blocks = page.get_text("blocks")  # Возвращает список блоков текста
+    result = []
+    for block in blocks:
+        if block[6] == 0:  # 0 означает текстовый блок
+            result.append(block[4])  # Текст блока
+    return "\n".join(result)
+
+
 # Вариант 1: Простое извлечение текста с определенной страницы
 def read_page_text_simple(pdf_path, page_number):
     try:
-        doc = fitz.open(pdf_path)
-        if page_number < 0 or page_number >= len(doc):
-            raise ValueError(f"Номер страницы {page_number} вне диапазона (0-{len(doc) - 1})")
-
-        page = doc[page_number]
-        text = page.get_text("text")
-        doc.close()
-        return text
+        with _POOL.document(pdf_path) as doc:
+            _check_page(doc, page_number)
+            return doc[page_number].get_text("text")
     except Exception as e:
         return f"Ошибка: {str(e)}"
 
@@ -22,18 +121,9 @@ def read_page_text_simple(pdf_path, page_number):
 # Вариант 2: Извлечение текста с форматированием (включая блоки текста)
 def read_page_text_blocks(pdf_path, page_number):
     try:
-        doc = fitz.open(pdf_path)
-        if page_number < 0 or page_number >= len(doc):
-            raise ValueError(f"Номер страницы {page_number} вне диапазона (0-{len(doc) - 1})")
-
-        page = doc[page_number]
-        blocks = page.get_text("blocks")  # Возвращает список блоков текста
-        result = []
-        for block in blocks:
-            if block[6] == 0:  # 0 означает текстовый блок
-                result.append(block[4])  # Текст блока
-        doc.close()
-        return "\n".join(result)
+        with _POOL.document(pdf_path) as doc:
+            _check_page(doc, page_number)
+            return _text_blocks(doc[page_number])
     except Exception as e:
         return f"Ошибка: {str(e)}"
 
@@ -41,14 +131,9 @@ def read_page_text_blocks(pdf_path, page_number):
 # Вариант 3: Извлечение текста в формате словаря (JSON-подобный)
 def read_page_text_dict(pdf_path, page_number):
     try:
-        doc = fitz.open(pdf_path)
-        if page_number < 0 or page_number >= len(doc):
-            raise ValueError(f"Номер страницы {page_number} вне диапазона (0-{len(doc) - 1})")
-
-        page = doc[page_number]
-        text_dict = page.get_text("dict")  # Возвращает структурированный словарь
-        doc.close()
-        return text_dict
+        with _POOL.document(pdf_path) as doc:
+            _check_page(doc, page_number)
+            return doc[page_number].get_text("dict")  # Возвращает структурированный словарь
     except Exception as e:
         return f"Ошибка: {str(e)}"
 
@@ -56,28 +141,73 @@ def read_page_text_dict(pdf_path, page_number):
 # Вариант 4: Извлечение текста с координатами слов
 def read_page_text_words(pdf_path, page_number):
     try:
-        doc = fitz.open(pdf_path)
-        if page_number < 0 or page_number >= len(doc):
-            raise ValueError(f"Номер страницы {page_number} вне диапазона (0-{len(doc) - 1})")
-
-        page = doc[page_number]
-        words = page.get_text("words")  # Возвращает список слов с координатами
+        with _POOL.document(pdf_path) as doc:
+            _check_page(doc, page_number)
+            words = doc[page_number].get_text("words")  # Возвращает список слов с координатами
         result = []
         for word in words:
             result.append({
                 "text": word[4],
                 "coordinates": (word[0], word[1], word[2], word[3])  # x0, y0, x1, y1
             })
-        doc.close()
         return result
     except Exception as e:
         return f"Ошибка: {str(e)}"
 
 
+def read_pages_text_blocks(pdf_path: str, pages: Sequence[int]) -> Dict[int, str]:
+    """
+    Текст блоков нескольких страниц за одно обращение к пулу (см. read_page_text_blocks).
+
+    :param pdf_path: путь к PDF
+    :param pages: номера страниц (начинаются с 0)
+    :return: {номер страницы: текст}; для страницы вне диапазона — строка "Ошибка: ..."
+    """
+    out: Dict[int, str] = {}
+    try:
+        with _POOL.document(pdf_path) as doc:
+            for page_number in pages:
+                try:
+                    _check_page(doc, page_number)
+                    out[page_number] = _text_blocks(doc[page_number])
+                except Exception as e:
+                    out[page_number] = f"Ошибка: {str(e)}"
+    except Exception as e:
+        return {page_number: f"Ошибка: {str(e)}" for page_number in pages}
+    return out
+
+
+def iter_pages_text_blocks(
+        pdf_path: str,
+        pages: Optional[Sequence[int]] = None,
+        prefetch: int = 1,
+) -> Iterator[Tuple[int, str]]:
+    """
+    Страницы по очереди; пока вызывающий код обрабатывает страницу N (например, ждёт LLM),
+    фоновый поток уже читает следующие prefetch страниц.
+
+    :param pdf_path: путь к PDF
+    :param pages: номера страниц (начинаются с 0); None — все страницы документа
+    :param prefetch: сколько страниц читать заранее
+    :return: итератор (номер страницы, текст)
+    """
+    if pages is None:
+        with _POOL.document(pdf_path) as doc:
+            pages = range(len(doc))
+    pages = list(pages)
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-prefetch") as executor:
+        futures = [executor.submit(read_page_text_blocks, pdf_path, p) for p in pages[:max(0, prefetch) + 1]]
+        for i, page_number in enumerate(pages):
+            text = futures[i].result()
+            nxt = i + max(0, prefetch) + 1
+            if nxt < len(pages):
+                futures.append(executor.submit(read_page_text_blocks, pdf_path, pages[nxt]))
+            futures[i] = None
+            yield page_number, text
+
+
 # Пример использования
 if __name__ == "__main__":
-    import os
-
     pdf_file = os.path.join("../data", "med_sources", "Guide-to-Common-Childhood-Infections-2023_Final-Approved.pdf")
     page_num = 10  # Номер страницы (начинается с 0)
 
@@ -93,3 +223,7 @@ if __name__ == "__main__":
     print(read_page_text_dict(pdf_file, page_num))
     print("\nВариант 4 (Слова с координатами):")
     print(read_page_text_words(pdf_file, page_num))
+    print("\nПакетное чтение и чтение с упреждением:")
+    print({p: len(t) for p, t in read_pages_text_blocks(pdf_file, [page_num, page_num + 1]).items()})
+    for p, t in iter_pages_text_blocks(pdf_file, range(page_num, page_num + 3)):
+        print(p, len(t))
@@ -1,6 +1,6 @@
 # retriever_adapter.py
 
-from typing import Any, List
+from typing import Any, List, Optional
 
 from pydantic import Field
 from langchain.schema import BaseRetriever, Document
@@ -9,17 +9,26 @@ from langchain.schema import BaseRetriever, Document
 class LlamaRetrieverForLangChain(BaseRetriever):
     llama_retriever: Any = Field()  # это теперь валидное поле для pydantic!
 
-    def _get_relevant_documents(self, query: str) -> List[Document]:
-        nodes = self.llama_retriever.retrieve(query)
-        docs = [
+    @classmethod
+    def from_index(cls, index: Any, similarity_top_k: int = 5, hybrid: Optional[bool] = None
+                   ) -> "LlamaRetrieverForLangChain":
+        # векторный или гибридный (BM25 + вектор, RRF) retriever — по settings.HYBRID_RETRIEVAL
+        from utils.hybrid_retriever import build_retriever
+        return cls(llama_retriever=build_retriever(index, similarity_top_k, hybrid=hybrid))
+
+    @staticmethod
+    def _to_documents(nodes: List[Any]) -> List[Document]:
+        return [
             Document(
                 page_content=node.text,
                 metadata=node.metadata
             )
             for node in nodes
         ]
-        return docs
+
+    def _get_relevant_documents(self, query: str) -> List[Document]:
+        return self._to_documents(self.llama_retriever.retrieve(query))
 
     async def _aget_relevant_documents(self, query: str) -> List[Document]:
-        # Если не используешь асинхронно, просто повторяем sync-метод
-        return self._get_relevant_documents(query)
+        # Асинхронный поиск llama-index: эмбеддинг запроса и векторное хранилище не блокируют event loop
+        return self._to_documents(await self.llama_retriever.aretrieve(query))
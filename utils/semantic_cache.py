@@ -0,0 +1,337 @@
+"""
+semantic_cache.py
+
+Семантический кэш ответов QA-цепочки: вопрос, сформулированный иначе, но близкий по смыслу к уже
+заданному, получает сохранённый ответ и источники без поиска и map_reduce.
+
+Вопрос нормализуется (NFKC, регистр, пробелы, конечная пунктуация) и кодируется в L2-нормализованный
+эмбеддинг; попадание — лучший по косинусу сохранённый вопрос той же области (scope: "query", "symptoms")
+и той же версии индекса не ниже threshold, с теми же числами и дозировками ("5 mg/kg" и "10 mg/kg",
+"2 years" и "12 years" близки по косинусу, но это разные вопросы). Вопросы-шаблоны, различающиеся только
+сущностью (симптомы диагноза: "hepatitis A" и "hepatitis B"), кэшируются по точному ключу (key) без
+семантического поиска. Записи устаревают по TTL и вытесняются по давности использования (LRU) при
+превышении max_entries. Кэш сохраняется в JSON (save/load).
+
+Пример:
+    cache = SemanticAnswerCache.load(SEMANTIC_CACHE_PATH, index_version=index_version(PERSISTED_INDEX_DIR))
+    result = cached_invoke(qa, question, cache)
+    result = cached_invoke(qa, symptoms_question(diagnosis), cache, scope="symptoms", key=diagnosis)
+    cache.save()
+"""
+from __future__ import annotations
+import os
+import re
+import time
+import hashlib
+import threading
+import unicodedata
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+EmbedFn = Callable[[List[str]], np.ndarray]
+
+# число с необязательной единицей: 5 mg/kg, 0,5 ml, 38.5 °c, 2 years, 10%
+_NUMBER_RE = re.compile(
+    r"(\d+(?:[.,]\d+)?)\s*(mg/kg(?:/day)?|mg|mcg|µg|ug|g|kg|ml|l|mmol/l|iu|units?|°c|%|"
+    r"years?|yrs?|y|months?|mo|weeks?|wk|days?|d|hours?|h)?(?![\w/])"
+)
+
+
+def normalize_question(text: str) -> str:
+    """NFKC, нижний регистр, схлопнутые пробелы, без пунктуации в конце."""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return re.sub(r"[\s?!.;:,]+$", "", text)
+
+
+def number_tokens(text: str) -> List[str]:
+    """Числа и дозировки вопроса ("5mg/kg", "2years", "1") в порядке появления; десятичная запятая — точка."""
+    return [f"{value.replace(',', '.')}{unit or ''}" for value, unit in _NUMBER_RE.findall(normalize_question(text))]
+
+
+def index_version(persist_dir: str, *extra_paths: str) -> str:
+    """
+    Версия индекса: хэш (путь, размер, mtime) файлов директории индекса и дополнительных источников
+    ответа (файлов или директорий; отсутствующий путь тоже часть версии). Любая переиндексация меняет
+    версию, и ответы, полученные на старом индексе, перестают находиться.
+    """
+    digest = hashlib.sha1()
+    for top in (persist_dir, *extra_paths):
+        if os.path.isfile(top):
+            st = os.stat(top)
+            digest.update(f"{top}|{st.st_size}|{st.st_mtime_ns}\n".encode("utf-8"))
+            continue
+        if top != persist_dir and not os.path.isdir(top):
+            digest.update(f"{top}|missing\n".encode("utf-8"))
+            continue
+        for root, _, files in sorted(os.walk(top)):
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                digest.update(f"{os.path.relpath(path, persist_dir)}|{st.st_size}|{st.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def _default_embed_fn() -> EmbedFn:
+    from toolkit.pdf_preprocessing.headings_to_styles_matching import encode_texts, get_st_model_cached
+
+    model = get_st_model_cached()
+    return lambda texts: encode_texts(texts, model=model)
+
+
+class SemanticAnswerCache:
+    """
+    Кэш ответов по смысловой близости вопросов. Потокобезопасен в пределах процесса.
+    """
+
+    def __init__(
+            self,
+            path: Optional[str] = None,
+            *,
+            index_version: str = "",
+            scope_versions: Optional[Dict[str, str]] = None,
+            threshold: float = 0.92,
+            ttl: Optional[float] = 7 * 24 * 3600,
+            max_entries: int = 2000,
+            embed_fn: Optional[EmbedFn] = None,
+    ) -> None:
+        """
+        :param path: JSON-файл кэша (None — только в памяти)
+        :param index_version: версия индекса (index_version()); записи других версий не находятся
+        :param scope_versions: версии для отдельных областей, ответы которых зависят и от других источников
+                               ({"symptoms": ...}); для остальных областей — index_version
+        :param threshold: минимальный косинус между вопросами для попадания
+        :param ttl: время жизни записи, с (None — без ограничения)
+        :param max_entries: максимум записей; сверх него вытесняются давно не использованные
+        :param embed_fn: функция list[str] -> матрица L2-нормализованных эмбеддингов (по умолчанию — MiniLM)
+        """
+        self.path = path
+        self.index_version = index_version
+        self.scope_versions: Dict[str, str] = dict(scope_versions or {})
+        self.threshold = float(threshold)
+        self.ttl = ttl
+        self.max_entries = max(1, int(max_entries))
+        self._embed_fn = embed_fn
+        self._lock = threading.RLock()
+        self._entries: List[Dict[str, Any]] = []
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    # ───────────────────────────── хранение ─────────────────────────────
+
+    @classmethod
+    def load(cls, path: str, **kwargs: Any) -> "SemanticAnswerCache":
+        from utils.general import load_json
+
+        cache = cls(path, **kwargs)
+        data = load_json(path) if os.path.isfile(path) else None
+        if data:
+            entries = data.get("entries", [])
+            cache._entries = [{k: v for k, v in e.items() if k != "vector"} for e in entries]
+            if entries:
+                cache._vectors = np.asarray([e["vector"] for e in entries], dtype=np.float32)
+            cache._purge(time.time())
+        return cache
+
+    def save(self) -> bool:
+        from utils.general import save_json
+
+        if not self.path:
+            return False
+        with self._lock:
+            entries = [{**e, "vector": v.tolist()} for e, v in zip(self._entries, self._vectors)]
+        return save_json({"entries": entries}, self.path)
+
+    def _embed(self, question: str) -> np.ndarray:
+        if self._embed_fn is None:
+            self._embed_fn = _default_embed_fn()
+        vector = np.asarray(self._embed_fn([normalize_question(question)]), dtype=np.float32).reshape(-1)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _remove(self, positions: List[int]) -> None:
+        if not positions:
+            return
+        keep = np.ones(len(self._entries), dtype=bool)
+        keep[positions] = False
+        self._entries = [e for e, k in zip(self._entries, keep) if k]
+        self._vectors = self._vectors[keep]
+
+    def version(self, scope: str) -> str:
+        """Версия индекса для области scope."""
+        return self.scope_versions.get(scope, self.index_version)
+
+    def _purge(self, now: float) -> None:
+        """Удаляет просроченные записи (TTL) и записи других версий индекса."""
+        stale = [
+            i for i, e in enumerate(self._entries)
+            if (self.ttl is not None and now - e["created"] > self.ttl)
+            or (self.version(e["scope"]) and e.get("index_version") != self.version(e["scope"]))
+        ]
+        self.expirations += len(stale)
+        self._remove(stale)
+
+    # ───────────────────────────── API ─────────────────────────────
+
+    def lookup(self, question: str, scope: str = "query", key: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Ответ на близкий вопрос или None.
+
+        :param key: точный ключ (например, диагноз): ищется только запись с тем же нормализованным ключом,
+                    без эмбеддинга вопроса
+        :return: {"question", "answer", "sources", "similarity", "cached_question"} при попадании
+        """
+        now = time.time()
+        if key is not None:
+            key = normalize_question(key)
+            with self._lock:
+                self._purge(now)
+                found = [i for i, e in enumerate(self._entries) if e["scope"] == scope and e.get("key") == key]
+                return self._hit(question, found[-1], 1.0, now) if found else self._miss()
+
+        vector = self._embed(question)
+        numbers = number_tokens(question)
+        with self._lock:
+            self._purge(now)
+            best, best_score = -1, -1.0
+            if self._entries:
+                scores = self._vectors @ vector
+                for i in np.argsort(-scores).tolist():
+                    if scores[i] < self.threshold:
+                        break
+                    entry = self._entries[i]
+                    if entry["scope"] != scope or entry.get("key") is not None:
+                        continue
+                    if entry.get("numbers", number_tokens(entry["question"])) != numbers:
+                        continue  # другие числа/дозировки — другой вопрос
+                    best, best_score = i, float(scores[i])
+                    break
+            if best < 0:
+                return self._miss()
+            return self._hit(question, best, best_score, now)
+
+    def _miss(self) -> None:
+        self.misses += 1
+        return None
+
+    def _hit(self, question: str, position: int, score: float, now: float) -> Dict[str, Any]:
+        entry = self._entries[position]
+        entry["last_used"] = now
+        entry["hits"] = entry.get("hits", 0) + 1
+        self.hits += 1
+        return {"question": question, "answer": entry["answer"], "sources": entry["sources"],
+                "similarity": round(score, 4), "cached_question": entry["question"]}
+
+    def put(self, question: str, answer: str, sources: List[Dict[str, Any]], scope: str = "query",
+            key: Optional[str] = None) -> None:
+        """
+        Сохраняет ответ; при превышении max_entries вытесняет давно не использованные записи.
+
+        :param key: точный ключ записи (см. lookup); запись с ключом находится только по нему
+        """
+        vector = self._embed(question)
+        now = time.time()
+        with self._lock:
+            entry = {"question": question, "scope": scope, "answer": answer, "sources": sources,
+                     "index_version": self.version(scope), "created": now, "last_used": now, "hits": 0,
+                     "numbers": number_tokens(question)}
+            if key is not None:
+                entry["key"] = normalize_question(key)
+                self._remove([i for i, e in enumerate(self._entries)
+                              if e["scope"] == scope and e.get("key") == entry["key"]])
+            self._entries.append(entry)
+            self._vectors = vector[None, :] if self._vectors.size == 0 else np.vstack([self._vectors, vector])
+            overflow = len(self._entries) - self.max_entries
+            if overflow > 0:
+                lru = sorted(range(len(self._entries)), key=lambda i: self._entries[i]["last_used"])[:overflow]
+                self.evictions += len(lru)
+                self._remove(lru)
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hit_rate(), 4), "evictions": self.evictions,
+                "expirations": self.expirations, "index_version": self.index_version,
+                "scope_versions": self.scope_versions}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def open_answer_cache(persist_dir: Optional[str] = None) -> SemanticAnswerCache:
+    """
+    Кэш ответов с параметрами из settings, привязанный к текущей версии индекса persist_dir. Версия "symptoms"
+    включает и источники поиска по диагнозу (индекс заболеваний, синонимы, индекс чанков, сохранённые чанки):
+    их пересборка med_index.pipeline сбрасывает ответы о симптомах.
+    """
+    from settings import (PERSISTED_INDEX_DIR, SEMANTIC_CACHE_PATH, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL,
+                          SEMANTIC_CACHE_MAX_ENTRIES, DISEASE_INDEX_PATH, DISEASE_SYNONYMS_PATH, CHUNKS_INDEX_DIR,
+                          MED_CHUNKS_PATH)
+
+    persist_dir = persist_dir or PERSISTED_INDEX_DIR
+    return SemanticAnswerCache.load(
+        SEMANTIC_CACHE_PATH,
+        index_version=index_version(persist_dir),
+        scope_versions={"symptoms": index_version(persist_dir, DISEASE_INDEX_PATH, DISEASE_SYNONYMS_PATH,
+                                                  CHUNKS_INDEX_DIR, MED_CHUNKS_PATH)},
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        ttl=SEMANTIC_CACHE_TTL,
+        max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+    )
+
+
+def serialize_sources(documents: List[Any]) -> List[Dict[str, Any]]:
+    """Источники ответа (LangChain Document) в JSON."""
+    return [{"text": doc.page_content, "metadata": dict(doc.metadata or {})} for doc in documents or []]
+
+
+def _restore_result(question: str, hit: Dict[str, Any]) -> Dict[str, Any]:
+    from langchain.schema import Document
+
+    return {
+        "query": question,
+        "result": hit["answer"],
+        "source_documents": [Document(page_content=s["text"], metadata=s["metadata"]) for s in hit["sources"]],
+        "cache": {"similarity": hit["similarity"], "cached_question": hit["cached_question"]},
+    }
+
+
+def cached_invoke(qa: Any, question: str, cache: Optional[SemanticAnswerCache], scope: str = "query",
+                  key: Optional[str] = None) -> Dict[str, Any]:
+    """
+    qa.invoke({"query": question}) через семантический кэш. Результат в формате RetrievalQA
+    (при попадании дополнительно ключ "cache").
+
+    :param key: точный ключ вместо семантического поиска (SemanticAnswerCache.lookup)
+    """
+    if cache is not None:
+        hit = cache.lookup(question, scope, key)
+        if hit is not None:
+            return _restore_result(question, hit)
+    result = qa.invoke({"query": question})
+    if cache is not None:
+        cache.put(question, result["result"], serialize_sources(result.get("source_documents")), scope, key)
+    return result
+
+
+async def acached_invoke(qa: Any, question: str, cache: Optional[SemanticAnswerCache],
+                         scope: str = "query", key: Optional[str] = None) -> Dict[str, Any]:
+    """Асинхронный вариант cached_invoke (qa.ainvoke); эмбеддинг вопроса считается в пуле потоков."""
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    if cache is not None:
+        hit = await loop.run_in_executor(None, cache.lookup, question, scope, key)
+        if hit is not None:
+            return _restore_result(question, hit)
+    result = await qa.ainvoke({"query": question})
+    if cache is not None:
+        await loop.run_in_executor(None, cache.put, question, result["result"],
+                                   serialize_sources(result.get("source_documents")), scope, key)
+    return result